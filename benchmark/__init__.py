@@ -0,0 +1 @@
+__all__ = ['bulk_server', 'fixture', 'replicas', 'serializer', 'throughput']
@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""bulk_server.py: Local Elasticsearch `_bulk` stand-in, with configurable latency and rejections.
+
+Run from the project root:
+	python -m benchmark.bulk_server --port 9200 --latency 0.05 --rejections 0.01
+"""
+
+__author__      = "Ber Clausen"
+__copyright__   = "Copyright 2014, Planet Earth"
+
+import json
+import random
+import threading
+import time
+from argparse import ArgumentParser
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+
+
+class BulkHandler(BaseHTTPRequestHandler):
+	"""Answers `_bulk` requests like Elasticsearch does, item by item."""
+
+	# Persistent connections, as the bulk sink keeps them.
+	protocol_version = 'HTTP/1.1'
+
+	def do_POST(self):
+		server = self.server
+		body = self.rfile.read(int(self.headers.getheader('content-length', 0)))
+
+		if not self.path.split('?')[0].endswith('/_bulk'):
+			return self.respond(404, {'error': 'Only _bulk is served.'})
+
+		time.sleep(max(0.0, random.gauss(server.latency + server.latency_per_byte * len(body), server.jitter)))
+
+		if len(body) > server.max_bytes:
+			return self.respond(413, None)
+		if random.random() < server.request_rejections:
+			with server.lock:
+				server.stats['rejected_requests'] += 1
+			return self.respond(429, {'error': 'EsRejectedExecutionException[rejected execution]', 'status': 429})
+
+		items = []
+		lines = body.splitlines()
+		i = 0
+		while i < len(lines):
+			action = json.loads(lines[i])
+			operation, meta = action.items()[0]
+			i += 2 if operation in ['index', 'create', 'update'] else 1
+
+			if random.random() < server.rejections:
+				items.append({operation: dict(meta, status=429,
+					error='EsRejectedExecutionException[rejected execution (queue capacity 50)]')})
+			else:
+				items.append({operation: dict(meta, status=201 if operation != 'delete' else 200, _version=1)})
+
+		rejected = sum(1 for item in items if 'error' in item.values()[0])
+		with server.lock:
+			server.stats['requests'] += 1
+			server.stats['bytes'] += len(body)
+			server.stats['documents'] += len(items) - rejected
+			server.stats['rejected_documents'] += rejected
+
+		self.respond(200, {'took': 1, 'errors': rejected > 0, 'items': items})
+
+	def respond(self, status, response):
+		content = json.dumps(response) if response is not None else ''
+		self.send_response(status)
+		self.send_header('Content-Type', 'application/json')
+		self.send_header('Content-Length', str(len(content)))
+		self.end_headers()
+		self.wfile.write(content)
+
+	def log_message(self, format, *args):
+		pass
+
+
+class BulkServer(ThreadingMixIn, HTTPServer):
+	"""BulkServer class.
+
+	Attributes:
+		latency (float): Mean seconds per request.
+		latency_per_byte (float): Extra seconds per byte of body.
+		jitter (float): Standard deviation of the latency.
+		rejections (float): Probability of rejecting a document with a 429 item.
+		request_rejections (float): Probability of rejecting a whole request with a 429 status.
+		max_bytes (int): Larger bodies are answered with 413.
+		stats (dict): Requests, bytes, documents and rejections served.
+	"""
+
+	daemon_threads = True
+	allow_reuse_address = True
+
+	def __init__(self, port=0, latency=0.0, latency_per_byte=0.0, jitter=0.0, rejections=0.0,
+		request_rejections=0.0, max_bytes=100 * 1024 * 1024):
+		HTTPServer.__init__(self, ('127.0.0.1', port), BulkHandler)
+		self.latency = latency
+		self.latency_per_byte = latency_per_byte
+		self.jitter = jitter
+		self.rejections = rejections
+		self.request_rejections = request_rejections
+		self.max_bytes = max_bytes
+		self.lock = threading.Lock()
+		self.stats = {'requests': 0, 'bytes': 0, 'documents': 0, 'rejected_documents': 0, 'rejected_requests': 0}
+
+	@property
+	def port(self):
+		return self.server_address[1]
+
+	def start(self):
+		"""Serves from a background thread.
+
+		Returns:
+			BulkServer.
+		"""
+		thread = threading.Thread(target=self.serve_forever, name='BulkServer')
+		thread.daemon = True
+		thread.start()
+		return self
+
+	def stop(self):
+		self.shutdown()
+		self.server_close()
+
+def main():
+	parser = ArgumentParser(description = 'Serve a fake Elasticsearch _bulk endpoint.')
+	parser.add_argument('--port',
+		type = int,
+		default = 9200)
+	parser.add_argument('--latency',
+		type = float,
+		default = 0.0,
+		help = 'Mean seconds per request.')
+	parser.add_argument('--jitter',
+		type = float,
+		default = 0.0,
+		help = 'Standard deviation of the latency.')
+	parser.add_argument('--rejections',
+		type = float,
+		default = 0.0,
+		help = 'Probability of rejecting a document.')
+	parser.add_argument('--request-rejections',
+		type = float,
+		default = 0.0,
+		dest = 'request_rejections',
+		help = 'Probability of rejecting a whole request.')
+	args = parser.parse_args()
+
+	server = BulkServer(args.port, args.latency, 0.0, args.jitter, args.rejections, args.request_rejections)
+	print('Serving _bulk on 127.0.0.1:{:d}'.format(server.port))
+	try:
+		server.serve_forever()
+	except KeyboardInterrupt:
+		print(server.stats)
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,197 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""fixture.py: Synthetic dmoz shaped SQLite database.
+
+Same tables and relationships as the ones indexed by index.py: a tree of categories, with their external
+pages, alternative languages and news groups. Rows are generated from a seed, so the same arguments always
+build the same database.
+
+Run from the project root:
+	python -m benchmark.fixture dmoz.sqlite --categories 10000 --fan-out 5
+"""
+
+__author__      = "Ber Clausen"
+__copyright__   = "Copyright 2014, Planet Earth"
+
+import datetime
+import os
+import random
+import sqlite3
+from argparse import ArgumentParser
+
+
+# Source table, relationships and document map of index.py.
+SOURCE_TABLE = 'categories'
+RELATIONSHIPS = {
+	'one_to_many': {
+		'alternative_languages': {
+			'foreign_key': 'category_id'
+		},
+		'external_pages': {
+			'foreign_key': 'category_id'
+		},
+		'news_groups': {
+			'foreign_key': 'category_id'
+		}
+	},
+	'self_referential': {
+		'parent_category': {
+			'foreign_key': 'parent_id',
+			'backref': 'child_categories'
+		},
+	}
+}
+DOCUMENT_MAP = {
+	'alternative_languages': 'alternative_languages',
+	'categories': 'categories',
+	'external_pages': 'external_pages',
+	'news_groups': 'news_groups',
+	'parent_category': 'parent_category',
+}
+
+SCHEMA = """
+CREATE TABLE categories (
+	id INTEGER PRIMARY KEY,
+	parent_id INTEGER REFERENCES categories (id),
+	topic VARCHAR(255) NOT NULL,
+	title VARCHAR(255) NOT NULL,
+	description TEXT,
+	updated_at DATETIME NOT NULL
+);
+CREATE INDEX categories_parent_id ON categories (parent_id);
+CREATE TABLE external_pages (
+	id INTEGER PRIMARY KEY,
+	category_id INTEGER NOT NULL REFERENCES categories (id),
+	url VARCHAR(255) NOT NULL,
+	title VARCHAR(255) NOT NULL,
+	description TEXT,
+	priority INTEGER NOT NULL,
+	updated_at DATETIME NOT NULL
+);
+CREATE INDEX external_pages_category_id ON external_pages (category_id);
+CREATE TABLE alternative_languages (
+	id INTEGER PRIMARY KEY,
+	category_id INTEGER NOT NULL REFERENCES categories (id),
+	language VARCHAR(32) NOT NULL,
+	resource VARCHAR(255) NOT NULL,
+	updated_at DATETIME NOT NULL
+);
+CREATE INDEX alternative_languages_category_id ON alternative_languages (category_id);
+CREATE TABLE news_groups (
+	id INTEGER PRIMARY KEY,
+	category_id INTEGER NOT NULL REFERENCES categories (id),
+	name VARCHAR(255) NOT NULL,
+	updated_at DATETIME NOT NULL
+);
+CREATE INDEX news_groups_category_id ON news_groups (category_id);
+"""
+
+WORDS = ('arts', 'business', 'computers', 'games', 'health', 'home', 'news', 'recreation', 'reference',
+	'science', 'shopping', 'society', 'sports', 'movies', 'music', 'software', 'internet', 'history')
+LANGUAGES = ('Deutsch', 'Español', 'Français', 'Italiano', 'Japanese', 'Nederlands', 'Polska', 'Русский')
+
+
+def text(rand, words):
+	return ' '.join(rand.choice(WORDS) for _ in range(words))
+
+def count(rand, mean):
+	"""Skewed number of children around a mean: most rows have a few, some have many."""
+	return int(rand.expovariate(1.0 / mean)) if mean > 0 else 0
+
+def generate(path, categories=10000, fan_out=5.0, languages=0.5, news_groups=0.3, branching=8, seed=42):
+	"""Builds the database, replacing any previous file.
+
+	Args:
+		path (string): Database file.
+		categories (int): Number of categories.
+		fan_out (float): Mean number of external pages per category.
+		languages (float): Mean number of alternative languages per category.
+		news_groups (float): Mean number of news groups per category.
+		branching (int): Mean number of child categories per category, sets the depth of the tree.
+		seed (int): Random seed.
+
+	Returns:
+		Dict with the number of rows of every table.
+	"""
+	if os.path.exists(path):
+		os.remove(path)
+
+	rand = random.Random(seed)
+	connection = sqlite3.connect(path)
+	connection.executescript(SCHEMA)
+
+	updated_at = datetime.datetime(2014, 1, 1)
+	rows = {'categories': 0, 'external_pages': 0, 'alternative_languages': 0, 'news_groups': 0}
+	page_id = language_id = group_id = 0
+
+	for id in range(1, categories + 1):
+		# Parents always come first, so the tree has no cycles.
+		parent_id = rand.randint(max(1, (id - 1) // branching), id - 1) if id > 1 else None
+		title = text(rand, 2).title()
+		connection.execute('INSERT INTO categories VALUES (?, ?, ?, ?, ?, ?)',
+			(id, parent_id, 'Top/' + title.replace(' ', '/'), title, text(rand, 20), updated_at))
+		rows['categories'] += 1
+
+		for _ in range(count(rand, fan_out)):
+			page_id += 1
+			connection.execute('INSERT INTO external_pages VALUES (?, ?, ?, ?, ?, ?, ?)',
+				(page_id, id, 'http://example.com/{:d}'.format(page_id), text(rand, 4), text(rand, 30),
+				rand.randint(0, 2), updated_at))
+			rows['external_pages'] += 1
+
+		for _ in range(count(rand, languages)):
+			language_id += 1
+			connection.execute('INSERT INTO alternative_languages VALUES (?, ?, ?, ?, ?)',
+				(language_id, id, rand.choice(LANGUAGES).decode('utf-8'), 'Top/World/' + title, updated_at))
+			rows['alternative_languages'] += 1
+
+		for _ in range(count(rand, news_groups)):
+			group_id += 1
+			connection.execute('INSERT INTO news_groups VALUES (?, ?, ?, ?)',
+				(group_id, id, 'news:' + text(rand, 2).replace(' ', '.'), updated_at))
+			rows['news_groups'] += 1
+
+	connection.commit()
+	connection.close()
+
+	return rows
+
+def main():
+	parser = ArgumentParser(description = 'Generate a synthetic dmoz shaped SQLite database.')
+	parser.add_argument('path',
+		help = 'Database file, replaced if it exists.')
+	parser.add_argument('--categories',
+		type = int,
+		default = 10000,
+		help = 'Number of categories.')
+	parser.add_argument('--fan-out',
+		type = float,
+		default = 5.0,
+		dest = 'fan_out',
+		help = 'Mean number of external pages per category.')
+	parser.add_argument('--languages',
+		type = float,
+		default = 0.5,
+		help = 'Mean number of alternative languages per category.')
+	parser.add_argument('--news-groups',
+		type = float,
+		default = 0.3,
+		dest = 'news_groups',
+		help = 'Mean number of news groups per category.')
+	parser.add_argument('--branching',
+		type = int,
+		default = 8,
+		help = 'Mean number of child categories per category.')
+	parser.add_argument('--seed',
+		type = int,
+		default = 42,
+		help = 'Random seed.')
+	args = parser.parse_args()
+
+	rows = generate(args.path, args.categories, args.fan_out, args.languages, args.news_groups, args.branching, args.seed)
+	for table, number in sorted(rows.items()):
+		print('{:>24s} {:>10d}'.format(table, number))
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,194 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""replicas.py: Read replica balancing benchmark, against copies of a SQLite fixture and a local `_bulk` stand-in.
+
+Each replica is a copy of the fixture. The second one adds a fixed delay to every query, the third one fails
+every query for a while, then recovers. The indexer reads through a replica pool, which should route most
+chunks to the fast replicas, eject the failing one and bring it back once it recovers.
+
+Run from the project root:
+	python -m benchmark.replicas --replicas 3 --slow-latency 0.02 --failing-seconds 2
+"""
+
+__author__      = "Ber Clausen"
+__copyright__   = "Copyright 2014, Planet Earth"
+
+import os
+import shutil
+import sqlite3
+import time
+from argparse import ArgumentParser
+
+# SQLAlchemy
+import sqlalchemy
+
+# Db connectors
+from connectors import Core, SQLSoup
+from connectors.Replicas import ReplicaPool
+
+# Bulk sink
+from sinks.Elasticsearch import BulkSink
+
+# Indexer
+from indexer.Indexer import Indexer
+
+# Thread
+from utils.Thread import Thread
+
+# Benchmark
+from benchmark.bulk_server import BulkServer
+from benchmark.fixture import generate, SOURCE_TABLE, RELATIONSHIPS, DOCUMENT_MAP
+
+
+def degrade(engine, latency=0.0, failing_until=None):
+	"""Makes the queries of an engine slower, or failing.
+
+	Args:
+		engine (sqlalchemy.engine.Engine): Engine of a replica.
+		latency (float): Seconds added to every query.
+		failing_until (float): Time until which every query fails, None to never fail.
+	"""
+	def do_execute(cursor, statement, parameters, context):
+		if failing_until is not None and time.time() < failing_until:
+			raise sqlite3.OperationalError('replica down')
+		if latency:
+			time.sleep(latency)
+
+	sqlalchemy.event.listen(engine, 'do_execute', do_execute)
+
+def run(databases, port, connector, threads, read_chunk_size, slow_latency, failing_seconds, read_retries, limit):
+	"""Indexes the fixture once, reading from every replica.
+
+	Args:
+		databases (list): Replica database files.
+		port (int): Port of the `_bulk` stand-in.
+		connector (string): Db connector, 'core' or 'sqlsoup'.
+		threads (int): Number of indexing threads.
+		read_chunk_size (int): Number of ids read per query.
+		slow_latency (float): Seconds added to every query of the second replica.
+		failing_seconds (float): Seconds during which the third replica fails.
+		read_retries (int): Number of times a failed chunk is read again.
+		limit (int): Number of documents to index, None for all of them.
+
+	Returns:
+		Tuple with the indexing results and the replica statistics.
+	"""
+	DbConnector = Core.Connector if connector == 'core' else SQLSoup.Connector
+	read_queue = ReplicaPool(eject_seconds=0.5)
+
+	failing_until = time.time() + failing_seconds
+	for i, database in enumerate(databases):
+		for _ in range(threads):
+			db_connector = DbConnector((database, '', '', ''), engine='sqlite').build(SOURCE_TABLE, RELATIONSHIPS)
+			if i == 1:
+				degrade(db_connector._engine, latency=slow_latency)
+			elif i == 2:
+				degrade(db_connector._engine, failing_until=failing_until)
+			read_queue.add(db_connector, os.path.basename(database))
+			if i == 0:
+				# The id span is read from a healthy replica
+				first_connector = db_connector
+
+	sink = BulkSink([('http', '127.0.0.1', str(port))], 'benchmark', 'category', backoff=0.01)
+	indexer = Indexer(
+		db_connector=first_connector,
+		read_queue=read_queue,
+		es_connector=None,
+		es_index='benchmark',
+		es_type='category',
+		document_map=DOCUMENT_MAP,
+		limit=limit,
+		watch_threads=False,
+		sink=sink,
+		read_retries=read_retries)
+
+	start_time = time.time()
+
+	workers = [Thread(indexer.index, start_time, read_chunk_size=read_chunk_size, autostart=True) for _ in range(threads)]
+	for worker in workers:
+		worker.join()
+	failed = indexer.flush()
+
+	elapsed = time.time() - start_time
+	documents = indexer.index_count
+
+	return {
+		'documents': documents,
+		'failed': failed,
+		'seconds': elapsed,
+		'docs_per_second': documents / elapsed if elapsed else 0.0,
+	}, read_queue.stats()
+
+def main():
+	parser = ArgumentParser(description = 'Measure the read replica balancing against local stand-ins.')
+	parser.add_argument('--database',
+		default = 'benchmark.sqlite',
+		help = 'Fixture database, generated if missing.')
+	parser.add_argument('--categories',
+		type = int,
+		default = 10000,
+		help = 'Number of categories of a generated fixture.')
+	parser.add_argument('--connector',
+		choices = ['core', 'sqlsoup'],
+		default = 'core')
+	parser.add_argument('--replicas',
+		type = int,
+		default = 3,
+		help = 'Number of replicas, copies of the fixture.')
+	parser.add_argument('--threads',
+		type = int,
+		default = 4)
+	parser.add_argument('--chunk-size',
+		type = int,
+		default = 100,
+		dest = 'chunk_size',
+		help = 'Read chunk size.')
+	parser.add_argument('--slow-latency',
+		type = float,
+		default = 0.02,
+		dest = 'slow_latency',
+		help = 'Seconds added to every query of the second replica.')
+	parser.add_argument('--failing-seconds',
+		type = float,
+		default = 2.0,
+		dest = 'failing_seconds',
+		help = 'Seconds during which the third replica fails every query.')
+	parser.add_argument('--read-retries',
+		type = int,
+		default = 2,
+		dest = 'read_retries',
+		help = 'Number of times a failed chunk is read again.')
+	parser.add_argument('--limit',
+		type = int,
+		help = 'Number of documents to index.')
+	args = parser.parse_args()
+
+	if not os.path.exists(args.database):
+		print('Generating {:s}...'.format(args.database))
+		generate(args.database, args.categories)
+
+	databases = []
+	for i in range(args.replicas):
+		path = '{:s}.replica{:d}'.format(args.database, i + 1)
+		shutil.copyfile(args.database, path)
+		databases.append(path)
+
+	server = BulkServer().start()
+	try:
+		result, replicas = run(databases, server.port, args.connector, args.threads, args.chunk_size,
+			args.slow_latency, args.failing_seconds, args.read_retries, args.limit)
+	finally:
+		server.stop()
+		for path in databases:
+			os.remove(path)
+
+	print('{documents:d} documents in {seconds:.3f}s, {docs_per_second:.1f} docs/s, {failed:d} failed'.format(**result))
+	print('{:<28s} {:>8s} {:>10s} {:>8s} {:>12s} {:>10s}'.format(
+		'replica', 'chunks', 'queries', 'errors', 'latency (s)', 'ejections'))
+	for stats in replicas:
+		print('{name:<28s} {checkouts:>8d} {queries:>10d} {errors:>8d} {mean_latency:>12.4f} {ejections:>10d}'.format(
+			**stats))
+
+if __name__ == '__main__':
+	main()
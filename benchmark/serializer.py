@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""serializer.py: Micro-benchmark of the table serializers against the former per row schema path.
+
+Run from the project root:
+	python -m benchmark.serializer --columns 10 50 200 --rows 10000
+"""
+
+__author__      = "Ber Clausen"
+__copyright__   = "Copyright 2014, Planet Earth"
+
+import datetime
+import decimal
+import timeit
+from argparse import ArgumentParser
+
+# SQLAlchemy
+import sqlalchemy
+
+# Serializers
+from connectors.Serializer import Serializer
+
+
+class MappedRow(object):
+	"""Stand-in for a mapped model: the loaded values live in __dict__, the table in the class."""
+
+	_table = None
+
+	def __init__(self, values):
+		self.__dict__.update(values)
+
+
+def wide_table(columns):
+	"""Builds a table with the given number of columns, mixing the usual column types.
+
+	Args:
+		columns (int): Number of columns.
+
+	Returns:
+		sqlalchemy.Table.
+	"""
+	types = [sqlalchemy.Integer, sqlalchemy.String(255), sqlalchemy.DateTime, sqlalchemy.Numeric(10, 2)]
+	return sqlalchemy.Table('wide_{:d}'.format(columns), sqlalchemy.MetaData(),
+		sqlalchemy.Column('id', sqlalchemy.Integer, primary_key=True),
+		*[sqlalchemy.Column('column_{:d}'.format(i), types[i % len(types)]) for i in range(1, columns)])
+
+def sample_row(table, id):
+	"""Builds the values of a row.
+
+	Args:
+		table (sqlalchemy.Table): Table.
+		id (int): Row id.
+
+	Returns:
+		Tuple of values, in column order.
+	"""
+	values = []
+	for column in table.c:
+		if isinstance(column.type, sqlalchemy.DateTime):
+			values.append(datetime.datetime(2014, 1, 1, 12, 0, 0))
+		elif isinstance(column.type, sqlalchemy.Numeric):
+			values.append(decimal.Decimal('12.34'))
+		elif isinstance(column.type, sqlalchemy.String):
+			values.append('Top/Arts/Movies')
+		else:
+			values.append(id)
+	return tuple(values)
+
+def legacy_mapped_to_document(mapped_model):
+	"""Former Indexer.mapped_to_document path: schema built for every row."""
+	empty_schema = {k:None for k in mapped_model._table.c.keys()}
+	return {k:mapped_model.__dict__[k] for k in empty_schema}
+
+def measure(function, rows, repeat):
+	"""Best time of converting all the rows.
+
+	Args:
+		function: Conversion function.
+		rows (list): Rows to convert.
+		repeat (int): Number of repetitions.
+
+	Returns:
+		float, seconds.
+	"""
+	return min(timeit.Timer(lambda: [function(row) for row in rows]).repeat(repeat, 1))
+
+def main():
+	parser = ArgumentParser(description = 'Compare the table serializers with the former per row schema path.')
+	parser.add_argument('--columns',
+		type = int,
+		nargs = '+',
+		default = [10, 50, 200],
+		help = 'Number of columns of the benchmarked tables.')
+	parser.add_argument('--rows',
+		type = int,
+		default = 10000,
+		help = 'Number of rows converted per measure.')
+	parser.add_argument('--repeat',
+		type = int,
+		default = 3,
+		help = 'Number of measures, the best one is kept.')
+	args = parser.parse_args()
+
+	print('{:>8s} {:>12s} {:>12s} {:>12s} {:>12s}'.format('columns', 'legacy', 'mapped', 'mapped+conv', 'tuple+conv'))
+	for columns in args.columns:
+		table = wide_table(columns)
+		Row = type('Row', (MappedRow,), {'_table': table})
+		keys = table.c.keys()
+		tuples = [sample_row(table, id) for id in range(args.rows)]
+		mapped = [Row(zip(keys, values)) for values in tuples]
+
+		plain = Serializer(table, converters={})
+		converting = Serializer(table)
+
+		print('{:>8d} {:>11.4f}s {:>11.4f}s {:>11.4f}s {:>11.4f}s'.format(
+			columns,
+			measure(legacy_mapped_to_document, mapped, args.repeat),
+			measure(plain.from_mapped, mapped, args.repeat),
+			measure(converting.from_mapped, mapped, args.repeat),
+			measure(converting.from_tuple, tuples, args.repeat)))
+
+if __name__ == '__main__':
+	main()
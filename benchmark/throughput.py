@@ -0,0 +1,234 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""throughput.py: End to end indexing benchmark against a SQLite fixture and a local `_bulk` stand-in.
+
+Every combination of thread count and read chunk size runs in its own process, so the peak RSS of each one
+is measured apart. Results can be stored as a baseline, and later runs compared against it.
+
+Run from the project root:
+	python -m benchmark.throughput --threads 1 4 16 --chunk-sizes 10 100 --save-baseline baseline.json
+	python -m benchmark.throughput --threads 1 4 16 --chunk-sizes 10 100 --baseline baseline.json
+"""
+
+__author__      = "Ber Clausen"
+__copyright__   = "Copyright 2014, Planet Earth"
+
+import json
+import multiprocessing
+import os
+import resource
+import sys
+import time
+from argparse import ArgumentParser
+from Queue import Queue
+
+# Db connectors
+from connectors import Core, SQLSoup
+
+# Bulk sink
+from sinks.Elasticsearch import BulkSink
+
+# Indexer
+from indexer.Indexer import Indexer
+
+# Thread
+from utils.Thread import Thread
+
+# Metrics
+from utils.Metrics import metrics, instrument_sql
+
+# Benchmark
+from benchmark.bulk_server import BulkServer
+from benchmark.fixture import generate, SOURCE_TABLE, RELATIONSHIPS, DOCUMENT_MAP
+
+
+def run(database, port, connector, threads, read_chunk_size, bulk_requests, limit):
+	"""Indexes the fixture once.
+
+	Args:
+		database (string): Database file.
+		port (int): Port of the `_bulk` stand-in.
+		connector (string): Db connector, 'core' or 'sqlsoup'.
+		threads (int): Number of indexing threads.
+		read_chunk_size (int): Number of ids read per query.
+		bulk_requests (int): Number of concurrent `_bulk` requests.
+		limit (int): Number of documents to index, None for all of them.
+
+	Returns:
+		Dict with the results.
+	"""
+	instrument_sql()
+
+	DbConnector = Core.Connector if connector == 'core' else SQLSoup.Connector
+	read_queue = Queue()
+	for _ in range(threads):
+		db_connector = DbConnector((database, '', '', ''), engine='sqlite').build(SOURCE_TABLE, RELATIONSHIPS)
+		read_queue.put(db_connector)
+
+	sink = BulkSink([('http', '127.0.0.1', str(port))], 'benchmark', 'category',
+		concurrency=bulk_requests,
+		backoff=0.01)
+	indexer = Indexer(
+		db_connector=db_connector,
+		read_queue=read_queue,
+		es_connector=None,
+		es_index='benchmark',
+		es_type='category',
+		document_map=DOCUMENT_MAP,
+		limit=limit,
+		watch_threads=False,
+		sink=sink)
+
+	# Only the indexing is measured, not the reflection nor the id span.
+	metrics.reset()
+	start_time = time.time()
+
+	workers = [Thread(indexer.index, start_time, read_chunk_size=read_chunk_size, autostart=True) for _ in range(threads)]
+	for worker in workers:
+		worker.join()
+	failed = indexer.flush()
+
+	elapsed = time.time() - start_time
+	documents = indexer.index_count
+	timers = metrics.snapshot()['total']['timers']
+	queries = timers['sql_query']['count'] if 'sql_query' in timers else 0
+
+	return {
+		'threads': threads,
+		'read_chunk_size': read_chunk_size,
+		'documents': documents,
+		'failed': failed,
+		'seconds': round(elapsed, 3),
+		'docs_per_second': round(documents / elapsed, 1) if elapsed else 0.0,
+		'queries_per_doc': round(float(queries) / documents, 3) if documents else 0.0,
+		# Kilobytes on Linux
+		'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0, 1),
+	}
+
+def run_process(results, *args):
+	try:
+		results.put(run(*args))
+	except Exception, e:
+		results.put({'error': repr(e)})
+		raise
+
+def compare(results, baseline, tolerance):
+	"""Prints the throughput change of every run against the baseline.
+
+	Args:
+		results (list): Results of this benchmark.
+		baseline (dict): Results of the baseline by run key.
+		tolerance (float): Accepted throughput drop, as a fraction.
+
+	Returns:
+		int, number of regressions.
+	"""
+	regressions = 0
+	print('{:>8s} {:>8s} {:>12s} {:>12s} {:>8s}'.format('threads', 'chunk', 'baseline', 'docs/s', 'change'))
+	for result in results:
+		previous = baseline.get(key(result))
+		if previous is None or not previous['docs_per_second']:
+			continue
+		change = result['docs_per_second'] / previous['docs_per_second'] - 1
+		regressed = change < -tolerance
+		regressions += regressed
+		print('{:>8d} {:>8d} {:>12.1f} {:>12.1f} {:>+7.1%}{:s}'.format(result['threads'], result['read_chunk_size'],
+			previous['docs_per_second'], result['docs_per_second'], change, ' REGRESSION' if regressed else ''))
+	return regressions
+
+def key(result):
+	return '{:d}x{:d}'.format(result['threads'], result['read_chunk_size'])
+
+def main():
+	parser = ArgumentParser(description = 'Measure the indexing throughput against local stand-ins.')
+	parser.add_argument('--database',
+		default = 'benchmark.sqlite',
+		help = 'Fixture database, generated if missing.')
+	parser.add_argument('--categories',
+		type = int,
+		default = 10000,
+		help = 'Number of categories of a generated fixture.')
+	parser.add_argument('--fan-out',
+		type = float,
+		default = 5.0,
+		dest = 'fan_out',
+		help = 'Mean number of external pages per category of a generated fixture.')
+	parser.add_argument('--connector',
+		choices = ['core', 'sqlsoup'],
+		default = 'core')
+	parser.add_argument('--threads',
+		type = int,
+		nargs = '+',
+		default = [1, 4, 16])
+	parser.add_argument('--chunk-sizes',
+		type = int,
+		nargs = '+',
+		default = [10, 100],
+		dest = 'chunk_sizes',
+		help = 'Read chunk sizes.')
+	parser.add_argument('--bulk-requests',
+		type = int,
+		default = 4,
+		dest = 'bulk_requests',
+		help = 'Number of concurrent _bulk requests.')
+	parser.add_argument('--limit',
+		type = int,
+		help = 'Number of documents to index per run.')
+	parser.add_argument('--latency',
+		type = float,
+		default = 0.01,
+		help = 'Mean seconds per _bulk request.')
+	parser.add_argument('--rejections',
+		type = float,
+		default = 0.0,
+		help = 'Probability of rejecting a document.')
+	parser.add_argument('--baseline',
+		help = 'Baseline file to compare with.')
+	parser.add_argument('--save-baseline',
+		dest = 'save_baseline',
+		help = 'File where the results are stored as the new baseline.')
+	parser.add_argument('--tolerance',
+		type = float,
+		default = 0.1,
+		help = 'Accepted throughput drop against the baseline, as a fraction.')
+	args = parser.parse_args()
+
+	if not os.path.exists(args.database):
+		print('Generating {:s}...'.format(args.database))
+		generate(args.database, args.categories, args.fan_out)
+
+	server = BulkServer(latency=args.latency, rejections=args.rejections).start()
+
+	results = []
+	print('{:>8s} {:>8s} {:>10s} {:>10s} {:>12s} {:>12s} {:>10s} {:>8s}'.format(
+		'threads', 'chunk', 'documents', 'seconds', 'docs/s', 'queries/doc', 'RSS (MB)', 'failed'))
+	for threads in args.threads:
+		for read_chunk_size in args.chunk_sizes:
+			queue = multiprocessing.Queue()
+			process = multiprocessing.Process(target=run_process, args=(queue, args.database, server.port,
+				args.connector, threads, read_chunk_size, args.bulk_requests, args.limit))
+			process.start()
+			result = queue.get()
+			process.join()
+			if 'error' in result:
+				print('{:>8d} {:>8d} failed: {:s}'.format(threads, read_chunk_size, result['error']))
+				continue
+			results.append(result)
+			print('{threads:>8d} {read_chunk_size:>8d} {documents:>10d} {seconds:>10.3f} {docs_per_second:>12.1f} '
+				'{queries_per_doc:>12.3f} {peak_rss_mb:>10.1f} {failed:>8d}'.format(**result))
+
+	server.stop()
+
+	if args.save_baseline:
+		with open(args.save_baseline, 'w') as file:
+			json.dump(dict((key(result), result) for result in results), file, indent=1, sort_keys=True)
+
+	if args.baseline:
+		with open(args.baseline) as file:
+			baseline = json.load(file)
+		if compare(results, baseline, args.tolerance):
+			sys.exit(1)
+
+if __name__ == '__main__':
+	main()
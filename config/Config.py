@@ -9,6 +9,9 @@ __copyright__   = "Copyright 2014, Planet Earth"
 # from argparse import FileType
 from argparse import ArgumentParser
 
+# Errors
+from utils.errors import BadConfigError
+
 VERBOSE = 0
 
 
@@ -18,17 +21,73 @@ class Config:
 	Used to easy bootstrapping.
 	"""
 
+	connector = None
 	db_name = None
 	db_connections = None
 	db_queue_size = None
 	es_connections = None
 	es_index = None
 	es_type = None
+	id_source = None
+	incremental = None
+	watermark_column = None
+	watermark_file = None
+	watermark_overlap = None
+	resume = None
+	checkpoint_file = None
+	metrics_file = None
+	metrics_interval = None
+	rebuild = None
+	keep_versions = None
+	replicas = None
+	follow = None
+	change_log = None
+	install_change_log = None
+	purge_change_log = None
+	poll_interval = None
+	change_window = None
+	change_settle = None
+	id_window_size = None
+	id_split = None
+	id_split_parts = None
 	limit = None
+	pipeline = None
+	pipeline_readers = None
+	pipeline_builders = None
+	pipeline_writers = None
+	pipeline_queue_size = None
+	processes = None
 	read_chunk_size = None
 	single_process_mode = None
 	threads = None
 	autostart_threads = None
+	bulk_requests = None
+	bulk_bytes = None
+	min_bulk_bytes = None
+	max_bulk_bytes = None
+	bulk_latency = None
+	bulk_retries = None
+	bulk_backoff = None
+	sink = None
+	output_dir = None
+	compression = None
+	shard_bytes = None
+	shard_seconds = None
+	load = None
+	fingerprints = None
+	fingerprint_file = None
+	related_cache_entries = None
+	related_cache_bytes = None
+	related_cache_ttl = None
+	hierarchy = None
+	max_rss = None
+	schema_cache = None
+	read_retries = None
+	replica_max_errors = None
+	replica_eject_seconds = None
+	job_file = None
+	job_names = None
+	job_policy = None
 	verbose = None
 	write_chunk_size = None
 
@@ -72,6 +131,9 @@ class Config:
 			dest = 'db_connections',
 			type = file,
 			help = 'File where the MySQL database connections are defined.')
+		parser.add_argument('--connector',
+			choices = ['sqlsoup', 'core'],
+			help = 'Database connector: SQLSoup ORM, or streaming SQLAlchemy Core without mapped objects.')
 		parser.add_argument('-b', '--db-name',
 			dest = 'db_name',
 			help='MySQL database name.')
@@ -99,6 +161,29 @@ class Config:
 			type = int,
 			choices = range(1, 17),
 			help = 'Number of threads to deploy.')
+		parser.add_argument('-p', '--processes',
+			type = int,
+			help = 'Number of worker processes, each one indexing a disjoint id range.')
+		parser.add_argument('--pipeline',
+			action = 'store_true',
+			default = None,
+			help = 'Run reading, building and writing as separate stages connected by bounded queues.')
+		parser.add_argument('--pipeline-readers',
+			type = int,
+			dest = 'pipeline_readers',
+			help = 'Number of reader workers of the pipeline.')
+		parser.add_argument('--pipeline-builders',
+			type = int,
+			dest = 'pipeline_builders',
+			help = 'Number of builder workers of the pipeline.')
+		parser.add_argument('--pipeline-writers',
+			type = int,
+			dest = 'pipeline_writers',
+			help = 'Number of writer workers of the pipeline.')
+		parser.add_argument('--pipeline-queue-size',
+			type = int,
+			dest = 'pipeline_queue_size',
+			help = 'Maximum number of chunks waiting in front of each pipeline stage.')
 		parser.add_argument('-a', '--autostart-threads',
 			dest = 'autostart_threads',
 			action = 'store_true',
@@ -111,9 +196,199 @@ class Config:
 			type = int,
 			dest = 'write_chunk_size',
 			help = 'Size of the write chunk used when indexing the documents.')
+		parser.add_argument('--bulk-requests',
+			type = int,
+			dest = 'bulk_requests',
+			help = 'Number of concurrent _bulk requests kept in flight, 0 uses the pyes bulk indexing.')
+		parser.add_argument('--bulk-bytes',
+			type = int,
+			dest = 'bulk_bytes',
+			help = 'Initial target size in bytes of the _bulk requests, adapted while indexing.')
+		parser.add_argument('--min-bulk-bytes',
+			type = int,
+			dest = 'min_bulk_bytes',
+			help = 'Lower bound of the _bulk requests target size.')
+		parser.add_argument('--max-bulk-bytes',
+			type = int,
+			dest = 'max_bulk_bytes',
+			help = 'Upper bound of the _bulk requests target size.')
+		parser.add_argument('--bulk-latency',
+			type = float,
+			dest = 'bulk_latency',
+			help = 'Target seconds per _bulk request, slower requests shrink the target size.')
+		parser.add_argument('--bulk-retries',
+			type = int,
+			dest = 'bulk_retries',
+			help = 'Number of times a document rejected by a busy cluster is sent again.')
+		parser.add_argument('--bulk-backoff',
+			type = float,
+			dest = 'bulk_backoff',
+			help = 'Seconds to wait before the first retry, doubled on every retry.')
 		parser.add_argument('-l', '--limit',
 			type = int,
 			help = 'Limit the number of documents to index.')
+		parser.add_argument('--incremental',
+			action = 'store_true',
+			default = None,
+			help = 'Only index the rows changed since the last incremental run.')
+		parser.add_argument('--watermark-column',
+			dest = 'watermark_column',
+			help = 'Column holding the last change of the rows, used by the incremental runs.')
+		parser.add_argument('--watermark-file',
+			dest = 'watermark_file',
+			help = 'File where the high-water marks of the incremental runs are kept.')
+		parser.add_argument('--watermark-overlap',
+			type = float,
+			dest = 'watermark_overlap',
+			help = 'Seconds the changes of an incremental run start before the last high-water mark, so rows '
+				'committed late are not missed.')
+		parser.add_argument('--resume',
+			action = 'store_true',
+			default = None,
+			help = 'Skip the id ranges completed by the last interrupted run.')
+		parser.add_argument('--checkpoint-file',
+			dest = 'checkpoint_file',
+			help = 'File where the completed id ranges are kept, to resume interrupted runs.')
+		parser.add_argument('--metrics-file',
+			dest = 'metrics_file',
+			help = 'File where the stage metrics are written periodically, as JSON if it ends with .json, '
+				'as Prometheus text otherwise.')
+		parser.add_argument('--metrics-interval',
+			type = float,
+			dest = 'metrics_interval',
+			help = 'Seconds between writes of the metrics file.')
+		parser.add_argument('--rebuild',
+			action = 'store_true',
+			default = None,
+			help = 'Load a new timestamped version of the index, then move the index alias to it.')
+		parser.add_argument('--keep-versions',
+			type = int,
+			dest = 'keep_versions',
+			help = 'Number of index versions kept after a rebuild, including the one behind the alias.')
+		parser.add_argument('--replicas',
+			type = int,
+			help = 'Number of replicas of a rebuilt index, added once it is loaded.')
+		parser.add_argument('--follow',
+			action = 'store_true',
+			default = None,
+			help = 'Keep indexing the changes recorded in the change log table, until interrupted.')
+		parser.add_argument('--change-log',
+			dest = 'change_log',
+			help = 'Change log table filled by triggers, followed by --follow.')
+		parser.add_argument('--install-change-log',
+			action = 'store_true',
+			default = None,
+			dest = 'install_change_log',
+			help = 'Create the change log table and its triggers before following it.')
+		parser.add_argument('--purge-change-log',
+			action = 'store_true',
+			default = None,
+			dest = 'purge_change_log',
+			help = 'Delete the changes from the change log once indexed.')
+		parser.add_argument('--poll-interval',
+			type = float,
+			dest = 'poll_interval',
+			help = 'Seconds between polls of the change log while there are no changes.')
+		parser.add_argument('--change-window',
+			type = float,
+			dest = 'change_window',
+			help = 'Seconds during which the changes of a document are collapsed.')
+		parser.add_argument('--change-settle',
+			type = float,
+			dest = 'change_settle',
+			help = 'Seconds a missing change id is waited for, as transactions commit out of id order.')
+		parser.add_argument('--id-source',
+			dest = 'id_source',
+			choices = ['keyset', 'buffer'],
+			help = 'Source of the ids to index: keyset windows over the primary key, or a single buffered query.')
+		parser.add_argument('--id-window-size',
+			type = int,
+			dest = 'id_window_size',
+			help = 'Number of ids fetched per query by the keyset id source.')
+		parser.add_argument('--id-split',
+			dest = 'id_split',
+			choices = ['span', 'quantiles'],
+			help = 'Split of the ids scheduled to the threads: even primary key spans, or even numbers of rows.')
+		parser.add_argument('--id-split-parts',
+			type = int,
+			dest = 'id_split_parts',
+			help = 'Number of id ranges scheduled to the threads, idle threads steal halves of the busy ones.')
+		parser.add_argument('--sink',
+			choices = ['elasticsearch', 'file'],
+			help = 'Where the documents are written: Elasticsearch, or _bulk NDJSON shards loaded later with --load.')
+		parser.add_argument('--output-dir',
+			dest = 'output_dir',
+			help = 'Directory of the shards written by the file sink.')
+		parser.add_argument('--compression',
+			choices = ['gzip', 'zstd', 'none'],
+			help = 'Compression of the shards written by the file sink.')
+		parser.add_argument('--shard-bytes',
+			type = int,
+			dest = 'shard_bytes',
+			help = 'Maximum uncompressed size in bytes of the shards written by the file sink.')
+		parser.add_argument('--shard-seconds',
+			type = float,
+			dest = 'shard_seconds',
+			help = 'Age in seconds after which a shard is completed by a flush, so following the change log '
+				'does not write a shard per batch.')
+		parser.add_argument('--load',
+			metavar = 'DIR',
+			help = 'Load the shards of a directory into Elasticsearch instead of indexing the database.')
+		parser.add_argument('--fingerprints',
+			action = 'store_true',
+			default = None,
+			help = 'Skip the documents that did not change since they were last written to the index.')
+		parser.add_argument('--fingerprint-file',
+			dest = 'fingerprint_file',
+			help = 'File where the fingerprints of the written documents are kept.')
+		parser.add_argument('--job-file',
+			dest = 'job_file',
+			help = 'JSON file declaring the index jobs: source table, relationships, document map, index and type.')
+		parser.add_argument('--job',
+			action = 'append',
+			dest = 'job_names',
+			help = 'Job to run, may be repeated. The enabled jobs of the job file by default.')
+		parser.add_argument('--job-policy',
+			choices = ['fair', 'priority'],
+			dest = 'job_policy',
+			help = 'How the workers are shared by several jobs: by their weight, or by their priority first.')
+		parser.add_argument('--read-retries',
+			type = int,
+			dest = 'read_retries',
+			help = 'Number of times a chunk failing with a database error is read again, from another replica.')
+		parser.add_argument('--replica-max-errors',
+			type = int,
+			dest = 'replica_max_errors',
+			help = 'Consecutive failed queries ejecting a db replica from the read pool.')
+		parser.add_argument('--replica-eject-seconds',
+			type = float,
+			dest = 'replica_eject_seconds',
+			help = 'Seconds an ejected db replica waits before being probed, doubled on every failed probe.')
+		parser.add_argument('--schema-cache',
+			dest = 'schema_cache',
+			help = 'File where the reflected tables are cached, reflected again once the schema changes.')
+		parser.add_argument('--related-cache-entries',
+			type = int,
+			dest = 'related_cache_entries',
+			help = 'Number of many to one parents cached per process by the core connector, 0 disables the cache.')
+		parser.add_argument('--related-cache-bytes',
+			type = int,
+			dest = 'related_cache_bytes',
+			help = 'Bytes of many to one parents cached per process by the core connector, 0 for no limit.')
+		parser.add_argument('--related-cache-ttl',
+			type = float,
+			dest = 'related_cache_ttl',
+			help = 'Seconds a cached parent is kept, so followed changes are picked up.')
+		parser.add_argument('--max-rss',
+			type = int,
+			dest = 'max_rss',
+			help = 'Resident memory ceiling of each process in MB, once reached the sink is drained and the db '
+				'sessions and connections are recycled. 0 for no ceiling.')
+		parser.add_argument('--hierarchy',
+			action = 'store_true',
+			default = None,
+			help = 'Scan the parent ids of the self referential source table once, and add the ancestors, depth '
+				'and number of children to every document.')
 		#parser.add_argument('-i', '--input', nargs='?', type = FileType('r'), default = stdin)
 		#parser.add_argument('-o', '--output', nargs='?', type = FileType('w'), default = stdout)
 		return parser.parse_args()
@@ -144,6 +419,10 @@ class Config:
 		if args.es_type is not None:
 			self.es_type = args.es_type
 
+		# Database connector
+		if args.connector is not None:
+			self.connector = args.connector
+
 		# Database name
 		if args.db_name is not None:
 			self.db_name = args.db_name
@@ -172,6 +451,21 @@ class Config:
 		if args.autostart_threads is not None:
 			self.autostart_threads = args.autostart_threads
 
+		# Pipeline
+		if args.pipeline is not None:
+			self.pipeline = args.pipeline
+		for option in ['pipeline_readers', 'pipeline_builders', 'pipeline_writers', 'pipeline_queue_size']:
+			if getattr(args, option) is not None:
+				if getattr(args, option) < 1:
+					raise BadConfigError('The {:s} option must be positive.'.format(option))
+				setattr(self, option, getattr(args, option))
+
+		# Processes
+		if args.processes is not None:
+			if args.processes < 1:
+				raise BadConfigError('The number of processes must be positive.')
+			self.processes = args.processes
+
 		# Read buffer size
 		if args.read_chunk_size is not None:
 			self.read_chunk_size = args.read_chunk_size
@@ -180,10 +474,172 @@ class Config:
 		if args.write_chunk_size is not None:
 			self.write_chunk_size = args.write_chunk_size
 
+		# Concurrent bulk requests
+		if args.bulk_requests is not None:
+			if args.bulk_requests < 0:
+				raise BadConfigError('The number of bulk requests can not be negative.')
+			self.bulk_requests = args.bulk_requests
+
+		# Adaptive bulk sizing
+		for option in ['bulk_bytes', 'min_bulk_bytes', 'max_bulk_bytes', 'bulk_latency']:
+			if getattr(args, option) is not None:
+				if getattr(args, option) <= 0:
+					raise BadConfigError('The {:s} option must be positive.'.format(option))
+				setattr(self, option, getattr(args, option))
+
+		# Bulk retries
+		if args.bulk_retries is not None:
+			if args.bulk_retries < 0:
+				raise BadConfigError('The number of bulk retries can not be negative.')
+			self.bulk_retries = args.bulk_retries
+		if args.bulk_backoff is not None:
+			if args.bulk_backoff < 0:
+				raise BadConfigError('The bulk backoff can not be negative.')
+			self.bulk_backoff = args.bulk_backoff
+
 		# Documents limit
 		if args.limit is not None:
 			self.limit = args.limit
 
+		# Id source
+		if args.id_source is not None:
+			self.id_source = args.id_source
+		if args.id_window_size is not None:
+			self.id_window_size = args.id_window_size
+		if args.id_split is not None:
+			self.id_split = args.id_split
+		if args.id_split_parts is not None:
+			if args.id_split_parts < 1:
+				raise BadConfigError('The number of id ranges must be positive.')
+			self.id_split_parts = args.id_split_parts
+
+		# Incremental indexing
+		if args.incremental is not None:
+			self.incremental = args.incremental
+		if args.watermark_column is not None:
+			self.watermark_column = args.watermark_column
+		if args.watermark_file is not None:
+			self.watermark_file = args.watermark_file
+		if args.watermark_overlap is not None:
+			if args.watermark_overlap < 0:
+				raise BadConfigError('The watermark overlap can not be negative.')
+			self.watermark_overlap = args.watermark_overlap
+
+		# Sinks
+		for option in ['sink', 'output_dir', 'load']:
+			if getattr(args, option) is not None:
+				setattr(self, option, getattr(args, option))
+		if args.compression is not None:
+			self.compression = args.compression if args.compression != 'none' else None
+		if args.shard_bytes is not None:
+			if args.shard_bytes <= 0:
+				raise BadConfigError('The shard size must be positive.')
+			self.shard_bytes = args.shard_bytes
+		if args.shard_seconds is not None:
+			if args.shard_seconds < 0:
+				raise BadConfigError('The shard age can not be negative.')
+			self.shard_seconds = args.shard_seconds
+		if self.load:
+			if self.sink == 'file' or self.bulk_requests == 0:
+				raise BadConfigError('Loading shards needs the bulk sink.')
+			if self.incremental:
+				raise BadConfigError('Loading shards can not be incremental.')
+
+		# Checkpoints
+		if args.resume is not None:
+			self.resume = args.resume
+		if args.checkpoint_file is not None:
+			self.checkpoint_file = args.checkpoint_file
+		if self.resume and self.sink != 'file' and self.bulk_requests == 0:
+			raise BadConfigError('Resuming needs the bulk sink to checkpoint the acknowledged documents.')
+		if self.resume and self.incremental:
+			raise BadConfigError('Incremental runs can not be resumed, run them again instead.')
+
+		# Fingerprints
+		for option in ['fingerprints', 'fingerprint_file']:
+			if getattr(args, option) is not None:
+				setattr(self, option, getattr(args, option))
+		if self.fingerprints and (self.sink == 'file' or self.bulk_requests == 0):
+			raise BadConfigError('Fingerprints need the bulk sink, shards are always written whole.')
+
+		# Jobs
+		for option in ['job_file', 'job_names', 'job_policy']:
+			if getattr(args, option) is not None:
+				setattr(self, option, getattr(args, option))
+
+		# Replicas
+		if args.read_retries is not None:
+			if args.read_retries < 0:
+				raise BadConfigError('The number of read retries can not be negative.')
+			self.read_retries = args.read_retries
+		if args.replica_max_errors is not None:
+			if args.replica_max_errors < 1:
+				raise BadConfigError('Replicas need at least one error to be ejected.')
+			self.replica_max_errors = args.replica_max_errors
+		if args.replica_eject_seconds is not None:
+			if args.replica_eject_seconds <= 0:
+				raise BadConfigError('The replica ejection time must be positive.')
+			self.replica_eject_seconds = args.replica_eject_seconds
+
+		# Schema cache
+		if args.schema_cache is not None:
+			self.schema_cache = args.schema_cache
+
+		# Related cache
+		for option in ['related_cache_entries', 'related_cache_bytes', 'related_cache_ttl']:
+			if getattr(args, option) is not None:
+				if getattr(args, option) < 0:
+					raise BadConfigError('The {:s} option can not be negative.'.format(option))
+				setattr(self, option, getattr(args, option))
+		if (self.related_cache_entries or self.related_cache_bytes) and self.connector != 'core':
+			raise BadConfigError('The related cache needs the core connector.')
+
+		# Hierarchy
+		if args.hierarchy is not None:
+			self.hierarchy = args.hierarchy
+
+		# Memory ceiling
+		if args.max_rss is not None:
+			if args.max_rss < 0:
+				raise BadConfigError('The memory ceiling can not be negative.')
+			self.max_rss = args.max_rss
+
+		# Metrics
+		if args.metrics_file is not None:
+			self.metrics_file = args.metrics_file
+		if args.metrics_interval is not None:
+			if args.metrics_interval <= 0:
+				raise BadConfigError('The metrics interval must be positive.')
+			self.metrics_interval = args.metrics_interval
+
+		# Versioned rebuilds
+		for option in ['rebuild', 'keep_versions', 'replicas']:
+			if getattr(args, option) is not None:
+				setattr(self, option, getattr(args, option))
+		if self.keep_versions < 1:
+			raise BadConfigError('At least the version behind the alias must be kept.')
+		if self.replicas < 0:
+			raise BadConfigError('The number of replicas can not be negative.')
+		if self.rebuild and self.incremental:
+			raise BadConfigError('Rebuilds index every row, they can not be incremental.')
+		if self.rebuild and (self.sink == 'file' or self.load):
+			raise BadConfigError('Rebuilds write to a new index version, not to or from shards.')
+
+		# Change log following
+		for option in ['follow', 'change_log', 'install_change_log', 'purge_change_log']:
+			if getattr(args, option) is not None:
+				setattr(self, option, getattr(args, option))
+		for option in ['poll_interval', 'change_window', 'change_settle']:
+			if getattr(args, option) is not None:
+				if getattr(args, option) < 0:
+					raise BadConfigError('The {:s} option can not be negative.'.format(option))
+				setattr(self, option, getattr(args, option))
+		if self.follow:
+			if self.sink != 'file' and self.bulk_requests == 0:
+				raise BadConfigError('Following the change log needs the bulk sink.')
+			if self.processes > 1 or self.incremental or self.resume or self.rebuild or self.load or self.hierarchy:
+				raise BadConfigError('Following the change log runs in a single process, without batch options.')
+
 	def load(self, development=False):
 		if development:
 			config = {
@@ -196,13 +652,69 @@ class Config:
 				'db_connections': [
 					('127.0.0.1', 'elastico', 'elastico'),
 				],
+				'connector': 'sqlsoup',
 				'db_name': 'dmoz',
 				'db_queue_size': 4,
 				'single_process_mode': True,
 				'threads': 16,
+				'processes': 1,
+				'pipeline': False,
+				'pipeline_readers': 4,
+				'pipeline_builders': 2,
+				'pipeline_writers': 2,
+				'pipeline_queue_size': 8,
 				'read_chunk_size': 100,
 				'write_chunk_size': 1000,
+				'bulk_requests': 4,
+				'bulk_bytes': 5 * 1024 * 1024,
+				'min_bulk_bytes': 1024 * 1024,
+				'max_bulk_bytes': 20 * 1024 * 1024,
+				'bulk_latency': 1.0,
+				'bulk_retries': 5,
+				'bulk_backoff': 0.5,
+				'sink': 'elasticsearch',
+				'output_dir': 'shards',
+				'compression': 'gzip',
+				'shard_bytes': 256 * 1024 * 1024,
+				'shard_seconds': 60.0,
+				'load': None,
+				'fingerprints': False,
+				'fingerprint_file': 'fingerprints.sqlite',
+				'related_cache_entries': 0,
+				'related_cache_bytes': 0,
+				'related_cache_ttl': None,
+				'hierarchy': False,
+				'max_rss': 0,
+				'schema_cache': None,
+				'read_retries': 2,
+				'replica_max_errors': 3,
+				'replica_eject_seconds': 5.0,
+				'job_file': 'jobs.json',
+				'job_names': None,
+				'job_policy': 'fair',
 				'limit': 2000,
+				'id_source': 'keyset',
+				'id_window_size': 10000,
+				'id_split': 'span',
+				'id_split_parts': 64,
+				'incremental': False,
+				'watermark_column': 'updated_at',
+				'watermark_file': 'watermarks.json',
+				'watermark_overlap': 60.0,
+				'resume': False,
+				'checkpoint_file': 'checkpoints.sqlite',
+				'metrics_file': None,
+				'metrics_interval': 10.0,
+				'rebuild': False,
+				'keep_versions': 2,
+				'replicas': 1,
+				'follow': False,
+				'change_log': 'change_log',
+				'install_change_log': False,
+				'purge_change_log': False,
+				'poll_interval': 1.0,
+				'change_window': 0.5,
+				'change_settle': 5.0,
 			}
 		else:
 			config = {
@@ -215,12 +727,68 @@ class Config:
 				'db_connections': [
 					('127.0.0.1', 'elastico', 'elastico'),
 				],
+				'connector': 'sqlsoup',
 				'db_name': 'dmoz',
 				'db_queue_size': 4,
 				'threads': 16,
+				'processes': 1,
+				'pipeline': False,
+				'pipeline_readers': 4,
+				'pipeline_builders': 2,
+				'pipeline_writers': 2,
+				'pipeline_queue_size': 8,
 				'read_chunk_size': 100,
 				'write_chunk_size': 1000,
+				'bulk_requests': 4,
+				'bulk_bytes': 5 * 1024 * 1024,
+				'min_bulk_bytes': 1024 * 1024,
+				'max_bulk_bytes': 20 * 1024 * 1024,
+				'bulk_latency': 1.0,
+				'bulk_retries': 5,
+				'bulk_backoff': 0.5,
+				'sink': 'elasticsearch',
+				'output_dir': 'shards',
+				'compression': 'gzip',
+				'shard_bytes': 256 * 1024 * 1024,
+				'shard_seconds': 60.0,
+				'load': None,
+				'fingerprints': False,
+				'fingerprint_file': 'fingerprints.sqlite',
+				'related_cache_entries': 0,
+				'related_cache_bytes': 0,
+				'related_cache_ttl': None,
+				'hierarchy': False,
+				'max_rss': 0,
+				'schema_cache': None,
+				'read_retries': 2,
+				'replica_max_errors': 3,
+				'replica_eject_seconds': 5.0,
+				'job_file': 'jobs.json',
+				'job_names': None,
+				'job_policy': 'fair',
 				'limit': None,
+				'id_source': 'keyset',
+				'id_window_size': 10000,
+				'id_split': 'span',
+				'id_split_parts': 64,
+				'incremental': False,
+				'watermark_column': 'updated_at',
+				'watermark_file': 'watermarks.json',
+				'watermark_overlap': 60.0,
+				'resume': False,
+				'checkpoint_file': 'checkpoints.sqlite',
+				'metrics_file': None,
+				'metrics_interval': 10.0,
+				'rebuild': False,
+				'keep_versions': 2,
+				'replicas': 1,
+				'follow': False,
+				'change_log': 'change_log',
+				'install_change_log': False,
+				'purge_change_log': False,
+				'poll_interval': 1.0,
+				'change_window': 0.5,
+				'change_settle': 5.0,
 			}
 
 		return config
@@ -257,11 +825,64 @@ class Config:
 		process_mode = 'Single process' if self.single_process_mode else 'Multi threaded'
 		vprint('Process mode: {:s}'.format(process_mode))
 
-		if not self.single_process_mode:
+		if self.processes > 1:
+			vprint('Processes: {:d}'.format(self.processes))
+
+		if self.pipeline:
+			vprint('Pipeline: {:d} readers, {:d} builders, {:d} writers'.format(
+				self.pipeline_readers, self.pipeline_builders, self.pipeline_writers))
+		elif not self.single_process_mode:
 			vprint('Threads: {:d}'.format(self.threads))
 
 		vprint('Index: {:s}'.format(self.es_index))
 		vprint('Type: {:s}'.format(self.es_type))
+		vprint('DB connector: {:s}'.format(self.connector))
 		vprint('DB Queue size: {:d}'.format(self.db_queue_size))
+		vprint('DB replicas: ejected after {:d} errors for {:.1f}s, {:d} read retries'.format(
+			self.replica_max_errors, self.replica_eject_seconds, self.read_retries))
 		vprint('Read chunk size: {:d}'.format(self.read_chunk_size))
 		vprint('Write chunk size: {:d}'.format(self.write_chunk_size))
+		if self.sink == 'file':
+			vprint('Sink: {:s} ({:s}, {:d} bytes or {:.0f}s per shard)'.format(self.output_dir,
+				self.compression or 'uncompressed', self.shard_bytes, self.shard_seconds))
+		else:
+			vprint('Bulk requests: {:d}'.format(self.bulk_requests))
+			vprint('Bulk bytes: {:d} ({:d}-{:d})'.format(self.bulk_bytes, self.min_bulk_bytes, self.max_bulk_bytes))
+		if self.load:
+			vprint('Loading: {:s}'.format(self.load))
+		vprint('Id source: {:s}'.format('incremental' if self.incremental else self.id_source))
+		if self.incremental:
+			vprint('Watermark overlap: {:.1f}s'.format(self.watermark_overlap))
+		vprint('Id split: {:d} ranges by {:s}'.format(self.id_split_parts, self.id_split))
+
+		if self.resume:
+			vprint('Resuming from: {:s}'.format(self.checkpoint_file))
+
+		if self.fingerprints:
+			vprint('Fingerprints: {:s}'.format(self.fingerprint_file))
+
+		if self.hierarchy:
+			vprint('Hierarchy: scanned before indexing')
+
+		vprint('Jobs: {:s} from {:s}, {:s} policy'.format(
+			', '.join(self.job_names) if self.job_names else 'enabled ones', self.job_file, self.job_policy))
+
+		if self.schema_cache:
+			vprint('Schema cache: {:s}'.format(self.schema_cache))
+
+		if self.max_rss:
+			vprint('Memory ceiling: {:d}MB per process'.format(self.max_rss))
+
+		if self.related_cache_entries or self.related_cache_bytes:
+			vprint('Related cache: {:d} entries, {:d} bytes (0 for no limit)'.format(
+				self.related_cache_entries, self.related_cache_bytes))
+
+		if self.metrics_file:
+			vprint('Metrics: {:s} every {:.1f}s'.format(self.metrics_file, self.metrics_interval))
+
+		if self.rebuild:
+			vprint('Rebuild: keeping {:d} versions, {:d} replicas'.format(self.keep_versions, self.replicas))
+
+		if self.follow:
+			vprint('Following: {:s} (poll {:.2f}s, window {:.2f}s, settle {:.2f}s)'.format(self.change_log,
+				self.poll_interval, self.change_window, self.change_settle))
@@ -0,0 +1,186 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Job.py: Index jobs, declared in a JSON job file."""
+
+__author__      = "Ber Clausen"
+__copyright__   = "Copyright 2014, Planet Earth"
+
+import copy
+import json
+
+# Errors
+from utils.errors import BadConfigError
+
+
+# Relationship kinds, as understood by the connectors.
+RELATIONSHIP_KINDS = ['one_to_many', 'one_to_one', 'many_to_one', 'many_to_many', 'self_referential']
+
+# Configuration options a job may set for itself.
+JOB_OPTIONS = ['limit', 'read_chunk_size', 'id_source', 'id_window_size', 'id_split', 'id_split_parts', 'hierarchy']
+
+
+class Job(object):
+	"""Job class.
+
+	An index job: a source table, its relationships and document map, and the index and type its documents
+	are written to. Jobs are declared in a JSON job file:
+
+	{
+		"jobs": [
+			{
+				"name": "categories",
+				"source_table": "categories",
+				"relationships": {"one_to_many": {"news_groups": {"foreign_key": "category_id"}}},
+				"document_map": {"categories": "categories", "news_groups": "news_groups"},
+				"es_index": "dmoz",
+				"es_type": "category",
+				"weight": 2,
+				"priority": 0,
+				"options": {"hierarchy": true}
+			}
+		]
+	}
+
+	Only the name and the source table are required. The index and type default to the configured ones, and
+	the options override the configuration for the job only (see JOB_OPTIONS). Jobs with "enabled": false only
+	run when selected by name.
+
+	Attributes:
+		name (string): Job name.
+		source_table (string): Source table name.
+		relationships (dict): Relationships of the source table, by kind.
+		document_map (dict): Dict used for mapping the models to the document structure.
+		es_index (string): Elasticsearch index, None for the configured one.
+		es_type (string): Elasticsearch type, None for the configured one.
+		weight (float): Share of the workers when running along other jobs.
+		priority (int): Jobs of higher priority go first under the priority policy.
+		options (dict): Configuration overrides.
+		enabled (bool): Whether the job runs when no job is selected by name.
+	"""
+
+	def __init__(self, name, source_table,
+		relationships=None,
+		document_map=None,
+		es_index=None,
+		es_type=None,
+		weight=1,
+		priority=0,
+		options=None,
+		enabled=True):
+		"""Initialization.
+
+		Args:
+			name (string): Job name.
+			source_table (string): Source table name.
+			relationships (dict): Relationships of the source table, by kind.
+			document_map (dict): Dict used for mapping the models to the document structure, None to map the
+				source table only.
+			es_index (string): Elasticsearch index, None for the configured one.
+			es_type (string): Elasticsearch type, None for the configured one.
+			weight (float): Share of the workers when running along other jobs.
+			priority (int): Jobs of higher priority go first under the priority policy.
+			options (dict): Configuration overrides.
+			enabled (bool): Whether the job runs when no job is selected by name.
+		"""
+		if not name or not source_table:
+			raise BadConfigError('Jobs need a name and a source table.')
+
+		relationships = relationships or {}
+		for kind in relationships:
+			if kind not in RELATIONSHIP_KINDS:
+				raise BadConfigError('Unknown relationship kind in the {:s} job: {:s}.'.format(name, kind))
+		for kind, definitions in relationships.iteritems():
+			for relationship_name, relationship in definitions.iteritems():
+				if 'foreign_key' not in relationship:
+					raise BadConfigError('The {:s} relationship of the {:s} job needs a foreign key.'.format(
+						relationship_name, name))
+
+		options = options or {}
+		for option in options:
+			if option not in JOB_OPTIONS:
+				raise BadConfigError('The {:s} option can not be set by the {:s} job.'.format(option, name))
+
+		if weight <= 0:
+			raise BadConfigError('The weight of the {:s} job must be positive.'.format(name))
+
+		self.name = name
+		self.source_table = source_table
+		self.relationships = dict((kind, relationships.get(kind, {})) for kind in RELATIONSHIP_KINDS)
+		self.document_map = document_map or {}
+		self.es_index = es_index
+		self.es_type = es_type
+		self.weight = weight
+		self.priority = priority
+		self.options = options
+		self.enabled = enabled
+
+	def configure(self, config):
+		"""Configuration of the job.
+
+		Args:
+			config (Config): Configuration.
+
+		Returns:
+			Config, a copy with the index, type and options of the job.
+		"""
+		config = copy.copy(config)
+		if self.es_index is not None:
+			config.es_index = self.es_index
+		if self.es_type is not None:
+			config.es_type = self.es_type
+		for option, value in self.options.iteritems():
+			setattr(config, option, value)
+		return config
+
+
+def byte_strings(object):
+	"""JSON object hook, turns the unicode keys and strings into byte strings, as table names are."""
+	def encode(value):
+		if isinstance(value, unicode):
+			return value.encode('utf-8')
+		if isinstance(value, list):
+			return [encode(item) for item in value]
+		return value
+
+	return dict((encode(key), encode(value)) for key, value in object.iteritems())
+
+def load_jobs(path, names=None):
+	"""Loads the jobs of a job file.
+
+	Args:
+		path (string): Job file.
+		names (list): Names of the jobs to run, None for the enabled ones.
+
+	Returns:
+		List of Job, in file order.
+	"""
+	try:
+		with open(path) as file:
+			definitions = json.load(file, object_hook=byte_strings)['jobs']
+	except (IOError, ValueError, KeyError, TypeError), e:
+		raise BadConfigError('Can not read the job file {:s}: {!s}.'.format(path, e))
+
+	jobs = []
+	for definition in definitions:
+		try:
+			jobs.append(Job(**definition))
+		except TypeError, e:
+			raise BadConfigError('Bad job definition in {:s}: {!s}.'.format(path, e))
+
+	known = [job.name for job in jobs]
+	if len(set(known)) != len(known):
+		raise BadConfigError('Job names must be unique in {:s}.'.format(path))
+
+	if names:
+		for name in names:
+			if name not in known:
+				raise BadConfigError('No job named {:s} in {:s}.'.format(name, path))
+		jobs = [job for job in jobs if job.name in names]
+	else:
+		jobs = [job for job in jobs if job.enabled]
+
+	if not jobs:
+		raise BadConfigError('No job to run in {:s}.'.format(path))
+
+	return jobs
@@ -1 +1 @@
-__all__ = ["Config"]
+__all__ = ["Config", "Job"]
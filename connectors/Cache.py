@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Cache.py: Bounded LRU cache of related subdocuments, shared by the connectors of a process."""
+
+__author__      = "Ber Clausen"
+__copyright__   = "Copyright 2014, Planet Earth"
+
+import json
+import time
+from collections import OrderedDict
+
+# Threading
+import threading
+
+# Errors
+from utils.errors import BadConfigError
+
+# Metrics
+from utils.Metrics import metrics
+
+
+class LRUCache(object):
+	"""LRUCache class.
+
+	Keeps the serialized related subdocuments by (table, id), so a parent shared by many source rows is only
+	queried once per process. Entries are evicted least recently used first, once there are more than
+	`max_entries` or they take more than `max_bytes` (measured as JSON). With a `ttl`, older entries are
+	queried again, so followed changes are picked up.
+
+	Cached documents are shared by every document embedding them, and must not be modified.
+
+	Attributes:
+		max_entries (int): Maximum number of entries, None for no limit.
+		max_bytes (int): Maximum size of the entries, None for no limit.
+		ttl (float): Seconds an entry is kept, None to keep it until evicted.
+		stats (dict): Hits, misses, evictions and expirations.
+	"""
+
+	def __init__(self, max_entries=None, max_bytes=None, ttl=None):
+		"""Initialization.
+
+		Args:
+			max_entries (int): Maximum number of entries, None for no limit.
+			max_bytes (int): Maximum size of the entries, None for no limit.
+			ttl (float): Seconds an entry is kept, None to keep it until evicted.
+		"""
+		if not max_entries and not max_bytes:
+			raise BadConfigError('The cache must be bounded by entries or bytes.')
+		if ttl is not None and ttl <= 0:
+			raise BadConfigError('The cache TTL must be positive.')
+
+		self.max_entries = max_entries or None
+		self.max_bytes = max_bytes or None
+		self.ttl = ttl
+
+		self._lock = threading.Lock()
+		# (value, size, expiration) by key, least recently used first
+		self._entries = OrderedDict()
+		self._bytes = 0
+
+		self.stats = {
+			'hits': 0,
+			'misses': 0,
+			'evictions': 0,
+			'expirations': 0,
+		}
+
+	def __len__(self):
+		return len(self._entries)
+
+	@property
+	def bytes(self):
+		"""Size of the entries."""
+		return self._bytes
+
+	def get_many(self, keys):
+		"""Looks up some keys, marking the found ones as recently used.
+
+		Args:
+			keys (list): Keys.
+
+		Returns:
+			Dict with the value of every key found.
+		"""
+		found = {}
+		expired = 0
+		now = time.time() if self.ttl is not None else None
+		with self._lock:
+			entries = self._entries
+			for key in keys:
+				entry = entries.pop(key, None)
+				if entry is None:
+					continue
+				if now is not None and entry[2] < now:
+					self._bytes -= entry[1]
+					expired += 1
+					continue
+				entries[key] = entry
+				found[key] = entry[0]
+
+			self.stats['hits'] += len(found)
+			self.stats['misses'] += len(keys) - len(found)
+			self.stats['expirations'] += expired
+
+		metrics.add('related_cache_hits', len(found))
+		metrics.add('related_cache_misses', len(keys) - len(found))
+
+		return found
+
+	def put_many(self, items):
+		"""Stores some values, evicting the least recently used ones beyond the bounds.
+
+		Args:
+			items (dict): Values by key, plain documents.
+		"""
+		# Measured outside the lock
+		sizes = dict((key, len(json.dumps(value))) for key, value in items.iteritems()) if self.max_bytes else {}
+		expiration = time.time() + self.ttl if self.ttl is not None else None
+
+		evicted = 0
+		with self._lock:
+			entries = self._entries
+			for key, value in items.iteritems():
+				previous = entries.pop(key, None)
+				if previous is not None:
+					self._bytes -= previous[1]
+				size = sizes.get(key, 0)
+				entries[key] = (value, size, expiration)
+				self._bytes += size
+
+			while entries and ((self.max_entries is not None and len(entries) > self.max_entries) or
+				(self.max_bytes is not None and self._bytes > self.max_bytes)):
+				key, entry = entries.popitem(last=False)
+				self._bytes -= entry[1]
+				evicted += 1
+
+			self.stats['evictions'] += evicted
+
+		metrics.add('related_cache_evictions', evicted)
+
+	def clear(self):
+		with self._lock:
+			self._entries.clear()
+			self._bytes = 0
@@ -0,0 +1,352 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Core.py: Streaming database connector using SQLAlchemy Core."""
+
+__author__      = "Ber Clausen"
+__copyright__   = "Copyright 2014, Planet Earth"
+
+from collections import namedtuple
+
+# Errors
+from utils.errors import (
+	BadConfigError,
+	ConnectorError
+)
+
+# SQLAlchemy
+import sqlalchemy
+
+# Serializers
+from Serializer import Serializer
+
+
+# Source row and its related rows, all of them plain dicts.
+Record = namedtuple('Record', ['id', 'row', 'related'])
+
+
+class Connector(object):
+	"""Database connector.
+
+	Used as the MySQL repository connector when no ORM is wanted.
+
+	Rows are streamed as plain tuples through server-side cursors (SSCursor with MySQLdb), and the source rows
+	and their related rows are assembled into dicts without creating mapped objects or sessions. Each
+	relationship costs one query per chunk.
+
+	Only the relationships declared in `build` are resolved, backrefs are not.
+
+	The parents of many to one and self referential relationships can be kept in a cache shared by the
+	connectors of the process, so each one is only queried once. Likewise, the tables can be reflected into a
+	schema shared by the connectors of the process, so each one is only reflected once.
+	"""
+
+	_cache = None
+	_engine = None
+	_metadata = None
+	_model = None
+	_relationships = None
+	_schema = None
+	_serializers = None
+	_table = None
+	_url = None
+
+	fetch_size = 1000
+
+	def __init__(self, connection, engine='mysql', session=None, db_charset='utf8', cache=None, schema=None):
+		"""Conenctor initialization.
+
+		Args:
+			connection (tuple): Database name, hostname, username and password.
+			engine (string): Database engine, 'sqlite' to use the database name as a local file.
+			session: Unused, kept for compatibility with the SQLSoup connector.
+			db_charset (string): DB connection character set.
+			cache (Cache.LRUCache): Cache of the related parents by (table, id), None to query them every time.
+			schema (Schema.Schema): Schema the tables are reflected into, None to reflect them per connector.
+		"""
+		try:
+			name, hostname, username, password = connection
+		except ValueError:
+			raise BadConfigError
+
+		if engine == 'sqlite':
+			# Local stand-in, the name is the database file
+			self._url = 'sqlite:///{:s}'.format(name)
+		else:
+			self._url = '{:s}://{:s}:{:s}@{:s}/{:s}'.format(engine, username, password, hostname, name)
+		self._relationships = []
+		self._serializers = {}
+		self._cache = cache
+		self._schema = schema
+		self.db(db_charset)
+
+	@staticmethod
+	def table_name(model):
+		if not isinstance(model, sqlalchemy.Table):
+			raise ConnectorError('No model found.')
+
+		return model.fullname
+
+	def db(self, db_charset='utf8'):
+		"""Construct the engine and metadata used to access the database.
+
+		Args:
+			db_charset (string): DB connection character set.
+
+		Returns:
+			Connector.
+		"""
+		if self._url is None:
+			raise BadConfigError('No engine URL configured.')
+
+		url = self._url if self._url.startswith('sqlite') else '%s?charset=%s' % (self._url, db_charset)
+		if self._schema is not None:
+			self._engine = self._schema.engine(url)
+			self._metadata = self._schema.bind(self._engine)
+		else:
+			self._engine = sqlalchemy.create_engine(url)
+			self._metadata = sqlalchemy.MetaData(bind=self._engine)
+
+		return self
+
+	def model(self, table_name):
+		"""Gets a reflected table.
+
+		Args:
+			table_name (string): Table name.
+
+		Returns:
+			sqlalchemy.Table.
+		"""
+		if self._metadata is None:
+			raise BadConfigError('No database connector configured.')
+
+		try:
+			if self._schema is not None:
+				return self._schema.table(table_name)
+			return sqlalchemy.Table(table_name, self._metadata, autoload=True)
+		except sqlalchemy.exc.NoSuchTableError:
+			raise ConnectorError('No table found: {:s}.'.format(table_name))
+
+	def column(self, table, column_name):
+		"""Gets a column from a table.
+
+		Args:
+			table (sqlalchemy.Table): Table.
+			column_name (string): Column name.
+
+		Returns:
+			sqlalchemy.Column.
+		"""
+		if column_name not in table.c:
+			raise BadConfigError('No column {:s} found in {:s}.'.format(column_name, table.fullname))
+
+		return table.c[column_name]
+
+	def stream(self, query):
+		"""Streams the rows of a query as tuples.
+
+		The query runs on a server-side cursor, rows are fetched in blocks of `fetch_size`.
+
+		Args:
+			query: SQLAlchemy Core selectable.
+
+		Returns:
+			Generator of tuples.
+		"""
+		result = self._engine.execution_options(stream_results=True).execute(query)
+		try:
+			while True:
+				rows = result.fetchmany(self.fetch_size)
+				if not rows:
+					break
+				for row in rows:
+					yield tuple(row)
+		finally:
+			result.close()
+
+	def build(self, source_table, relationships=False):
+		"""Prepares the queries for the source table and its relationships.
+
+		Compiles the serializers of the source and related tables.
+
+		Args:
+			source_table (string): Source table name.
+			relationships (dict): Tables that should be binded to the source table, same format as the
+				SQLSoup connector.
+
+		Returns:
+			Connector.
+		"""
+		self._model = source_model = self.model(source_table)
+		self._table = source_table
+		self._relationships = []
+		self.serializer(source_model)
+
+		if relationships is False:
+			return self
+
+		for kind in ['one_to_many', 'one_to_one', 'many_to_one', 'many_to_many', 'self_referential']:
+			for relationship_name, relationship in relationships.get(kind, {}).iteritems():
+				relationship_table = relationship['table'] if 'table' in relationship else relationship_name
+
+				if kind == 'self_referential':
+					related_model = source_model
+				else:
+					related_model = self.model(relationship_table)
+
+				self.serializer(related_model)
+
+				if kind in ['one_to_many', 'one_to_one']:
+					foreign_key = self.column(related_model, relationship['foreign_key'])
+				elif kind == 'many_to_many':
+					secondary_model = self.model(relationship['secondary'])
+					foreign_key = self.column(secondary_model, relationship['foreign_key'])
+					self.column(secondary_model, relationship['secondary_foreign_key'])
+				else:
+					foreign_key = self.column(source_model, relationship['foreign_key'])
+
+				# Same attribute names as the SQLSoup connector: many to one relationships are reached
+				# through the backref named after the related table.
+				attribute_name = relationship_table if kind == 'many_to_one' else relationship_name
+
+				# Position of the key column in the rows holding it.
+				key_index = list(foreign_key.table.c.keys()).index(foreign_key.key)
+
+				self._relationships.append((kind, attribute_name, related_model, foreign_key, key_index, relationship))
+
+		return self
+
+	def release(self):
+		"""Nothing is kept between chunks, rows are plain tuples and dicts."""
+		pass
+
+	def recycle(self):
+		"""Closes the pooled connections, they are opened again when needed."""
+		self._engine.dispose()
+
+	def serializer(self, table):
+		"""Gets the serializer of a table, compiling it the first time.
+
+		Args:
+			table (sqlalchemy.Table): Table.
+
+		Returns:
+			Serializer.
+		"""
+		table_name = table.fullname
+		if table_name not in self._serializers:
+			self._serializers[table_name] = Serializer(table)
+
+		return self._serializers[table_name]
+
+	def query(self, ids):
+		"""Query the source rows with the given ids, and their related rows.
+
+		Args:
+			ids (list): Ids of the source table.
+
+		Returns:
+			List of Record.
+		"""
+		source_model = self._model
+		serializer = self.serializer(source_model)
+		id_index = serializer.keys.index('id')
+
+		rows = list(self.stream(sqlalchemy.select([source_model]).where(source_model.c.id.in_(ids))))
+
+		related = {}
+		for kind, attribute_name, related_model, foreign_key, key_index, relationship in self._relationships:
+			related[attribute_name] = self.related(kind, related_model, foreign_key, key_index, relationship, ids, rows)
+
+		records = []
+		for row in rows:
+			row_id = row[id_index]
+			record_related = {}
+			for kind, attribute_name, related_model, foreign_key, key_index, relationship in self._relationships:
+				if kind in ['one_to_many', 'many_to_many']:
+					record_related[attribute_name] = related[attribute_name].get(row_id, [])
+				elif kind == 'one_to_one':
+					record_related[attribute_name] = related[attribute_name].get(row_id)
+				else:
+					record_related[attribute_name] = related[attribute_name].get(row[key_index])
+			records.append(Record(row_id, serializer.from_tuple(row), record_related))
+
+		return records
+
+	def related(self, kind, related_model, foreign_key, key_index, relationship, ids, rows):
+		"""Loads the related rows of a relationship for a set of source rows, with a single query.
+
+		Args:
+			kind (string): Relationship kind.
+			related_model (sqlalchemy.Table): Related table.
+			foreign_key (sqlalchemy.Column): Foreign key column.
+			key_index (int): Position of the foreign key in the rows holding it.
+			relationship (dict): Relationship definition.
+			ids (list): Ids of the source rows.
+			rows (list): Source rows.
+
+		Returns:
+			Dict of related documents (or lists of them for *_many relationships) by source id or foreign key
+			value.
+		"""
+		serializer = self.serializer(related_model)
+		related = {}
+
+		if kind in ['one_to_many', 'one_to_one']:
+			query = sqlalchemy.select([related_model]).where(foreign_key.in_(ids))
+			for row in self.stream(query):
+				document = serializer.from_tuple(row)
+				if kind == 'one_to_one':
+					related.setdefault(row[key_index], document)
+				else:
+					related.setdefault(row[key_index], []).append(document)
+
+		elif kind == 'many_to_many':
+			secondary_model = foreign_key.table
+			secondary_foreign_key = secondary_model.c[relationship['secondary_foreign_key']]
+			query = sqlalchemy.select([foreign_key, related_model]).select_from(
+				related_model.join(secondary_model, related_model.c.id == secondary_foreign_key)
+			).where(foreign_key.in_(ids))
+			for row in self.stream(query):
+				related.setdefault(row[0], []).append(serializer.from_tuple(row[1:]))
+
+		else:
+			keys = set(row[key_index] for row in rows if row[key_index] is not None)
+			table_name = related_model.fullname
+
+			if keys and self._cache is not None:
+				cached = self._cache.get_many([(table_name, key) for key in keys])
+				for (_, key), document in cached.iteritems():
+					related[key] = document
+				keys.difference_update(related)
+
+			if keys:
+				id_index = serializer.keys.index('id')
+				query = sqlalchemy.select([related_model]).where(related_model.c.id.in_(list(keys)))
+				loaded = {}
+				for row in self.stream(query):
+					related[row[id_index]] = loaded[(table_name, row[id_index])] = serializer.from_tuple(row)
+				if self._cache is not None:
+					self._cache.put_many(loaded)
+
+		return related
+
+	def map(self, record, mapping):
+		"""Builds a dict containing the mapping structure.
+
+		Args:
+			record (Record): Source row and its related rows.
+			mapping (dict): Dict used for mapping the tables to the document structure.
+
+		Returns:
+			Dictionary containing the mapping structure.
+		"""
+		model_mapping = {}
+		for model_alias, table_name in mapping.iteritems():
+			if model_alias == self._table:
+				model_mapping[model_alias] = record.row
+				continue
+			model_mapping[model_alias] = record.related.get(table_name)
+
+		return model_mapping
@@ -0,0 +1,318 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Replicas.py: Pool of db connectors balanced by the latency and errors of their replicas."""
+
+__author__      = "Ber Clausen"
+__copyright__   = "Copyright 2014, Planet Earth"
+
+import time
+import weakref
+from collections import OrderedDict
+from Queue import Queue
+
+# Threading
+import threading
+
+# SQLAlchemy
+import sqlalchemy
+
+# Errors
+from utils.errors import BadConfigError
+
+# Utility functions
+from utils.utils import vprint
+
+
+# Checkout of the current thread: the pool and replica its queries are measured for.
+_checkout = threading.local()
+
+# Engines measured, listened to once per process whatever the number of pools sharing them.
+_engines = weakref.WeakSet()
+_engines_lock = threading.Lock()
+
+
+def listen(engine):
+	"""Measures the queries of an engine, for the replica checked out by the thread running them.
+
+	Queries run outside a checkout, like the id sources ones, are not measured.
+
+	Args:
+		engine (sqlalchemy.engine.Engine): Engine of a replica.
+	"""
+	with _engines_lock:
+		if engine in _engines:
+			return
+		_engines.add(engine)
+
+	def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+		if getattr(_checkout, 'pool', None) is not None:
+			context._replica_start = time.time()
+
+	def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+		pool = getattr(_checkout, 'pool', None)
+		start = getattr(context, '_replica_start', None)
+		if pool is not None and start is not None:
+			pool.succeeded(_checkout.replica, time.time() - start)
+
+	def handle_error(context):
+		pool = getattr(_checkout, 'pool', None)
+		if pool is not None:
+			pool.failed(_checkout.replica, context.original_exception)
+
+	sqlalchemy.event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+	sqlalchemy.event.listen(engine, 'after_cursor_execute', after_cursor_execute)
+	sqlalchemy.event.listen(engine, 'handle_error', handle_error)
+
+
+class Replica(object):
+	"""Database replica, the host a group of db connectors reads from.
+
+	Attributes:
+		name (string): Replica name.
+		connectors (int): Number of db connectors.
+		in_flight (int): Db connectors checked out.
+		checkouts (int): Number of checkouts, one per chunk read.
+		queries (int): Number of queries.
+		query_time (float): Seconds spent in queries.
+		latency (float): Smoothed seconds per query, None before the first one.
+		errors (int): Number of failed queries.
+		failures (int): Consecutive failed queries.
+		failed_at (float): Time of the last failed query.
+		ejections (int): Number of times the replica was ejected.
+		ejected_until (float): Time the replica can be probed again, None while healthy.
+		eject_seconds (float): Seconds of the next ejection, doubled on every failed probe.
+		probing (bool): Whether a db connector is checked out to probe the replica.
+	"""
+
+	def __init__(self, name, eject_seconds):
+		self.name = name
+		self.connectors = 0
+		self.in_flight = 0
+		self.checkouts = 0
+		self.queries = 0
+		self.query_time = 0.0
+		self.latency = None
+		self.errors = 0
+		self.failures = 0
+		self.failed_at = None
+		self.ejections = 0
+		self.ejected_until = None
+		self.eject_seconds = eject_seconds
+		self.probing = False
+
+	def available(self, now):
+		"""Whether a chunk can be read from the replica: it is healthy, or its ejection is over and nobody is
+		probing it yet."""
+		if self.ejected_until is None:
+			return True
+		return now >= self.ejected_until and not self.probing
+
+	def load(self, now):
+		"""Ranks the replicas for a new chunk: an ejected replica due for a probe goes first, the ones that
+		failed within their ejection time last, the others by expected seconds per query, the smoothed latency
+		times the queries in flight and the new one. Replicas without measures go before, so they get measured."""
+		if self.ejected_until is not None:
+			return -1, 0.0
+		failing = self.failures if self.failures and now - self.failed_at < self.eject_seconds else 0
+		return failing, (self.in_flight + 1) * (self.latency or 0.0)
+
+
+class ReplicaPool(Queue):
+	"""ReplicaPool class.
+
+	Drop-in replacement of the read queue of db connectors. Instead of handing them out in round robin, every
+	chunk gets an idle connector of the healthy replica with the lowest load, its smoothed query latency times
+	its queries in flight, so a lagging or overloaded replica gets less work. A replica whose last queries
+	failed is only used once the others are busy, so a chunk read again after an error goes elsewhere.
+
+	Latency and errors are measured per replica with SQLAlchemy engine events, whatever the connector. Only
+	the queries of a thread holding a connector of the pool count, for the replica of that connector, so the
+	pools of several jobs can share their engines.
+
+	After `max_errors` consecutive failed queries a replica is ejected for `eject_seconds`. Once that time is
+	over, the next chunk probes it: a successful query brings it back, a failed one ejects it again for twice
+	as long, up to `max_eject_seconds`. While every replica is ejected, all of them are used, rather than
+	stalling.
+
+	Attributes:
+		max_errors (int): Consecutive failed queries ejecting a replica.
+		eject_seconds (float): Seconds of the first ejection.
+		max_eject_seconds (float): Maximum seconds of an ejection.
+		smoothing (float): Weight of the latest query in the smoothed latency.
+		replicas (OrderedDict): Replica by name.
+	"""
+
+	max_errors = 3
+	eject_seconds = 5.0
+	max_eject_seconds = 300.0
+	smoothing = 0.2
+
+	def __init__(self, max_errors=None, eject_seconds=None, max_eject_seconds=None):
+		"""Initialization.
+
+		Args:
+			max_errors (int): Consecutive failed queries ejecting a replica.
+			eject_seconds (float): Seconds of the first ejection.
+			max_eject_seconds (float): Maximum seconds of an ejection.
+		"""
+		if max_errors is not None:
+			if max_errors < 1:
+				raise BadConfigError('Replicas need at least one error to be ejected.')
+			self.max_errors = max_errors
+		if eject_seconds is not None:
+			if eject_seconds <= 0:
+				raise BadConfigError('The replica ejection time must be positive.')
+			self.eject_seconds = eject_seconds
+		if max_eject_seconds is not None:
+			self.max_eject_seconds = max_eject_seconds
+
+		self._start_time = time.time()
+
+		Queue.__init__(self)
+
+	# Queue implementation, called holding the mutex
+
+	def _init(self, maxsize):
+		self.queue = []
+		self.replicas = OrderedDict()
+		# Replica of each db connector, and checkout start time, by connector id
+		self._replica_of = {}
+		self._checkouts = {}
+
+	def _qsize(self, len=len):
+		return len(self.usable())
+
+	def _put(self, db_connector):
+		key = id(db_connector)
+		replica = self._replica_of[key]
+		if key in self._checkouts:
+			del self._checkouts[key]
+			replica.in_flight -= 1
+			replica.probing = False
+			if getattr(_checkout, 'replica', None) is replica:
+				_checkout.pool = _checkout.replica = None
+		self.queue.append(db_connector)
+
+	def _get(self):
+		now = time.time()
+		db_connector = min(self.usable(), key=lambda connector: self._replica_of[id(connector)].load(now))
+		self.queue.remove(db_connector)
+
+		replica = self._replica_of[id(db_connector)]
+		replica.in_flight += 1
+		replica.checkouts += 1
+		if replica.ejected_until is not None:
+			replica.probing = True
+		self._checkouts[id(db_connector)] = time.time()
+		_checkout.pool = self
+		_checkout.replica = replica
+
+		return db_connector
+
+	def usable(self):
+		"""Idle db connectors of the available replicas, of every replica if none is healthy.
+
+		Returns:
+			List of db connectors.
+		"""
+		now = time.time()
+		if not any(replica.ejected_until is None for replica in self.replicas.itervalues()):
+			return self.queue
+		return [connector for connector in self.queue if self._replica_of[id(connector)].available(now)]
+
+	# Replicas
+
+	def add(self, db_connector, name):
+		"""Adds an idle db connector.
+
+		Args:
+			db_connector: Db connector, either connector kind.
+			name (string): Name of its replica, the db connectors of a replica share it.
+
+		Returns:
+			ReplicaPool.
+		"""
+		with self.mutex:
+			replica = self.replicas.get(name)
+			if replica is None:
+				replica = self.replicas[name] = Replica(name, self.eject_seconds)
+			replica.connectors += 1
+			self._replica_of[id(db_connector)] = replica
+
+		listen(db_connector._engine)
+		self.put(db_connector)
+		return self
+
+	def succeeded(self, replica, latency):
+		"""Accounts a successful query, bringing the replica back if it was probed.
+
+		Args:
+			replica (Replica): Replica.
+			latency (float): Seconds.
+		"""
+		with self.mutex:
+			replica.queries += 1
+			replica.query_time += latency
+			if replica.latency is None:
+				replica.latency = latency
+			else:
+				replica.latency += self.smoothing * (latency - replica.latency)
+			replica.failures = 0
+
+			if replica.ejected_until is not None:
+				replica.ejected_until = None
+				replica.eject_seconds = self.eject_seconds
+				replica.probing = False
+				vprint('Replica {:s} is back.'.format(replica.name))
+				self.not_empty.notify_all()
+
+	def failed(self, replica, error):
+		"""Accounts a failed query, ejecting the replica after too many of them, or a failed probe.
+
+		Args:
+			replica (Replica): Replica.
+			error (Exception): Error.
+		"""
+		with self.mutex:
+			replica.errors += 1
+			replica.failures += 1
+			replica.failed_at = time.time()
+
+			if replica.probing or (replica.ejected_until is None and replica.failures >= self.max_errors):
+				if replica.probing:
+					replica.eject_seconds = min(replica.eject_seconds * 2, self.max_eject_seconds)
+					replica.probing = False
+				replica.ejected_until = time.time() + replica.eject_seconds
+				replica.ejections += 1
+				vprint('Replica {:s} ejected for {:.1f}s: {!s}'.format(replica.name, replica.eject_seconds, error))
+
+	def stats(self):
+		"""Statistics of every replica.
+
+		Returns:
+			List of dicts.
+		"""
+		with self.mutex:
+			elapsed = max(time.time() - self._start_time, 1e-6)
+			return [{
+				'name': replica.name,
+				'connectors': replica.connectors,
+				'checkouts': replica.checkouts,
+				'queries': replica.queries,
+				'errors': replica.errors,
+				'ejections': replica.ejections,
+				'ejected': replica.ejected_until is not None,
+				'mean_latency': replica.query_time / replica.queries if replica.queries else 0.0,
+				'latency': replica.latency or 0.0,
+				'chunks_per_second': replica.checkouts / elapsed,
+				'queries_per_second': replica.queries / elapsed,
+			} for replica in self.replicas.itervalues()]
+
+	def report(self):
+		"""Prints the throughput of every replica."""
+		for stats in self.stats():
+			vprint('Replica {name:s}: {connectors:d} connectors, {checkouts:d} chunks ({chunks_per_second:.1f}/s), '
+				'{queries:d} queries ({queries_per_second:.1f}/s), mean latency {mean_latency:.4f}s, '
+				'{errors:d} errors, {ejections:d} ejections{ejected_note:s}'.format(
+					ejected_note=', ejected' if stats['ejected'] else '', **stats))
@@ -17,10 +17,14 @@ from utils.errors import (
 # SQLAlchemy
 import sqlalchemy
 import sqlalchemy.ext.declarative
+import sqlalchemy.orm
 
 # SQLSoup
 import sqlsoup
 
+# Serializers
+from Serializer import Serializer
+
 
 class Connector(object):
 	"""Database connector.
@@ -29,18 +33,48 @@ class Connector(object):
 	"""
 
 	_db = None
+	_engine = None
+	_loader_options = None
 	_model = None
+	_schema = None
+	_serializers = None
 	_table = None
 	_url = None
 
-	def __init__(self, connection, engine='mysql', session=True, db_charset='utf8'):
-		"""Conenctor initialization."""
+	# Loading strategies available for the relationships.
+	# http://docs.sqlalchemy.org/en/latest/orm/loading_relationships.html
+	loaders = {
+		'selectin': sqlalchemy.orm.selectinload,
+		'subquery': sqlalchemy.orm.subqueryload,
+		'joined': sqlalchemy.orm.joinedload,
+		'lazy': None,
+	}
+	default_loader = 'selectin'
+
+	def __init__(self, connection, engine='mysql', session=True, db_charset='utf8', schema=None):
+		"""Conenctor initialization.
+
+		Args:
+			connection (tuple): Database name, hostname, username and password.
+			engine (string): Database engine, 'sqlite' to use the database name as a local file.
+			session (mixed): Session registry to use for the connector, see Connector.db.
+			db_charset (string): DB connection character set.
+			schema (Schema.Schema): Schema the tables are reflected into, None to reflect them per connector.
+				Mapped classes and relationships are still built per connector, as they hold its session.
+		"""
 		try:
 			name, hostname, username, password = connection
 		except ValueError:
 			raise BadConfigError
 
-		self._url = '{:s}://{:s}:{:s}@{:s}/{:s}'.format(engine, username, password, hostname, name)
+		if engine == 'sqlite':
+			# Local stand-in, the name is the database file
+			self._url = 'sqlite:///{:s}'.format(name)
+		else:
+			self._url = '{:s}://{:s}:{:s}@{:s}/{:s}'.format(engine, username, password, hostname, name)
+		self._loader_options = []
+		self._serializers = {}
+		self._schema = schema
 		self.db(session, db_charset)
 
 	@staticmethod
@@ -128,6 +162,64 @@ class Connector(object):
 
 		return model_mapping
 
+	def serializer(self, table):
+		"""Gets the serializer of a table, compiling it the first time.
+
+		Args:
+			table (sqlalchemy.Table): Table.
+
+		Returns:
+			Serializer.
+		"""
+		table_name = table.fullname
+		if table_name not in self._serializers:
+			self._serializers[table_name] = Serializer(table)
+
+		return self._serializers[table_name]
+
+	def serialize(self, mapped_model):
+		"""Converts a mapped model into a document.
+
+		Args:
+			mapped_model: Mapped model.
+
+		Returns:
+			Dict.
+		"""
+		return self.serializer(mapped_model._table).from_mapped(mapped_model)
+
+	def query(self, ids):
+		"""Query the source model rows with the given ids.
+
+		The declared relationships are loaded for the whole set of rows, using one query per relationship
+		(see Connector.loader), so the number of queries does not depend on the number of ids.
+
+		Args:
+			ids (list): Ids of the source model.
+
+		Returns:
+			Query of mapped models.
+		"""
+		model = self._model
+		return model.filter(model.id.in_(ids)).options(*self._loader_options)
+
+	def loader(self, attribute_name, relationship):
+		"""Registers the loader option for a relationship of the source model.
+
+		The strategy is read from the 'loading' key of the relationship dict: 'selectin' (default), 'subquery',
+		'joined' or 'lazy' (one query per row and relationship).
+
+		Args:
+			attribute_name (string): Relationship attribute of the source model.
+			relationship (dict): Relationship definition.
+		"""
+		strategy = relationship['loading'] if 'loading' in relationship else self.default_loader
+		if strategy not in self.loaders:
+			raise BadConfigError('Unknown loading strategy: {:s}.'.format(strategy))
+
+		if self.loaders[strategy] is not None:
+			self._loader_options.append(self.loaders[strategy](attribute_name))
+
 	def model(self, table_name):
 		"""Gets a Mapped object based on an existing table.
 
@@ -140,6 +232,10 @@ class Connector(object):
 		if not self.is_database(self._db):
 			raise BadConfigError('No database connector configured.')
 
+		# Reflected once in the shared schema, found there by SQLSoup
+		if self._schema is not None:
+			self._schema.table(table_name)
+
 		return self._db.entity(table_name)
 
 	def db(self, session=True, db_charset='utf8'):
@@ -148,7 +244,8 @@ class Connector(object):
 		Note: Using session with autocommit=True is better when working with threads, and avoids calling Soup.session.commit()
 		http://forum.griffith.cc/index.php?topic=1082.0
 
-		Creates one session per db object.
+		Creates one session per db object. The custom session registry is bound to the connector engine, as the
+		metadata may be shared with other connectors.
 
 		Args:
 			session (mixed): Session registry to use for the connector.
@@ -163,12 +260,18 @@ class Connector(object):
 		if self._url is None:
 			raise BadConfigError('No engine URL configured.')
 
-		engine = '%s?charset=%s' % (self._url, db_charset)
+		url = self._url if self._url.startswith('sqlite') else '%s?charset=%s' % (self._url, db_charset)
+		if self._schema is not None:
+			self._engine = self._schema.engine(url)
+			metadata = self._schema.bind(self._engine)
+		else:
+			self._engine = sqlalchemy.create_engine(url)
+			metadata = sqlalchemy.MetaData(bind=self._engine)
 
 		if session is True:
 			session = self.session()
 
-		self._db = sqlsoup.SQLSoup(engine, session=session)
+		self._db = sqlsoup.SQLSoup(metadata, session=session)
 
 		return self
 
@@ -183,21 +286,38 @@ class Connector(object):
 		# 	expire_on_commit=True,
 		# 	autocommit=False))
 		return sqlsoup.scoped_session(sqlsoup.sessionmaker(
+			bind=self._engine,
 			autoflush=False,
 			expire_on_commit=False,
 			autocommit=True))
 
+	def release(self):
+		"""Closes the session of the current thread, once its chunk is read.
+
+		The identity map keeps every instance loaded through the session, so without this the instances of
+		every chunk read by the thread stay alive. The instances already read keep their loaded attributes
+		and relationships, detached, so their documents can still be built.
+		"""
+		self._db.session.remove()
+
+	def recycle(self):
+		"""Closes the session and the pooled connections, they are opened again when needed."""
+		self._db.session.remove()
+		self._engine.dispose()
+
 	def build(self, source_table, relationships=False):
 		"""Returns the constructed model.
 
 		Set an object parameter with the connector used to construct it.
-		Bind relationships.
+		Bind relationships, and register how they are loaded (see Connector.loader).
+		Compile the serializers of the source and related models.
 
 		http://docs.sqlalchemy.org/en/latest/orm/relationships.html#adjacency-list-relationships
 
 		Args:
 			source_table (string): Source table name.
-			relationships (dict): Models that should be binded to the source model.
+			relationships (dict): Models that should be binded to the source model. Each relationship may set its
+				loading strategy with the 'loading' key.
 
 		Returns:
 			sqlsoup.TableClassType object.
@@ -207,6 +327,7 @@ class Connector(object):
 		"""
 		self._model = source_model = self.model(source_table)
 		self._table = source_table
+		self.serializer(source_model._table)
 
 		if relationships is False:
 			return self
@@ -215,6 +336,7 @@ class Connector(object):
 			for relationship_name, relationship in relationships['one_to_many'].iteritems():
 				relationship_table = relationship['table'] if 'table' in relationship else relationship_name
 				related_model = self.model(relationship_table)
+				self.serializer(related_model._table)
 				foreign_key = self.field(related_model, relationship['foreign_key'])
 
 				source_model.relate(
@@ -223,11 +345,13 @@ class Connector(object):
 					foreign_keys=foreign_key,
 					primaryjoin=(source_model.id == foreign_key),
 					backref=source_table)
+				self.loader(relationship_name, relationship)
 
 		if 'one_to_one' in relationships:
 			for relationship_name, relationship in relationships['one_to_one'].iteritems():
 				relationship_table = relationship['table'] if 'table' in relationship else relationship_name
 				related_model = self.model(relationship_table)
+				self.serializer(related_model._table)
 				foreign_key = self.field(related_model, relationship['foreign_key'])
 
 				source_model.relate(
@@ -237,11 +361,13 @@ class Connector(object):
 					foreign_keys=foreign_key,
 					primaryjoin=(source_model.id == foreign_key),
 					backref=source_table)
+				self.loader(relationship_name, relationship)
 
 		if 'many_to_one' in relationships:
 			for relationship_name, relationship in relationships['many_to_one'].iteritems():
 				relationship_table = relationship['table'] if 'table' in relationship else relationship_name
 				related_model = self.model(relationship_table)
+				self.serializer(related_model._table)
 				foreign_key = self.field(source_model, relationship['foreign_key'])
 
 				related_model.relate(
@@ -250,12 +376,15 @@ class Connector(object):
 					foreign_keys=foreign_key,
 					primaryjoin=(related_model.id == foreign_key),
 					backref=relationship_table)
+				# The source model reaches the related model through the backref.
+				self.loader(relationship_table, relationship)
 
 		if 'many_to_many' in relationships:
 			Base = sqlalchemy.ext.declarative.declarative_base()
 			for relationship_name, relationship in relationships['many_to_many'].iteritems():
 				relationship_table = relationship['table'] if 'table' in relationship else relationship_name
 				related_model = self.model(relationship_table)
+				self.serializer(related_model._table)
 
 				secondary_table = sqlalchemy.Table(relationship['secondary'], Base.metadata,
 					sqlalchemy.Column(relationship['foreign_key'], sqlalchemy.Integer, sqlalchemy.ForeignKey(source_model.id)),
@@ -267,6 +396,7 @@ class Connector(object):
 					related_model,
 					secondary=secondary_table,
 					backref=source_table)
+				self.loader(relationship_name, relationship)
 
 		if 'self_referential' in relationships:
 			for relationship_name, relationship in relationships['self_referential'].iteritems():
@@ -280,5 +410,6 @@ class Connector(object):
 					primaryjoin=(source_model.id == foreign_key),
 					remote_side=source_model.id,
 					backref=backref)
+				self.loader(relationship_name, relationship)
 
 		return self
@@ -0,0 +1,220 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Schema.py: Reflected tables shared by the connectors of a process, optionally cached in a file."""
+
+__author__      = "Ber Clausen"
+__copyright__   = "Copyright 2014, Planet Earth"
+
+import os
+import hashlib
+import cPickle as pickle
+
+# Threading
+import threading
+
+# SQLAlchemy
+import sqlalchemy
+
+# Errors
+from utils.errors import BadConfigError
+
+# Utility functions
+from utils.utils import vprint
+
+
+# Connections kept open by each engine, the SQLAlchemy default, the others up to the maximum are opened on
+# demand.
+POOL_SIZE = 5
+
+# Queries describing the schema of the current database, by engine.
+FINGERPRINT_QUERIES = {
+	'mysql': [
+		'SELECT table_name, column_name, column_type, is_nullable, column_default, column_key, extra '
+			'FROM information_schema.columns WHERE table_schema = DATABASE() '
+			'ORDER BY table_name, ordinal_position',
+		'SELECT table_name, constraint_name, column_name, referenced_table_name, referenced_column_name '
+			'FROM information_schema.key_column_usage WHERE table_schema = DATABASE() '
+			'ORDER BY table_name, constraint_name, ordinal_position',
+		'SELECT table_name, index_name, non_unique, column_name '
+			'FROM information_schema.statistics WHERE table_schema = DATABASE() '
+			'ORDER BY table_name, index_name, seq_in_index',
+	],
+	'sqlite': [
+		'SELECT type, name, tbl_name, sql FROM sqlite_master ORDER BY type, name',
+	],
+}
+
+
+def fingerprint(engine):
+	"""Digest of the schema of a database, read from its catalog with a few queries.
+
+	The SQLAlchemy version is part of it, as the cached tables are pickled.
+
+	Args:
+		engine (sqlalchemy.engine.Engine): Engine.
+
+	Returns:
+		string, None if the engine is not supported.
+	"""
+	if engine.dialect.name not in FINGERPRINT_QUERIES:
+		return None
+
+	digest = hashlib.sha1(sqlalchemy.__version__)
+	for query in FINGERPRINT_QUERIES[engine.dialect.name]:
+		for row in engine.execute(sqlalchemy.text(query)):
+			digest.update(repr(tuple(row)))
+			digest.update('\n')
+
+	return digest.hexdigest()
+
+
+class Schema(object):
+	"""Schema class.
+
+	Holds the metadata every connector of a process reflects its tables into, so each table is reflected once
+	instead of once per connector. The metadata is bound to the engine of the first connector. The engines are
+	shared too, one per database URL, so the connectors of every job of the process share their connection
+	pools, bounded by `max_connections`.
+
+	With a cache file, the reflected tables are stored along with the fingerprint of the schema, and loaded
+	back by later runs while the fingerprint does not change, so reflection is skipped altogether.
+
+	Attributes:
+		cache_file (string): Path of the cache file, None to reflect on every run.
+		max_connections (int): Maximum number of connections of each engine, None for the SQLAlchemy default.
+		metadata (sqlalchemy.MetaData): Shared metadata, None until bound.
+		stats (dict): Tables reflected, and loaded from the cache file.
+	"""
+
+	def __init__(self, cache_file=None, max_connections=None):
+		"""Initialization.
+
+		Args:
+			cache_file (string): Path of the cache file, None to reflect on every run.
+			max_connections (int): Maximum number of connections of each engine, None for the SQLAlchemy
+				default.
+		"""
+		if max_connections is not None and max_connections < 1:
+			raise BadConfigError('Engines need at least one connection.')
+
+		self.cache_file = cache_file
+		self.max_connections = max_connections
+		self.metadata = None
+
+		self._lock = threading.RLock()
+		self._engines = {}
+		self._fingerprint = None
+		self._dirty = False
+
+		self.stats = {
+			'reflected': 0,
+			'cached': 0,
+		}
+
+	def engine(self, url):
+		"""Gets the engine of a database URL, created the first time.
+
+		Args:
+			url (string): Database URL.
+
+		Returns:
+			sqlalchemy.engine.Engine.
+		"""
+		with self._lock:
+			if url not in self._engines:
+				if url.startswith('sqlite') or self.max_connections is None:
+					self._engines[url] = sqlalchemy.create_engine(url)
+				else:
+					# Connectors of several jobs check out connections at once
+					pool_size = min(POOL_SIZE, self.max_connections)
+					self._engines[url] = sqlalchemy.create_engine(url,
+						pool_size=pool_size,
+						max_overflow=self.max_connections - pool_size)
+			return self._engines[url]
+
+	def bind(self, engine):
+		"""Gets the shared metadata, built the first time, from the cache file if it is still valid.
+
+		Args:
+			engine (sqlalchemy.engine.Engine): Engine of the connector.
+
+		Returns:
+			sqlalchemy.MetaData.
+		"""
+		with self._lock:
+			if self.metadata is None:
+				if self.cache_file is not None:
+					self._fingerprint = fingerprint(engine)
+					if self._fingerprint is None:
+						vprint('No schema fingerprint for {:s}, the schema cache is ignored.'.format(engine.dialect.name))
+					else:
+						self.metadata = self.load()
+				if self.metadata is None:
+					self.metadata = sqlalchemy.MetaData()
+				self.metadata.bind = engine
+
+			return self.metadata
+
+	def load(self):
+		"""Loads the cached tables.
+
+		Returns:
+			sqlalchemy.MetaData, None if the cache file is missing, unreadable or of another schema.
+		"""
+		if not os.path.exists(self.cache_file):
+			return None
+
+		try:
+			with open(self.cache_file, 'rb') as file:
+				cached = pickle.load(file)
+		except Exception, e:
+			vprint('Ignoring the schema cache {:s}: {!s}.'.format(self.cache_file, e))
+			return None
+
+		if cached.get('fingerprint') != self._fingerprint:
+			vprint('The schema changed since {:s} was written, reflecting it again.'.format(self.cache_file))
+			return None
+
+		metadata = cached['metadata']
+		self.stats['cached'] = len(metadata.tables)
+		vprint('Schema loaded from {:s}: {:d} tables.'.format(self.cache_file, len(metadata.tables)))
+
+		return metadata
+
+	def table(self, table_name):
+		"""Gets a table, reflecting it the first time.
+
+		Args:
+			table_name (string): Table name.
+
+		Returns:
+			sqlalchemy.Table.
+		"""
+		with self._lock:
+			if self.metadata is None:
+				raise sqlalchemy.exc.UnboundExecutionError('The schema is not bound to an engine yet.')
+
+			table = self.metadata.tables.get(table_name)
+			if table is None:
+				table = sqlalchemy.Table(table_name, self.metadata, autoload=True)
+				self.stats['reflected'] += 1
+				self._dirty = True
+
+			return table
+
+	def save(self):
+		"""Writes the tables to the cache file, if some were reflected since it was loaded."""
+		with self._lock:
+			if self.cache_file is None or self._fingerprint is None or not self._dirty:
+				return
+
+			# Several processes may write it at once
+			path = '{:s}.{:d}.tmp'.format(self.cache_file, os.getpid())
+			with open(path, 'wb') as file:
+				pickle.dump({'fingerprint': self._fingerprint, 'metadata': self.metadata}, file,
+					pickle.HIGHEST_PROTOCOL)
+			os.rename(path, self.cache_file)
+			self._dirty = False
+
+			vprint('Schema cached in {:s}: {:d} tables.'.format(self.cache_file, len(self.metadata.tables)))
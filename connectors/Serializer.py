@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Serializer.py: Per table row to document serializers."""
+
+__author__      = "Ber Clausen"
+__copyright__   = "Copyright 2014, Planet Earth"
+
+import base64
+import datetime
+from itertools import izip
+
+# SQLAlchemy
+import sqlalchemy
+
+# Utility functions
+from utils.utils import format_timedelta
+
+
+def convert_datetime(value):
+	return value.isoformat()
+
+def convert_time(value):
+	# MySQLdb returns TIME columns as durations
+	if isinstance(value, datetime.timedelta):
+		return format_timedelta(value)
+	return value.isoformat()
+
+def convert_decimal(value):
+	return float(value)
+
+def convert_bytes(value):
+	return base64.b64encode(value)
+
+
+class Serializer(object):
+	"""Serializer class.
+
+	Compiled once per table: holds the column keys and the converters of the columns that need one, so
+	converting a row into a document does no schema work.
+
+	Attributes:
+		keys (tuple): Column keys, in column order.
+		converters (tuple): (key, converter) pairs of the columns that need a conversion.
+	"""
+
+	# Converters by column kind, see Serializer.kind.
+	default_converters = {
+		'datetime': convert_datetime,
+		'time': convert_time,
+		'decimal': convert_decimal,
+		'bytes': convert_bytes,
+	}
+
+	keys = ()
+	converters = ()
+
+	def __init__(self, table, converters=None):
+		"""Initialization.
+
+		Args:
+			table (sqlalchemy.Table): Table whose rows will be serialized.
+			converters (dict): Converters by column kind, None for the default ones, {} to disable them.
+		"""
+		if converters is None:
+			converters = self.default_converters
+
+		self.keys = tuple(table.c.keys())
+
+		column_converters = []
+		for key, column in table.c.items():
+			kind = self.kind(column)
+			if kind in converters:
+				column_converters.append((key, converters[kind]))
+		self.converters = tuple(column_converters)
+
+	@staticmethod
+	def kind(column):
+		"""Kind of value held by a column, regarding conversions.
+
+		Args:
+			column (sqlalchemy.Column): Column.
+
+		Returns:
+			string, None if the values need no conversion.
+		"""
+		column_type = column.type
+		if isinstance(column_type, (sqlalchemy.types.DateTime, sqlalchemy.types.Date)):
+			return 'datetime'
+		if isinstance(column_type, sqlalchemy.types.Time):
+			return 'time'
+		if isinstance(column_type, sqlalchemy.types.Numeric) and column_type.asdecimal:
+			return 'decimal'
+		if isinstance(column_type, (sqlalchemy.types.LargeBinary, sqlalchemy.types.BINARY, sqlalchemy.types.VARBINARY)):
+			return 'bytes'
+		return None
+
+	def convert(self, document):
+		"""Applies the column converters to a document, in place.
+
+		Args:
+			document (dict): Document.
+
+		Returns:
+			Dict.
+		"""
+		for key, converter in self.converters:
+			value = document[key]
+			if value is not None:
+				document[key] = converter(value)
+		return document
+
+	def from_tuple(self, row):
+		"""Converts a row tuple into a document.
+
+		Args:
+			row (tuple): Row values, in column order.
+
+		Returns:
+			Dict.
+		"""
+		document = dict(izip(self.keys, row))
+		if self.converters:
+			self.convert(document)
+		return document
+
+	def from_mapped(self, mapped_model):
+		"""Converts a mapped model into a document.
+
+		Args:
+			mapped_model: Mapped model.
+
+		Returns:
+			Dict.
+		"""
+		values = mapped_model.__dict__
+		document = {k:values[k] for k in self.keys}
+		if self.converters:
+			self.convert(document)
+		return document
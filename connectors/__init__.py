@@ -1 +1 @@
-__all__ = ['SQLSoup']
+__all__ = ['Cache', 'Core', 'Replicas', 'Schema', 'SQLSoup']
@@ -6,14 +6,21 @@
 __author__      = "Ber Clausen"
 __copyright__   = "Copyright 2014, Planet Earth"
 
-import time, sys
-from Queue import Queue
+import time, sys, os
+import multiprocessing
+from Queue import Empty
+
+# Threading
+import threading
 
 # Elasticsearch connector
 from pyes import ES
 
+# Errors
+from utils.errors import BadConfigError
+
 # Utility functions
-from utils.utils import vprint
+from utils.utils import vprint, tprint
 
 # # Indexer
 # from utils.ThreadWatcher import ThreadWatcher # Thread control
@@ -24,16 +31,37 @@ from utils.utils import vprint
 
 # Config
 from config.Config import Config
+from config.Job import load_jobs
+
+# Db connectors
+from connectors import Core, SQLSoup
+from connectors.Cache import LRUCache
+from connectors.Schema import Schema
+from connectors.Replicas import ReplicaPool
 
-# Db connector
-from connectors.SQLSoup import Connector as DbConnector
+# Sinks
+from sinks.Elasticsearch import BulkSink
+from sinks.File import FileSink, shards, load
+
+# Versioned indexes
+from sinks.Versions import VersionedIndex
 
 # Indexer
 from indexer.Indexer import Indexer
+from indexer.IdSource import id_ranges, IncrementalIdSource
+from indexer.Watermark import Watermark
+from indexer.Checkpoint import Checkpoint
+from indexer.Fingerprints import Fingerprints
+from indexer.Hierarchy import Hierarchy
+from indexer.ChangeLog import ChangeLog, triggers
+from indexer.JobScheduler import JobScheduler
 
 # Thread
 from utils.Thread import Thread
 
+# Metrics
+from utils.Metrics import metrics, instrument_sql, Reporter
+
 
 def main(script, *args, **kwargs):
 	start_time = time.time()
@@ -41,78 +69,122 @@ def main(script, *args, **kwargs):
 	# Config options
 	config = Config()
 
-	source_table = 'categories'
-	source_relationships = {
-		'one_to_many': {
-			'alternative_languages': {
-				'foreign_key': 'category_id'
-			},
-			'external_pages': {
-				'foreign_key': 'category_id'
-			},
-			'news_groups': {
-				'foreign_key': 'category_id'
-			}
-		},
-		'one_to_one': {
-		},
-		'many_to_one': {
-		},
-		'many_to_many': {
-		},
-		'self_referential': {
-			'parent_category': {
-				'foreign_key': 'parent_id',
-				'backref': 'child_categories'
-			},
-		}
-	}
-	# source_table = 'external_pages'
-	# source_relationships = {
-	# 	'one_to_many': {
-	# 	},
-	# 	'many_to_one': {
-	# 		'categories': {
-	# 			'foreign_key': 'category_id'
-	# 		}
-	# 	},
-	# 	'one_to_one': {
-	# 	},
-	# 	'many_to_many': {
-	# 	},
-	# 	'self_referential': {
-	# 	}
-	# }
-	document_map = {
-		'alternative_languages': 'alternative_languages',
-		'categories': 'categories',
-		'external_pages': 'external_pages',
-		'news_groups': 'news_groups',
-		'parent_category': 'parent_category',
-		'related_categories': 'related_categories',
-	}
+	# Index jobs
+	jobs = load_jobs(config.job_file, config.job_names)
+	if len(jobs) > 1:
+		if config.follow or config.load or config.processes > 1 or config.pipeline:
+			raise BadConfigError('Following, loading, worker processes and pipelines run a single job, select it with --job.')
+		indices = [job.configure(config).es_index for job in jobs]
+		if len(set(indices)) != len(indices):
+			raise BadConfigError('Jobs running together need their own index.')
 
-	# Threads list
-	threads = []
+	# Stage metrics
+	reporter = start_metrics(config)
 
-	# Db connector queue
-	read_queue = Queue()
+	# Tables reflected once, and engines shared by every db connector of this process
+	schema = shared_schema(config, len(jobs))
 
-	# Db connections list
-	db_connections = config.db_connections
+	# Shards are written without Elasticsearch
+	if config.sink == 'file':
+		es_connector = None
+	else:
+		es_connector = ES(server=config.es_connections, bulk_size=config.write_chunk_size)
 
-	# Populte db connector queue (round robin)
-	for _ in range(config.db_queue_size):
-		db_connection = db_connections.pop(0)
-		db_connector = DbConnector(db_connection).build(source_table, source_relationships)
-		read_queue.put(db_connector)
-		db_connections.append(db_connection)
+	# Each job has its own configuration, index and type
+	runs = []
+	for job in jobs:
+		job_config = job.configure(config)
+		runs.append({
+			'job': job,
+			'config': job_config,
+			'versioned': prepare_index(job_config, es_connector),
+		})
+
+	# Near real time indexing keeps the interactive settings
+	if config.follow:
+		job = runs[0]['job']
+		follow(runs[0]['config'], es_connector, job.source_table, job.relationships, job.document_map, schema)
+		stop_metrics(reporter)
+		vprint('Elapsed: {:f}'.format(time.time() - start_time))
+		return
+
+	for run in runs:
+		prepare_run(run, es_connector, schema)
+
+	# Start indexing
+	if len(runs) > 1:
+		index_jobs(config, es_connector, runs, start_time, schema)
+	else:
+		run = runs[0]
+		job = run['job']
+		job_config = run['config']
+		if config.load:
+			run['failed'] = load_shards(job_config)
+		elif config.processes > 1:
+			run['failed'], run['error'] = index_processes(job_config, start_time, job.source_table,
+				job.relationships, job.document_map, schema, **run['options'])
+		else:
+			indexer = build_indexer(job_config, es_connector, job.source_table, job.relationships, job.document_map,
+				schema=schema,
+				**run['options'])
+			run['error'] = run_indexer(job_config, indexer, start_time)
+			run['failed'] = indexer.flush()
+
+	for run in runs:
+		finish_run(run, es_connector)
+
+	stop_metrics(reporter)
+
+	vprint('Elapsed: {:f}'.format(time.time() - start_time))
+
+def prepare_index(config, es_connector):
+	"""Prepares the index of a job: a new version when rebuilding, otherwise the index, created if missing.
+
+	Args:
+		config (Config): Configuration of the job, its index is the new version when rebuilding.
+		es_connector: Elasticsearch connector, None with the file sink.
+
+	Returns:
+		VersionedIndex, None if not rebuilding.
+	"""
+	# Full rebuilds load a new version of the index, and move the alias to it once loaded
+	versioned = None
+	if config.rebuild:
+		versioned = VersionedIndex(es_connector, config.es_index, config.keep_versions)
+		target = versioned.unfinished() if config.resume else None
+		if target is None:
+			target = versioned.create({
+				'index.refresh_interval': '-1',
+				'index.number_of_replicas': 0,
+				'index.merge.policy.merge_factor': '30'
+			})
+		else:
+			vprint('Resuming {:s}...'.format(target))
+		config.es_index = target
+	elif es_connector is not None:
+		# Fingerprints of a missing index describe documents that are gone
+		if config.fingerprints and not es_connector.indices.exists_index(config.es_index):
+			store = fingerprints(config)
+			store.clear()
+			store.close()
+
+		# Create index if necessary
+		es_connector.indices.create_index_if_missing(config.es_index)
 
-	# Elasticsearch connector
-	es_connector = ES(server=config.es_connections, bulk_size=config.write_chunk_size)
+	return versioned
 
-	# Create index if necessary
-	es_connector.indices.create_index_if_missing(config.es_index)
+def prepare_run(run, es_connector, schema):
+	"""Prepares the indexing of a job: bulk settings, incremental changes, hierarchy and checkpoint.
+
+	Args:
+		run (dict): Job, its configuration and its versioned index, the Indexer arguments, watermark and
+			checkpoint are added.
+		es_connector: Elasticsearch connector, None with the file sink.
+		schema (Schema): Schema shared by the db connectors of the process.
+	"""
+	config = run['config']
+	source_table = run['job'].source_table
+	source_relationships = run['job'].relationships
 
 	# Define mapping
 	# es_connector.cluster.put_mapping(config.es_type, {'properties':gralSettings['mapping']}, config.indexName)
@@ -128,23 +200,467 @@ def main(script, *args, **kwargs):
 	# http://www.elasticsearch.org/blog/update-settings/
 	# https://github.com/aparo/pyes/blob/master/docs/guide/reference/api/admin-indices-update-settings.rst
 	# http://www.elasticsearch.org/guide/en/elasticsearch/reference/current/index-modules-merge.html#log-byte-size
-	vprint('Optimizing for bulk indexing...')
-	es_connector.indices.update_settings(config.es_index, {
-		'index.refresh_interval': '-1',
-		'index.merge.policy.merge_factor': '30'
-	})
+	if es_connector is not None:
+		vprint('Optimizing {:s} for bulk indexing...'.format(config.es_index))
+		es_connector.indices.update_settings(config.es_index, {
+			'index.refresh_interval': '-1',
+			'index.merge.policy.merge_factor': '30'
+		})
+
+	# Incremental indexing: only the rows changed since the last run
+	options = {}
+	watermark = None
+	if config.incremental:
+		watermark, options = incremental_options(config, source_table, source_relationships, schema)
+
+	# Parent index of the whole table, scanned once and inherited by the worker processes
+	if config.hierarchy and not config.load:
+		options['hierarchy'] = scan_hierarchy(config, source_table, source_relationships, schema)
+
+	# Completed id ranges, kept until the run finishes
+	checkpoint = None
+	if (config.sink == 'file' or config.bulk_requests > 0) and not config.load:
+		checkpoint = Checkpoint(config.checkpoint_file, config.es_index, source_table)
+		if not config.resume:
+			checkpoint.clear()
+
+	run['options'] = options
+	run['watermark'] = watermark
+	run['checkpoint'] = checkpoint
+
+def finish_run(run, es_connector):
+	"""Completes the indexing of a job: moves its watermark, clears its checkpoint, restores the interactive
+	settings, and serves the new version when rebuilding. Nothing moves forward if documents failed, or the
+	job stopped on an error.
+
+	Args:
+		run (dict): Job, its configuration, versioned index, options, watermark, checkpoint, number of
+			failed documents and error, if any.
+		es_connector: Elasticsearch connector, None with the file sink.
+	"""
+	config = run['config']
+	failed = run['failed']
+	versioned = run['versioned']
+	checkpoint = run['checkpoint']
+
+	# A job stopped on an error is as incomplete as one with failed documents
+	if run.get('error') is not None:
+		failure = 'The {:s} job failed'.format(run['job'].name)
+	elif failed:
+		failure = '{:d} documents failed'.format(failed)
+	else:
+		failure = None
+
+	# The watermark only moves forward once every document is acknowledged
+	if config.incremental:
+		watermark = run['watermark']
+		until = run['options']['id_source_options']['until']
+		if failure:
+			vprint('{:s}, the watermark stays at {!s}.'.format(failure, watermark.load()))
+		elif until is not None:
+			watermark.save(until)
+			vprint('Watermark moved to {!s}.'.format(until))
+
+	# Only a complete run has nothing to resume, after an error the checkpoint is all that says which ranges
+	# were written
+	if checkpoint is not None:
+		if failure:
+			vprint('{:s}, run again with --resume to retry.'.format(failure))
+		else:
+			checkpoint.clear()
+		checkpoint.close()
+
+	if es_connector is not None:
+		vprint('Optimizing {:s} for interactive indexing...'.format(config.es_index))
+		settings = {
+			'index.refresh_interval': '1s',
+			'index.merge.policy.merge_factor': '10'
+		}
+		if versioned is not None:
+			settings['index.number_of_replicas'] = config.replicas
+		es_connector.indices.update_settings(config.es_index, settings)
+
+		vprint('Refreshing index...')
+		es_connector.indices.refresh(config.es_index)
+
+	# Only a complete version is served, never one missing the chunks of a failed thread
+	if versioned is not None:
+		if failure:
+			vprint('The alias {:s} stays on {:s}, run again with --resume to complete {:s}.'.format(
+				versioned.alias, ', '.join(versioned.current()) or 'nothing', config.es_index))
+		else:
+			versioned.swap(config.es_index)
+			deleted = versioned.prune()
+
+			# The documents of the alias are now the ones of the version
+			if config.fingerprints:
+				store = fingerprints(config)
+				store.promote(versioned.alias)
+				for name in deleted:
+					store.clear(name)
+				store.close()
+
+def index_jobs(config, es_connector, runs, start_time, schema):
+	"""Indexes several jobs at once in this process, sharing the workers, db connections and bulk capacity.
+
+	The workers are shared according to the job policy (see JobScheduler). The db connectors of every job
+	share the reflected schema and the engines, so their connection pools, and the bulk sinks share a limiter,
+	so there are never more than `bulk_requests` requests in flight altogether.
+
+	Args:
+		config (Config): Configuration.
+		es_connector: Elasticsearch connector, None with the file sink.
+		runs (list): Prepared jobs, the number of failed documents of each one is added.
+		start_time (float): Start time in seconds.
+		schema (Schema): Schema shared by the db connectors of the process.
+	"""
+	limiter = threading.Semaphore(config.bulk_requests) if config.bulk_requests > 0 else None
+
+	scheduler = JobScheduler(config.job_policy)
+	indexers = []
+	for i, run in enumerate(runs):
+		job = run['job']
+		indexer = build_indexer(run['config'], es_connector, job.source_table, job.relationships, job.document_map,
+			schema=schema,
+			limiter=limiter,
+			watch_threads=i == 0,
+			**run['options'])
+		scheduler.add(job.name, indexer, job.weight, job.priority, run['config'].read_chunk_size)
+		indexers.append(indexer)
+
+	stats = scheduler.run(config.threads, start_time)
+
+	for run, indexer, job_stats in zip(runs, indexers, stats):
+		run['failed'] = indexer.flush()
+		run['error'] = job_stats['error']
+
+	for job_stats in stats:
+		vprint('{name:s}: weight {weight:.1f}, priority {priority:d}, {chunks:d} chunks, {ids:d} ids, '
+			'busy {busy_time:.3f}s ({busy_share:.1%}){failed_note:s}'.format(
+				failed_note=', failed' if job_stats['error'] is not None else '', **job_stats))
+
+def start_metrics(config, worker_name=None):
+	"""Times the SQL statements, and starts writing the metrics file if configured.
+
+	Args:
+		config (Config): Configuration.
+		worker_name (string): Name of the worker process, appended to the file name, None in the main process.
+
+	Returns:
+		Reporter, None if there is no metrics file.
+	"""
+	instrument_sql()
+
+	if not config.metrics_file:
+		return None
+
+	path = config.metrics_file
+	if worker_name is not None:
+		root, extension = os.path.splitext(path)
+		path = '{:s}-{:s}{:s}'.format(root, worker_name, extension)
+
+	reporter = Reporter(metrics, path, config.metrics_interval)
+	reporter.start()
+	return reporter
+
+def stop_metrics(reporter):
+	"""Prints the metrics summary, and writes the final metrics file.
+
+	Args:
+		reporter (Reporter): Reporter, None if there is no metrics file.
+	"""
+	metrics.summary()
+	if reporter is not None:
+		reporter.stop()
+
+def incremental_options(config, source_table, source_relationships, schema):
+	"""Prepares the incremental id source.
+
+	The high-water mark of this run is computed once here, so every worker selects the same changes.
+
+	Args:
+		config (Config): Configuration.
+		source_table (string): Source table name.
+		source_relationships (dict): Relationships of the source table, changes of the one to many child
+			tables mark their parents. A relationship may set its own 'watermark' column, or False to ignore it.
+		schema (Schema): Schema shared by the db connectors of the process.
+
+	Returns:
+		Tuple with the Watermark and the Indexer arguments.
+	"""
+	watermark = Watermark(config.watermark_file, config.es_index, source_table)
+
+	children = []
+	for relationship_name, relationship in source_relationships.get('one_to_many', {}).iteritems():
+		relationship_table = relationship['table'] if 'table' in relationship else relationship_name
+		child_column = relationship['watermark'] if 'watermark' in relationship else config.watermark_column
+		if child_column is not False:
+			children.append((relationship_table, relationship['foreign_key'], child_column))
+
+	DbConnector = Core.Connector if config.connector == 'core' else SQLSoup.Connector
+	db_connector = DbConnector(config.db_connections[0], schema=schema).build(source_table)
+	id_source = IncrementalIdSource(db_connector._model,
+		column=config.watermark_column,
+		since=watermark.load(),
+		overlap=config.watermark_overlap,
+		children=children)
+	vprint('Changes since {!s} until {!s}.'.format(id_source.lower_bound(), id_source.until))
+
+	return watermark, {
+		'id_source': 'incremental',
+		'id_source_options': {
+			'column': config.watermark_column,
+			'since': id_source.since,
+			'until': id_source.until,
+			'overlap': config.watermark_overlap,
+			'children': children,
+		},
+	}
+
+def follow(config, es_connector, source_table, source_relationships, document_map, schema):
+	"""Indexes the changes recorded in the change log, until interrupted.
 
-	indexer = Indexer(
+	The offset of the last acknowledged change is kept in the watermark file, so following starts again where
+	it stopped.
+
+	Args:
+		config (Config): Configuration.
+		es_connector: Elasticsearch connector.
+		source_table (string): Source table name.
+		source_relationships (dict): Relationships of the source table.
+		document_map (dict): Dict used for mapping the models to the document structure.
+		schema (Schema): Schema shared by the db connectors of the process.
+	"""
+	DbConnector = Core.Connector if config.connector == 'core' else SQLSoup.Connector
+	db_connector = DbConnector(config.db_connections[0], schema=schema).build(source_table)
+	metadata = getattr(db_connector._model, '_table', db_connector._model).metadata
+
+	if config.install_change_log:
+		vprint('Installing the change log {:s}...'.format(config.change_log))
+		# Already there when loaded from the schema cache
+		table = metadata.tables.get(config.change_log)
+		if table is None:
+			table = ChangeLog.define(config.change_log, metadata)
+		table.create(checkfirst=True)
+		for statement in triggers(config.change_log, source_table, source_relationships):
+			metadata.bind.execute(statement)
+	else:
+		table = schema.table(config.change_log)
+
+	indexer = build_indexer(config, es_connector, source_table, source_relationships, document_map,
+		schema=schema,
+		checkpoint=None)
+
+	offset = Watermark(config.watermark_file, config.es_index, config.change_log)
+	last = indexer.follow(ChangeLog(table), offset.load(),
+		poll_interval=config.poll_interval,
+		window=config.change_window,
+		batch_size=config.write_chunk_size,
+		purge=config.purge_change_log,
+		on_offset=offset.save,
+		settle=config.change_settle)
+	indexer.flush()
+
+	vprint('Followed up to change {!r}.'.format(last))
+
+def scan_hierarchy(config, source_table, source_relationships, schema):
+	"""Scans the parent ids of the source table.
+
+	Args:
+		config (Config): Configuration.
+		source_table (string): Source table name.
+		source_relationships (dict): Relationships of the source table, with a self referential one.
+		schema (Schema): Schema shared by the db connectors of the process.
+
+	Returns:
+		Hierarchy.
+	"""
+	self_referential = source_relationships.get('self_referential', {})
+	if len(self_referential) != 1:
+		raise BadConfigError('The hierarchy needs exactly one self referential relationship.')
+	relationship = self_referential.values()[0]
+
+	DbConnector = Core.Connector if config.connector == 'core' else SQLSoup.Connector
+	db_connector = DbConnector(config.db_connections[0], schema=schema).build(source_table)
+	return Hierarchy.scan(db_connector._model, relationship['foreign_key'])
+
+def shared_schema(config, jobs=1):
+	"""Builds the schema shared by the db connectors of a process.
+
+	Each engine gets enough connections for every db connector of every job, plus one per indexing thread for
+	the id queries, and one for the main thread.
+
+	Args:
+		config (Config): Configuration.
+		jobs (int): Number of jobs run by the process.
+
+	Returns:
+		Schema.
+	"""
+	return Schema(config.schema_cache, config.db_queue_size * jobs + config.threads + 1)
+
+def fingerprints(config):
+	"""Opens the fingerprints of the configured index.
+
+	Args:
+		config (Config): Configuration.
+
+	Returns:
+		Fingerprints.
+	"""
+	return Fingerprints(config.fingerprint_file, config.es_index)
+
+def load_shards(config):
+	"""Loads the shards written by the file sink into Elasticsearch, through the bulk sink.
+
+	Args:
+		config (Config): Configuration.
+
+	Returns:
+		int, number of documents that could not be written.
+	"""
+	paths = shards(config.load)
+	vprint('Loading {:d} shards from {:s}...'.format(len(paths), config.load))
+
+	sink = bulk_sink(config)
+	return load(sink, paths, config.threads)['failed_documents']
+
+def bulk_sink(config, limiter=None):
+	"""Builds the bulk sink.
+
+	Args:
+		config (Config): Configuration.
+		limiter (threading.Semaphore): Bounds the requests in flight of the sinks sharing it, if any.
+
+	Returns:
+		BulkSink.
+	"""
+	return BulkSink(config.es_connections, config.es_index, config.es_type,
+		bulk_size=config.write_chunk_size,
+		bulk_bytes=config.bulk_bytes,
+		min_bulk_bytes=config.min_bulk_bytes,
+		max_bulk_bytes=config.max_bulk_bytes,
+		bulk_latency=config.bulk_latency,
+		concurrency=config.bulk_requests,
+		max_retries=config.bulk_retries,
+		backoff=config.bulk_backoff,
+		limiter=limiter)
+
+def replica_name(db_connection):
+	"""Name of the replica of a db connection: its host and database.
+
+	Args:
+		db_connection (tuple): Database name, hostname, username and password.
+
+	Returns:
+		string.
+	"""
+	name, hostname = db_connection[:2]
+	return '{:s}/{:s}'.format(hostname, name) if hostname else name
+
+def build_indexer(config, es_connector, source_table, source_relationships, document_map, schema=None, limiter=None,
+	**kwargs):
+	"""Builds the db connectors queue and the indexer.
+
+	Args:
+		config (Config): Configuration.
+		es_connector: Elasticsearch connector, None with the file sink.
+		source_table (string): Source table name.
+		source_relationships (dict): Relationships of the source table.
+		document_map (dict): Dict used for mapping the models to the document structure.
+		schema (Schema): Schema shared with the db connectors of other jobs, None for one of their own.
+		limiter (threading.Semaphore): Bounds the requests in flight of the bulk sinks sharing it, if any.
+		**kwargs: Extra Indexer arguments.
+
+	Returns:
+		Indexer.
+	"""
+	# Db connector queue, balanced by the latency and errors of each replica
+	read_queue = ReplicaPool(config.replica_max_errors, config.replica_eject_seconds)
+
+	# Db connections list
+	db_connections = config.db_connections
+
+	# Db connector implementation
+	DbConnector = Core.Connector if config.connector == 'core' else SQLSoup.Connector
+
+	# Tables reflected once per process, shared by its db connectors
+	if schema is None:
+		schema = shared_schema(config)
+	connector_options = {'schema': schema}
+
+	# Related parents cached once per process, shared by its db connectors
+	if config.related_cache_entries or config.related_cache_bytes:
+		connector_options['cache'] = LRUCache(config.related_cache_entries, config.related_cache_bytes,
+			config.related_cache_ttl)
+
+	# Populte db connector queue (round robin), each db connection is a replica
+	for _ in range(config.db_queue_size):
+		db_connection = db_connections.pop(0)
+		db_connector = DbConnector(db_connection, **connector_options).build(source_table, source_relationships)
+		read_queue.add(db_connector, replica_name(db_connection))
+		db_connections.append(db_connection)
+	schema.save()
+
+	options = {
+		'limit': config.limit,
+		'id_source': config.id_source,
+		'id_window_size': config.id_window_size,
+		'id_split': config.id_split,
+		'id_split_parts': config.id_split_parts,
+		'resume': config.resume,
+		'max_rss': config.max_rss * 1024 * 1024 if config.max_rss else None,
+		'read_retries': config.read_retries,
+	}
+
+	# Sink
+	if config.sink == 'file':
+		options['sink'] = FileSink(config.output_dir, config.es_index, config.es_type,
+			compression=config.compression,
+			shard_bytes=config.shard_bytes,
+			shard_seconds=config.shard_seconds)
+	elif config.bulk_requests > 0:
+		options['sink'] = bulk_sink(config, limiter)
+
+	if 'sink' in options:
+		# Each process opens its own connection to the checkpoint file
+		if 'checkpoint' not in kwargs:
+			options['checkpoint'] = Checkpoint(config.checkpoint_file, config.es_index, source_table)
+		if config.fingerprints:
+			options['fingerprints'] = fingerprints(config)
+	options.update(kwargs)
+
+	return Indexer(
 		db_connector=db_connector,
 		read_queue=read_queue,
 		es_connector=es_connector,
 		es_index=config.es_index,
 		es_type=config.es_type,
 		document_map=document_map,
-		limit=config.limit)
+		**options)
 
-	# Start indexing
-	if config.single_process_mode:
+def run_indexer(config, indexer, start_time):
+	"""Runs the indexer in the current process, either directly, in threads or as a staged pipeline.
+
+	Args:
+		config (Config): Configuration.
+		indexer (Indexer): Indexer.
+		start_time (float): Start time in seconds.
+
+	Returns:
+		string, first error that stopped an indexing thread, None if none did.
+	"""
+	# Threads list
+	threads = []
+
+	if config.pipeline:
+		indexer.pipeline(start_time,
+			read_chunk_size=config.read_chunk_size,
+			readers=config.pipeline_readers,
+			builders=config.pipeline_builders,
+			writers=config.pipeline_writers,
+			queue_size=config.pipeline_queue_size)
+	elif config.single_process_mode:
 		indexer.index(start_time, read_chunk_size=config.read_chunk_size)
 	else:
 		# Create new threads
@@ -165,16 +681,129 @@ def main(script, *args, **kwargs):
 		for thread in threads:
 			thread.join()
 
-	vprint('Optimizing for interactive indexing...')
-	es_connector.indices.update_settings(config.es_index, {
-		'index.refresh_interval': '1s',
-		'index.merge.policy.merge_factor': '10'
-	})
+	return indexer.error
 
-	vprint('Refreshing index...')
-	es_connector.indices.refresh()
+def index_processes(config, start_time, source_table, source_relationships, document_map, schema, **kwargs):
+	"""Indexes using several worker processes, bypassing the GIL.
 
-	vprint('Elapsed: {:f}'.format(time.time() - start_time))
+	The primary key span is split into disjoint id ranges, one per process. Each worker owns its db connectors
+	and Elasticsearch connector, and reports its progress to this process.
+
+	Args:
+		config (Config): Configuration.
+		start_time (float): Start time in seconds.
+		source_table (string): Source table name.
+		source_relationships (dict): Relationships of the source table.
+		document_map (dict): Dict used for mapping the models to the document structure.
+		schema (Schema): Schema of this process, the workers build their own, from its cache file if any.
+		**kwargs: Extra Indexer arguments.
+
+	Returns:
+		Tuple with the number of documents that could not be written, and the error of the workers that
+		failed, None if every one finished.
+	"""
+	DbConnector = Core.Connector if config.connector == 'core' else SQLSoup.Connector
+	db_connector = DbConnector(config.db_connections[0], schema=schema).build(source_table)
+	ranges = id_ranges(db_connector._model, config.processes)
+	schema.save()
+
+	# Share the documents limit among the workers
+	limits = [None] * len(ranges)
+	if config.limit not in [None, 0]:
+		limits = [config.limit // len(ranges) + (1 if i < config.limit % len(ranges) else 0) for i in range(len(ranges))]
+
+	progress_queue = multiprocessing.Queue()
+
+	workers = []
+	for i, id_range in enumerate(ranges):
+		worker = multiprocessing.Process(
+			target=index_worker,
+			name='Process-{:d}'.format(i + 1),
+			args=(config, start_time, source_table, source_relationships, document_map, id_range, limits[i], progress_queue),
+			kwargs=kwargs)
+		worker.start()
+		workers.append(worker)
+
+	count = 0
+	total = 0
+	failed = 0
+	done = 0
+	while done < len(workers):
+		try:
+			kind, name, value = progress_queue.get(True, 1)
+		except Empty:
+			if not any(worker.is_alive() for worker in workers):
+				break
+			continue
+
+		if kind == 'total':
+			total += value
+		elif kind == 'progress':
+			count += value
+			tprint('Main', '{:d}/{:d} ({:.2%}) {{{:f}}}'.format(count, total, float(count) / max(total, 1), time.time() - start_time))
+		elif kind == 'failed':
+			failed += value
+		elif kind == 'done':
+			done += 1
+			tprint('Main', '{:s} done, {:d} documents.'.format(name, value))
+
+	# A failed worker left chunks of its range unwritten, whatever it acknowledged
+	errors = []
+	for worker in workers:
+		worker.join()
+		if worker.exitcode != 0:
+			errors.append('{:s} exited with code {:d}'.format(worker.name, worker.exitcode))
+			vprint('{:s}.'.format(errors[-1]))
+
+	vprint('Indexed: {:d}/{:d}'.format(count, total))
+
+	return failed, ', '.join(errors) if errors else None
+
+def index_worker(config, start_time, source_table, source_relationships, document_map, id_range, limit, progress_queue, **kwargs):
+	"""Worker process: indexes an id range with its own connectors.
+
+	Args:
+		config (Config): Configuration.
+		start_time (float): Start time in seconds.
+		source_table (string): Source table name.
+		source_relationships (dict): Relationships of the source table.
+		document_map (dict): Dict used for mapping the models to the document structure.
+		id_range (tuple): Inclusive (lower, upper) bounds of the ids to index.
+		limit (int): Number of documents to index.
+		progress_queue (multiprocessing.Queue): Queue where the progress is reported.
+		**kwargs: Extra Indexer arguments.
+
+	Exits with a non-zero code if an indexing thread failed.
+	"""
+	name = multiprocessing.current_process().name
+
+	# Forked with the metrics of the main process
+	metrics.reset()
+	reporter = start_metrics(config, name)
+
+	es_connector = None
+	if config.sink != 'file':
+		es_connector = ES(server=config.es_connections, bulk_size=config.write_chunk_size)
+
+	indexer = build_indexer(config, es_connector, source_table, source_relationships, document_map,
+		limit=limit,
+		id_range=id_range,
+		progress_queue=progress_queue,
+		watch_threads=False,
+		**kwargs)
+	progress_queue.put(('total', name, indexer.index_total))
+
+	error = run_indexer(config, indexer, start_time)
+
+	# Send the pending bulk
+	progress_queue.put(('failed', name, indexer.flush()))
+
+	stop_metrics(reporter)
+
+	progress_queue.put(('done', name, indexer.index_count))
+
+	if error is not None:
+		sys.exit(1)
 
 if __name__ == '__main__':
 	main(*sys.argv)
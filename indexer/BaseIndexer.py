@@ -7,6 +7,7 @@ __author__      = "Ber Clausen"
 __copyright__   = "Copyright 2014, Planet Earth"
 
 from abc import ABCMeta, abstractmethod
+import traceback
 
 # Threading
 import threading
@@ -17,6 +18,15 @@ import inflection
 # Thread control
 from utils import ThreadWatcher
 
+# Errors
+from utils.errors import BadConfigError
+
+# Memory ceiling
+from utils.Memory import MemoryGuard
+
+# Utility functions
+from utils.utils import vprint
+
 
 class BaseIndexer(object):
 	"""BaseIndexer class.
@@ -25,26 +35,43 @@ class BaseIndexer(object):
 	Later, builds the Elasticsearch documents according the the definitions and indexes them.
 
 	Attributes:
-		index_buffer: Buffer filled of items to be indexed.
+		index_buffer: Buffer filled of ids to be indexed.
 		index_count (int): Number of indexed items.
 		index_total (int): Number of elements to index.
 		read_chunk_size (int): Size of the read chunk used when reading from the buffer.
 		buffer_empty (bool): Whether the buffer is empty.
-		lock (threading.Lock: Internal threading lock.
+		error (string): First error that stopped an indexing thread, None if none did.
+		lock (threading.Lock): Internal threading lock, guards the buffer and the scheduler creation. Each
+			indexer has its own, so the jobs run together do not wait on each other.
 	"""
 
 	__metaclass__ = ABCMeta
-	_lock = threading.Lock()
+	_lock = None
 	_document_map = {}
 	_read_queue = None
 	_es_connector = None
 	_es_index = None
 	_es_type = None
+	_id_source = 'keyset'
+	_id_window_size = None
+	_id_split = 'span'
+	_id_split_parts = 64
+	_id_source_options = {}
+	_id_range = None
+	_progress_queue = None
+	_sink = None
+	_checkpoint = None
+	_resume = False
+	_fingerprints = None
+	_hierarchy = None
+	_memory = None
+	_last_id = None
+	_read_retries = 0
 
 	index_buffer = None
-	index_count = 0
 	index_total = 0
 	buffer_empty = False
+	error = None
 	read_chunk_size = 10
 
 	def __init__(self,
@@ -54,7 +81,22 @@ class BaseIndexer(object):
 		es_index,
 		es_type,
 		document_map={},
-		limit=None):
+		limit=None,
+		id_source='keyset',
+		id_window_size=None,
+		id_split=None,
+		id_split_parts=None,
+		id_source_options={},
+		id_range=None,
+		progress_queue=None,
+		watch_threads=True,
+		sink=None,
+		checkpoint=None,
+		resume=False,
+		fingerprints=None,
+		hierarchy=None,
+		max_rss=None,
+		read_retries=0):
 		"""Initialization.
 
 		Args:
@@ -65,8 +107,57 @@ class BaseIndexer(object):
 			es_type (string): Elasticsearch type.
 			document_map (dict): Dict used for mapping the models to the document structure.
 			limit (int): Number of documents to index
+			id_source (string): Name of the id source used to populate the buffer (see IdSource.id_sources).
+			id_window_size (int): Number of ids fetched per query by windowed id sources.
+			id_split (string): How the ids are split into the ranges scheduled to the threads, 'span' splits
+				the primary key span evenly, 'quantiles' splits the rows evenly.
+			id_split_parts (int): Number of ranges scheduled to the threads.
+			id_source_options (dict): Extra arguments of the id source.
+			id_range (tuple): Inclusive (lower, upper) bounds of the ids to index, None for all of them.
+			progress_queue (multiprocessing.Queue): Queue where the progress is reported, if any.
+			watch_threads (bool): Whether to fork a ThreadWatcher, not wanted inside worker processes.
+			sink (sinks.BaseSink.BaseSink): Sink the documents are written to, None to use the Elasticsearch
+				connector bulk indexing.
+			checkpoint (Checkpoint.Checkpoint): Where the acknowledged id ranges are stored, requires a sink.
+			resume (bool): Whether to skip the id ranges completed by an interrupted run.
+			fingerprints (Fingerprints.Fingerprints): Fingerprints of the written documents, to skip the
+				unchanged ones, requires a sink.
+			hierarchy (Hierarchy.Hierarchy): Parent index of the source table, adds the ancestors, depth and
+				number of children of every document under the 'hierarchy' key.
+			max_rss (int): Resident memory ceiling in bytes, once reached the sink is drained and the sessions
+				and connections are recycled between chunks. None for no ceiling.
+			read_retries (int): Number of times a chunk failing with a database error is read again, with
+				another db connector of the read queue.
 		"""
+		if checkpoint is not None and sink is None:
+			raise BadConfigError('Checkpoints need a bulk sink to acknowledge the documents.')
+		if fingerprints is not None and sink is None:
+			raise BadConfigError('Fingerprints need a bulk sink to acknowledge the documents.')
 
+		self._lock = threading.Lock()
+		self._id_source = id_source
+		self._id_window_size = id_window_size
+		if id_split is not None:
+			if id_split not in ['span', 'quantiles']:
+				raise BadConfigError('Unknown id split: {:s}.'.format(id_split))
+			self._id_split = id_split
+		if id_split_parts is not None:
+			if id_split_parts < 1:
+				raise BadConfigError('The number of id ranges must be positive.')
+			self._id_split_parts = id_split_parts
+		self._counts = {}
+		self._id_source_options = id_source_options
+		self._id_range = id_range
+		self._progress_queue = progress_queue
+		self._sink = sink
+		self._checkpoint = checkpoint
+		self._resume = resume
+		self._fingerprints = fingerprints
+		self._hierarchy = hierarchy
+		self._memory = MemoryGuard(max_rss, self.recycle)
+		if read_retries < 0:
+			raise BadConfigError('The number of read retries can not be negative.')
+		self._read_retries = read_retries
 		self.fill_buffer(db_connector._model, limit)
 
 		self._read_queue = read_queue
@@ -76,7 +167,44 @@ class BaseIndexer(object):
 		self._document_map = self.document_map(db_connector) if document_map in [None, {}] else document_map
 
 		# Threads manager
-		ThreadWatcher.ThreadWatcher()
+		if watch_threads:
+			ThreadWatcher.ThreadWatcher()
+
+	@property
+	def index_count(self):
+		"""Number of indexed items, the sum of the counts of every thread."""
+		return sum(self._counts.values())
+
+	def count(self, size):
+		"""Accounts indexed items to the current thread.
+
+		Each thread only writes its own counter, so no lock is needed and the total stays exact.
+
+		Args:
+			size (int): Number of items.
+
+		Returns:
+			int, number of indexed items so far.
+		"""
+		thread = threading.current_thread().ident
+		self._counts[thread] = self._counts.get(thread, 0) + size
+		return self.index_count
+
+	def fail(self, error):
+		"""Records the error that stopped an indexing thread, and reports it with its traceback.
+
+		The chunk the thread held is not written, so the run is incomplete: the caller keeps the watermark,
+		checkpoint and alias where they were.
+
+		Args:
+			error (Exception): Error.
+		"""
+		with self._lock:
+			if self.error is None:
+				self.error = repr(error)
+
+		vprint('Indexing failed in {:s}: {!r}\n{:s}'.format(threading.current_thread().getName(), error,
+			traceback.format_exc()))
 
 	def document_map(self, db_connector):
 		"""Builds the mapping between the models and the document structure.
@@ -108,6 +236,32 @@ class BaseIndexer(object):
 		"""
 		raise NotImplementedError()
 
+	def flush(self):
+		"""Sends the pending documents, and waits until they are written.
+
+		Returns:
+			int, number of documents that could not be written.
+		"""
+		# Throughput of each replica, when reading from a replica pool
+		report = getattr(self._read_queue, 'report', None)
+		if report is not None:
+			report()
+
+		if self._sink is not None:
+			failed = self._sink.close()['failed_documents']
+			# Every acknowledgement is in
+			if self._fingerprints is not None:
+				self._fingerprints.close()
+			return failed
+
+		self._es_connector.force_bulk()
+		return 0
+
+	@abstractmethod
+	def recycle(self):
+		"""Releases the state grown by the indexing, while no chunk is in progress."""
+		raise NotImplementedError()
+
 	@abstractmethod
 	def index(self, start_time, read_chunk_size):
 		"""Indexes the buffered items.
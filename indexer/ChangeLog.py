@@ -0,0 +1,335 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""ChangeLog.py: Change log (outbox) table filled by triggers, followed to index the changes."""
+
+__author__      = "Ber Clausen"
+__copyright__   = "Copyright 2014, Planet Earth"
+
+import bisect
+import time
+from collections import OrderedDict
+
+# Threading
+import threading
+
+# SQLAlchemy
+import sqlalchemy
+
+# Utility functions
+from utils.utils import vprint
+
+
+# Change log operations: the root document must be indexed again, or deleted.
+UPSERT = 'upsert'
+DELETE = 'delete'
+
+
+class ChangeLog(object):
+	"""ChangeLog class.
+
+	Triggers on the source and related tables append the id of every root document they affect to the change
+	log, so followers can index the changes without scanning the tables (see `triggers`).
+
+	Columns:
+		id: Auto increment, the order of the changes.
+		root_id: Id of the affected source row, NULL for related rows without parent, which are skipped.
+		operation: UPSERT or DELETE.
+		changed_at: Time of the change.
+
+	Attributes:
+		table (sqlalchemy.Table): Change log table.
+	"""
+
+	table = None
+
+	def __init__(self, table):
+		"""Initialization.
+
+		Args:
+			table (sqlalchemy.Table): Bound change log table.
+		"""
+		self.table = table
+
+	@staticmethod
+	def define(name, metadata):
+		"""Defines the change log table, to create it with `metadata.create_all`.
+
+		Args:
+			name (string): Table name.
+			metadata (sqlalchemy.MetaData): Metadata.
+
+		Returns:
+			sqlalchemy.Table.
+		"""
+		return sqlalchemy.Table(name, metadata,
+			sqlalchemy.Column('id', sqlalchemy.Integer, primary_key=True, autoincrement=True),
+			sqlalchemy.Column('root_id', sqlalchemy.Integer),
+			sqlalchemy.Column('operation', sqlalchemy.String(6), nullable=False),
+			sqlalchemy.Column('changed_at', sqlalchemy.DateTime, server_default=sqlalchemy.func.current_timestamp()))
+
+	def poll(self, after, limit):
+		"""Gets the next changes.
+
+		Args:
+			after (int): Last change already read, None to start from the first one.
+			limit (int): Maximum number of changes.
+
+		Returns:
+			List of (id, root id, operation) tuples, in change order. The root id is None for related rows
+			without parent, they are returned anyway so they do not look like missing changes.
+		"""
+		table = self.table
+		query = sqlalchemy.select([table.c.id, table.c.root_id, table.c.operation])
+		if after is not None:
+			query = query.where(table.c.id > after)
+		query = query.order_by(table.c.id).limit(limit)
+
+		return [tuple(row) for row in table.bind.execute(query)]
+
+	def find(self, ranges, limit):
+		"""Gets the changes inside some id ranges.
+
+		Args:
+			ranges (list): Inclusive (low, high) change id ranges.
+			limit (int): Maximum number of changes.
+
+		Returns:
+			List of (id, root id, operation) tuples of the changes found, in change order.
+		"""
+		table = self.table
+		query = sqlalchemy.select([table.c.id, table.c.root_id, table.c.operation]) \
+			.where(sqlalchemy.or_(*[table.c.id.between(low, high) for low, high in ranges])) \
+			.order_by(table.c.id).limit(limit)
+
+		return [tuple(row) for row in table.bind.execute(query)]
+
+	def last(self):
+		"""Last change.
+
+		Returns:
+			int, None if the change log is empty.
+		"""
+		return self.table.bind.execute(sqlalchemy.select([sqlalchemy.func.max(self.table.c.id)])).scalar()
+
+	def purge(self, upto):
+		"""Deletes the changes already indexed.
+
+		Args:
+			upto (int): Last indexed change.
+		"""
+		self.table.bind.execute(self.table.delete().where(self.table.c.id <= upto))
+
+
+class Cursor(object):
+	"""Position of a follower in the change log.
+
+	Change ids are assigned when the changes are logged, but only visible once their transaction commits, so
+	a change may show up after later ones were already read. The ids skipped by the reads are kept as gaps,
+	and polled again until they show up, or `settle` seconds after a later change was read: by then their
+	transaction was rolled back, or the id was never used (auto increment steps, lost ids).
+
+	Gaps are id ranges, so a jump of the auto increment costs a single one, whatever its size. New gaps come
+	after the ones known, and found ids split the gap holding them, so the gaps stay in id order.
+
+	The offset only moves past the settled ids, so storing it never skips a change. Changes read past the
+	offset are read again after a restart, documents are indexed from the current rows, so it is harmless.
+
+	Attributes:
+		change_log (ChangeLog): Change log.
+		offset (int): Every change up to it was read or given up, None before the first read.
+		read (int): Last change read.
+		settle (float): Seconds a gap is waited for.
+		gaps (list): Inclusive (low, high, expiry) ranges of missing change ids, in id order, given up once their
+			expiry time is reached.
+	"""
+
+	# Gaps polled again at once, the first ones first.
+	max_gaps_polled = 1000
+
+	def __init__(self, change_log, offset=None, settle=5.0):
+		"""Initialization.
+
+		Args:
+			change_log (ChangeLog): Change log.
+			offset (int): Last change already indexed, None to start from the first one.
+			settle (float): Seconds a gap is waited for.
+		"""
+		self.change_log = change_log
+		self.offset = offset
+		self.read = offset
+		self.settle = settle
+		self.gaps = []
+
+	def poll(self, limit):
+		"""Gets the changes not read yet: the late ones filling gaps, then the ones after the last read.
+
+		Args:
+			limit (int): Maximum number of changes.
+
+		Returns:
+			List of (id, root id, operation) tuples, in change order, without the changes without root.
+		"""
+		expiry = time.time() + self.settle
+		changes = []
+		if self.gaps:
+			ranges = [(low, high) for low, high, _ in self.gaps[:self.max_gaps_polled]]
+			changes.extend(self.change_log.find(ranges, limit))
+			for change in changes:
+				self.fill(change[0])
+
+		for change in self.change_log.poll(self.read, max(limit - len(changes), 1)):
+			if self.read is not None and change[0] > self.read + 1:
+				self.gaps.append((self.read + 1, change[0] - 1, expiry))
+			self.read = change[0]
+			changes.append(change)
+
+		changes.sort()
+		return [change for change in changes if change[1] is not None]
+
+	def fill(self, id):
+		"""Removes a change id found late from its gap, splitting it.
+
+		Args:
+			id (int): Change id.
+		"""
+		i = bisect.bisect_right(self.gaps, (id, float('inf'))) - 1
+		if i < 0:
+			return
+		low, high, expiry = self.gaps[i]
+		if id > high:
+			return
+		self.gaps[i:i + 1] = [(start, end, expiry) for start, end in [(low, id - 1), (id + 1, high)] if start <= end]
+
+	def settled(self):
+		"""Moves the offset past the changes read and the gaps waited for long enough.
+
+		Returns:
+			int, offset.
+		"""
+		now = time.time()
+		self.gaps = [gap for gap in self.gaps if gap[2] > now]
+
+		self.offset = self.gaps[0][0] - 1 if self.gaps else self.read
+		return self.offset
+
+
+class Batch(object):
+	"""Batch of changes whose documents are waiting to be acknowledged.
+
+	Attributes:
+		last (int): Offset once the batch is acknowledged, every change up to it is read or given up.
+		pending (int): Number of documents not acknowledged yet.
+		failed (int): Number of documents given up.
+	"""
+
+	def __init__(self, last):
+		"""Initialization.
+
+		Args:
+			last (int): Offset once the batch is acknowledged.
+		"""
+		self.last = last
+		self.pending = 0
+		self.failed = 0
+		self._lock = threading.Lock()
+
+	def expect(self, count):
+		"""Sets the number of documents to wait for. Must be called before handing them to the sink.
+
+		Args:
+			count (int): Number of documents of the batch.
+		"""
+		self.pending = count
+
+	def done(self):
+		with self._lock:
+			return self.pending == 0
+
+	def __call__(self, success):
+		"""Acknowledges a document.
+
+		Args:
+			success (bool): Whether the document was written.
+		"""
+		with self._lock:
+			self.pending -= 1
+			if not success:
+				self.failed += 1
+
+
+def collapse(changes):
+	"""Collapses the changes by root document, the last operation wins.
+
+	Args:
+		changes (list): (id, root id, operation) tuples, in change order.
+
+	Returns:
+		OrderedDict of operations by root id, in order of first change.
+	"""
+	operations = OrderedDict()
+	for id, root_id, operation in changes:
+		operations[root_id] = operation
+	return operations
+
+
+def triggers(change_log_name, source_table, relationships=False, primary_key='id'):
+	"""Renders the triggers filling the change log.
+
+	The statements are valid for both MySQL and SQLite. A source row change marks its own document, a change
+	of a one to many or one to one row marks its parent document (both of them when the row moves), and a change
+	of a many to one or self referential related row marks the documents pointing to it.
+
+	Many to many relationships are not tracked: their link tables can not be told apart from the relationship
+	definition alone.
+
+	Args:
+		change_log_name (string): Change log table name.
+		source_table (string): Source table name.
+		relationships (dict): Relationships of the source table, same format as the connectors.
+		primary_key (string): Primary key column of the source table.
+
+	Returns:
+		List of `CREATE TRIGGER` statements.
+	"""
+	def insert(root, operation):
+		return "INSERT INTO {:s} (root_id, operation) VALUES ({:s}, '{:s}')".format(change_log_name, root, operation)
+
+	def fan_out(row, foreign_key):
+		return "INSERT INTO {:s} (root_id, operation) SELECT {:s}, '{:s}' FROM {:s} WHERE {:s} = {:s}.{:s}".format(
+			change_log_name, primary_key, UPSERT, source_table, foreign_key, row, primary_key)
+
+	# Statements by (table, event), in definition order
+	statements = OrderedDict()
+	def add(table, event, statement):
+		statements.setdefault((table, event), []).append(statement)
+
+	add(source_table, 'INSERT', insert('NEW.' + primary_key, UPSERT))
+	add(source_table, 'UPDATE', insert('NEW.' + primary_key, UPSERT))
+	add(source_table, 'DELETE', insert('OLD.' + primary_key, DELETE))
+
+	for kind in ['one_to_many', 'one_to_one', 'many_to_one', 'self_referential', 'many_to_many']:
+		for relationship_name, relationship in (relationships or {}).get(kind, {}).iteritems():
+			relationship_table = relationship['table'] if 'table' in relationship else relationship_name
+			foreign_key = relationship.get('foreign_key')
+
+			if kind in ['one_to_many', 'one_to_one']:
+				add(relationship_table, 'INSERT', insert('NEW.' + foreign_key, UPSERT))
+				add(relationship_table, 'UPDATE', insert('OLD.' + foreign_key, UPSERT))
+				add(relationship_table, 'UPDATE', insert('NEW.' + foreign_key, UPSERT))
+				add(relationship_table, 'DELETE', insert('OLD.' + foreign_key, UPSERT))
+			elif kind == 'many_to_one':
+				add(relationship_table, 'UPDATE', fan_out('NEW', foreign_key))
+				add(relationship_table, 'DELETE', fan_out('OLD', foreign_key))
+			elif kind == 'self_referential':
+				add(source_table, 'UPDATE', fan_out('NEW', foreign_key))
+				add(source_table, 'DELETE', fan_out('OLD', foreign_key))
+			else:
+				vprint('Many to many relationship {:s} is not tracked by the change log.'.format(relationship_name))
+
+	ddl = []
+	for (table, event), table_statements in statements.iteritems():
+		ddl.append('CREATE TRIGGER {:s}_{:s}_{:s} AFTER {:s} ON {:s} FOR EACH ROW BEGIN {:s}; END'.format(
+			change_log_name, table, event.lower(), event, table, '; '.join(table_statements)))
+
+	return ddl
@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Checkpoint.py: Persisted id range checkpoints, used to resume interrupted runs."""
+
+__author__      = "Ber Clausen"
+__copyright__   = "Copyright 2014, Planet Earth"
+
+import sqlite3
+
+# Threading
+import threading
+
+
+class Checkpoint(object):
+	"""Checkpoint class.
+
+	Keeps in a SQLite file the id ranges whose documents were acknowledged, by index and table. A range
+	(after, upper] covers every id greater than `after` (None means from the first one) up to `upper`, including
+	the ids that do not exist, so consecutive ranges can be merged into segments.
+
+	The file can be shared by several processes.
+
+	Attributes:
+		path (string): State file path.
+		key (string): Key of the index and table in the state file.
+	"""
+
+	def __init__(self, path, es_index, table_name):
+		"""Initialization.
+
+		Args:
+			path (string): State file path.
+			es_index (string): Elasticsearch index.
+			table_name (string): Source table name.
+		"""
+		self.path = path
+		self.key = '{:s}/{:s}'.format(es_index, table_name)
+		self._lock = threading.Lock()
+
+		self._connection = sqlite3.connect(path, timeout=60, check_same_thread=False)
+		self._connection.execute('PRAGMA journal_mode=WAL')
+		self._connection.execute('PRAGMA synchronous=NORMAL')
+		self._connection.execute(
+			'CREATE TABLE IF NOT EXISTS ranges (key TEXT, after INTEGER, upper INTEGER)')
+		self._connection.execute(
+			'CREATE INDEX IF NOT EXISTS ranges_key ON ranges (key, after)')
+		self._connection.commit()
+
+	def complete(self, after, upper):
+		"""Stores a range whose documents were acknowledged.
+
+		Args:
+			after (int): Id before the range, None if the range starts at the first id.
+			upper (int): Last id of the range.
+		"""
+		with self._lock:
+			self._connection.execute('INSERT INTO ranges VALUES (?, ?, ?)', (self.key, after, upper))
+			self._connection.commit()
+
+	def segments(self):
+		"""Completed ranges, merged.
+
+		Returns:
+			Sorted list of (after, upper) tuples that do not overlap.
+		"""
+		with self._lock:
+			rows = self._connection.execute(
+				'SELECT after, upper FROM ranges WHERE key = ? ORDER BY after IS NOT NULL, after',
+				(self.key,)).fetchall()
+
+		segments = []
+		for after, upper in rows:
+			if segments and (after is None or segments[-1][1] >= after):
+				if upper > segments[-1][1]:
+					segments[-1] = (segments[-1][0], upper)
+			else:
+				segments.append((after, upper))
+
+		return segments
+
+	def clear(self):
+		"""Forgets the completed ranges, once the run finishes or when starting afresh."""
+		with self._lock:
+			self._connection.execute('DELETE FROM ranges WHERE key = ?', (self.key,))
+			self._connection.commit()
+
+	def close(self):
+		with self._lock:
+			self._connection.close()
+
+
+class Chunk(object):
+	"""Chunk of ids whose documents are waiting to be acknowledged.
+
+	Once every document is acknowledged, the range is completed in the checkpoint. A failed document leaves the
+	range out, so it is indexed again when resuming.
+	"""
+
+	def __init__(self, checkpoint, after, upper):
+		"""Initialization.
+
+		Args:
+			checkpoint (Checkpoint): Checkpoint.
+			after (int): Id before the chunk, None if the chunk starts at the first id.
+			upper (int): Last id of the chunk.
+		"""
+		self.checkpoint = checkpoint
+		self.after = after
+		self.upper = upper
+		self.pending = 0
+		self.failed = False
+		self._lock = threading.Lock()
+
+	def expect(self, count):
+		"""Sets the number of documents to wait for. Must be called before handing them to the sink.
+
+		Args:
+			count (int): Number of documents of the chunk.
+		"""
+		self.pending = count
+		if count == 0:
+			self.checkpoint.complete(self.after, self.upper)
+
+	def __call__(self, success):
+		"""Acknowledges a document.
+
+		Args:
+			success (bool): Whether the document was written.
+		"""
+		with self._lock:
+			self.pending -= 1
+			self.failed = self.failed or not success
+			done = self.pending == 0 and not self.failed
+
+		if done:
+			self.checkpoint.complete(self.after, self.upper)
+
+
+def skip_segments(ids, segments):
+	"""Filters out the ids inside completed segments.
+
+	Args:
+		ids: Ascending ids.
+		segments (list): Sorted (after, upper) segments.
+
+	Returns:
+		Generator of ids.
+	"""
+	segments = iter(segments)
+	segment = next(segments, None)
+	for id in ids:
+		while segment is not None and segment[1] < id:
+			segment = next(segments, None)
+		if segment is not None and (segment[0] is None or segment[0] < id):
+			continue
+		yield id
@@ -0,0 +1,220 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Fingerprints.py: Persisted document fingerprints, used to skip the documents that did not change."""
+
+__author__      = "Ber Clausen"
+__copyright__   = "Copyright 2014, Planet Earth"
+
+import hashlib
+import json
+import sqlite3
+
+# Threading
+import threading
+
+# Base sink
+from sinks.BaseSink import encode_default
+
+# Utility functions
+from utils.utils import vprint
+
+# Metrics
+from utils.Metrics import metrics
+
+
+# Maximum number of parameters of a SQLite statement.
+MAX_PARAMETERS = 999
+
+
+class Fingerprints(object):
+	"""Fingerprints class.
+
+	Keeps in a SQLite file a hash of the source of every document written to an index, by id. A document whose
+	hash did not change since it was last written is skipped.
+
+	A fingerprint is only recorded once the sink acknowledges its document, so a document that failed is
+	never skipped. Forgetting fingerprints is always safe, it only makes the documents be sent again: the file
+	can be deleted at any time.
+
+	Fingerprints are kept by index name. A rebuild writes to a new index version, which starts without any,
+	and once the alias is moved to the version its fingerprints replace the ones of the alias (see `promote`).
+
+	The file can be shared by several processes.
+
+	Attributes:
+		path (string): State file path.
+		es_index (string): Elasticsearch index, or alias, the documents are written to.
+		batch_size (int): Number of acknowledged fingerprints written at once.
+		checked (int): Number of documents checked.
+		skipped (int): Number of documents skipped.
+	"""
+
+	batch_size = 1000
+
+	def __init__(self, path, es_index, batch_size=None):
+		"""Initialization.
+
+		Args:
+			path (string): State file path.
+			es_index (string): Elasticsearch index, or alias, the documents are written to.
+			batch_size (int): Number of acknowledged fingerprints written at once.
+		"""
+		self.path = path
+		self.es_index = es_index
+		if batch_size is not None:
+			self.batch_size = batch_size
+		self.checked = 0
+		self.skipped = 0
+
+		# Sorted keys, so the same document always has the same source
+		self._encoder = json.JSONEncoder(default=encode_default, separators=(',', ':'), sort_keys=True)
+		self._lock = threading.Lock()
+		self._pending = []
+
+		self._connection = sqlite3.connect(path, timeout=60, check_same_thread=False)
+		self._connection.execute('PRAGMA journal_mode=WAL')
+		self._connection.execute('PRAGMA synchronous=NORMAL')
+		self._connection.execute(
+			'CREATE TABLE IF NOT EXISTS fingerprints (es_index TEXT, id INTEGER, digest BLOB, PRIMARY KEY (es_index, id))')
+		self._connection.commit()
+
+	def source(self, document):
+		"""Encodes a document, with its keys sorted.
+
+		Args:
+			document (dict): Document.
+
+		Returns:
+			Tuple with the source and its digest.
+		"""
+		source = self._encoder.encode(document)
+		return source, hashlib.sha1(source).digest()
+
+	def lookup(self, ids):
+		"""Fingerprints of some documents.
+
+		Args:
+			ids (list): Document ids.
+
+		Returns:
+			Dict with the digest of each id having a fingerprint.
+		"""
+		digests = {}
+		with self._lock:
+			for i in range(0, len(ids), MAX_PARAMETERS - 1):
+				part = ids[i:i + MAX_PARAMETERS - 1]
+				rows = self._connection.execute(
+					'SELECT id, digest FROM fingerprints WHERE es_index = ? AND id IN ({:s})'.format(
+						', '.join('?' * len(part))),
+					[self.es_index] + list(part)).fetchall()
+				digests.update((id, str(digest)) for id, digest in rows)
+		return digests
+
+	def changed(self, documents):
+		"""Filters out the documents that did not change since they were last written.
+
+		Args:
+			documents (list): (id, document) tuples.
+
+		Returns:
+			List with the (id, document, source, digest) tuple of every changed document.
+		"""
+		digests = self.lookup([id for id, document in documents])
+
+		changed = []
+		for id, document in documents:
+			source, digest = self.source(document)
+			if digests.get(id) != digest:
+				changed.append((id, document, source, digest))
+
+		skipped = len(documents) - len(changed)
+		with self._lock:
+			self.checked += len(documents)
+			self.skipped += skipped
+		metrics.add('skipped_documents', skipped)
+
+		return changed
+
+	def acknowledge(self, id, digest, ack=None):
+		"""Builds the acknowledgement callback of a document, recording its fingerprint once written.
+
+		Args:
+			id (int): Document id.
+			digest (string): Digest of the document source.
+			ack: Acknowledgement callback to chain, if any.
+
+		Returns:
+			Callback taking whether the document was written.
+		"""
+		def callback(success):
+			if success:
+				self.record(id, digest)
+			if ack is not None:
+				ack(success)
+		return callback
+
+	def record(self, id, digest):
+		"""Records the fingerprint of a written document, stored with the next batch.
+
+		Args:
+			id (int): Document id.
+			digest (string): Digest of the document source.
+		"""
+		with self._lock:
+			self._pending.append((self.es_index, id, sqlite3.Binary(digest)))
+			if len(self._pending) >= self.batch_size:
+				self.commit()
+
+	def forget(self, ids):
+		"""Forgets the fingerprints of some documents, before they are deleted or when their state is unknown.
+
+		Args:
+			ids (list): Document ids.
+		"""
+		with self._lock:
+			self.commit()
+			self._connection.executemany('DELETE FROM fingerprints WHERE es_index = ? AND id = ?',
+				[(self.es_index, id) for id in ids])
+			self._connection.commit()
+
+	def commit(self):
+		"""Stores the recorded fingerprints. Must be called holding the lock."""
+		if self._pending:
+			self._connection.executemany('INSERT OR REPLACE INTO fingerprints VALUES (?, ?, ?)', self._pending)
+			self._connection.commit()
+			self._pending = []
+
+	def clear(self, es_index=None):
+		"""Forgets every fingerprint of an index, when it is created or deleted.
+
+		Args:
+			es_index (string): Elasticsearch index, this one if None.
+		"""
+		with self._lock:
+			self.commit()
+			self._connection.execute('DELETE FROM fingerprints WHERE es_index = ?', (es_index or self.es_index,))
+			self._connection.commit()
+
+	def promote(self, alias):
+		"""Makes the fingerprints of this index the ones of an alias, once the alias is moved to it.
+
+		Args:
+			alias (string): Alias now pointing to this index.
+		"""
+		with self._lock:
+			self.commit()
+			self._connection.execute('DELETE FROM fingerprints WHERE es_index = ?', (alias,))
+			self._connection.execute('UPDATE fingerprints SET es_index = ? WHERE es_index = ?', (alias, self.es_index))
+			self._connection.commit()
+		self.es_index = alias
+
+	def close(self):
+		"""Stores the recorded fingerprints, and reports the skipped documents."""
+		with self._lock:
+			self.commit()
+			self._connection.close()
+
+		if self.checked:
+			vprint('Fingerprints: {:d}/{:d} unchanged documents skipped ({:.2%}).'.format(
+				self.skipped, self.checked, float(self.skipped) / self.checked))
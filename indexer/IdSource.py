@@ -0,0 +1,460 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""IdSource.py: Sources of ids used to populate the indexer buffer."""
+
+__author__      = "Ber Clausen"
+__copyright__   = "Copyright 2014, Planet Earth"
+
+import datetime
+from abc import ABCMeta, abstractmethod
+
+# SQLAlchemy
+import sqlalchemy
+
+# Errors
+from utils.errors import BadConfigError
+
+# Utility functions
+from utils.utils import vprint
+
+
+class BaseIdSource(object):
+	"""BaseIdSource class.
+
+	Produces the ids of the model that will be used as the entry point to construct the documents.
+
+	Queries are built with SQLAlchemy Core over the model table, so any connector can provide the model.
+
+	Attributes:
+		model: Model used as an entry point.
+		table (sqlalchemy.Table): Table of the model.
+		limit (int): Number of ids to produce.
+		where: Filter clause applied to the model.
+	"""
+
+	__metaclass__ = ABCMeta
+
+	model = None
+	table = None
+	limit = None
+	where = True
+
+	def __init__(self, model, limit=None, where=True, window_size=None):
+		"""Initialization.
+
+		Args:
+			model: Model used as an entry point, either a mapped class or a bound `sqlalchemy.Table`.
+			limit (int): Number of ids to produce, None or 0 means no limit.
+			where: Filter clause applied to the model.
+			window_size (int): Number of ids fetched per query, only used by windowed sources.
+		"""
+		self.model = model
+		self.table = getattr(model, '_table', model)
+		self.limit = limit if limit not in [None, 0] else None
+		self.where = where
+
+	@abstractmethod
+	def total(self):
+		"""Number of ids that will be produced.
+
+		Returns:
+			int.
+		"""
+		raise NotImplementedError()
+
+	@abstractmethod
+	def __iter__(self):
+		"""Produces the ids.
+
+		Returns:
+			Generator of ids.
+		"""
+		raise NotImplementedError()
+
+
+class BufferIdSource(BaseIdSource):
+	"""Single query id source.
+
+	Counts the elements and opens a single query over the ids. The MySQLdb driver buffers the whole result
+	client-side, so it is only advisable for small tables.
+
+	The ids are ordered like every other source: checkpoints assume ascending ids, and a covering secondary
+	index could otherwise return them in any order.
+	"""
+
+	def total(self):
+		table = self.table
+		total = table.bind.execute(
+			sqlalchemy.select([sqlalchemy.func.count(table.c.id)]).where(self.where)).scalar()
+		return min(total, self.limit) if self.limit is not None else total
+
+	def __iter__(self):
+		table = self.table
+		query = sqlalchemy.select([table.c.id]).where(self.where).order_by(table.c.id)
+		if self.limit is not None:
+			query = query.limit(self.limit)
+
+		for row in table.bind.execute(query):
+			yield row[0]
+
+
+class KeysetIdSource(BaseIdSource):
+	"""Keyset paginated id source.
+
+	Walks the primary key in windows (`WHERE id > last ORDER BY id LIMIT n`), so only one window of ids is held
+	in memory, and the first ids are available without scanning the whole table.
+
+	http://www.sqlalchemy.org/trac/wiki/UsageRecipes/WindowedRangeQuery
+	http://use-the-index-luke.com/no-offset
+
+	Attributes:
+		window_size (int): Number of ids fetched per query.
+	"""
+
+	window_size = 10000
+
+	def __init__(self, model, limit=None, where=True, window_size=None):
+		"""Initialization.
+
+		Args:
+			model: Model used as an entry point.
+			limit (int): Number of ids to produce, None or 0 means no limit.
+			where: Filter clause applied to the model.
+			window_size (int): Number of ids fetched per query.
+		"""
+		super(KeysetIdSource, self).__init__(model, limit, where, window_size)
+
+		if window_size is not None:
+			if window_size < 1:
+				raise BadConfigError('The id window size must be positive.')
+			self.window_size = window_size
+
+	def total(self):
+		"""Estimated number of ids that will be produced.
+
+		Avoids a full `COUNT(*)`: uses the table statistics when available (MySQL), otherwise the span of the
+		primary key, which only needs two index lookups.
+
+		Returns:
+			int.
+		"""
+		estimate = self.estimate_from_statistics() or self.estimate_from_span()
+		return min(estimate, self.limit) if self.limit is not None else estimate
+
+	def estimate_from_statistics(self):
+		"""Estimated number of rows according to the MySQL table statistics.
+
+		Returns:
+			int, None if the statistics are not available.
+		"""
+		bind = self.table.bind
+		if bind.dialect.name != 'mysql' or self.where is not True:
+			return None
+
+		statement = sqlalchemy.text(
+			'SELECT TABLE_ROWS FROM information_schema.TABLES '
+			'WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = :table_name')
+		return bind.execute(statement, table_name=self.table.name).scalar() or None
+
+	def estimate_from_span(self):
+		"""Estimated number of rows according to the primary key span.
+
+		Returns:
+			int.
+		"""
+		table = self.table
+		lower, upper = table.bind.execute(sqlalchemy.select([
+			sqlalchemy.func.min(table.c.id),
+			sqlalchemy.func.max(table.c.id)]).where(self.where)).first()
+
+		if lower is None:
+			return 0
+		return upper - lower + 1
+
+	def window(self, last, window_size, upper=None):
+		"""Query of the ids of the next window.
+
+		Args:
+			last: Last id of the previous window, None for the first one.
+			window_size (int): Number of ids to fetch.
+			upper: Last id that may be fetched, None for no bound.
+
+		Returns:
+			SQLAlchemy Core selectable.
+		"""
+		table = self.table
+		query = sqlalchemy.select([table.c.id]).where(self.where)
+		if last is not None:
+			query = query.where(table.c.id > last)
+		if upper is not None:
+			query = query.where(table.c.id <= upper)
+		return query.order_by(table.c.id).limit(window_size)
+
+	def fetch(self, last, window_size, upper=None):
+		"""Fetches the ids of the next window.
+
+		Args:
+			last: Last id of the previous window, None for the first one.
+			window_size (int): Number of ids to fetch.
+			upper: Last id that may be fetched, None for no bound.
+
+		Returns:
+			List of ids.
+		"""
+		return [row[0] for row in self.table.bind.execute(self.window(last, window_size, upper))]
+
+	def __iter__(self):
+		remaining = self.limit
+		last = None
+
+		while remaining is None or remaining > 0:
+			window_size = self.window_size if remaining is None else min(self.window_size, remaining)
+
+			ids = self.fetch(last, window_size)
+
+			for id in ids:
+				yield id
+
+			if len(ids) < window_size:
+				return
+
+			last = ids[-1]
+			if remaining is not None:
+				remaining -= len(ids)
+
+
+class IncrementalIdSource(KeysetIdSource):
+	"""Incremental id source.
+
+	Produces the ids of the rows whose watermark column changed inside the (since, until] window, and the ids of
+	the parents of the changed child rows, walking them in keyset windows.
+
+	`until` is fixed when the run starts, so rows changing while indexing are left for the next run. A row
+	stamped before `until` but committed after the run started is only seen by the next run, so the window
+	starts `overlap` before `since`, and the rows changed around the previous high-water mark are indexed again.
+
+	Attributes:
+		column (string): Watermark column of the source table.
+		since: Last stored high-water mark, None to select every row.
+		until: High-water mark of this run.
+		overlap (float): Seconds the window starts before `since`, in watermark units for numeric columns.
+		children (list): (table name, foreign key, watermark column) tuples of the child tables.
+	"""
+
+	column = 'updated_at'
+	since = None
+	until = None
+	overlap = 0
+	children = ()
+
+	def __init__(self, model, limit=None, where=True, window_size=None, column=None, since=None, until=None,
+		overlap=None, children=()):
+		"""Initialization.
+
+		Args:
+			model: Model used as an entry point.
+			limit (int): Number of ids to produce, None or 0 means no limit.
+			where: Filter clause applied to the model.
+			window_size (int): Number of ids fetched per query.
+			column (string): Watermark column of the source table.
+			since: Last stored high-water mark, None to select every row.
+			until: High-water mark of this run, None to compute it.
+			overlap (float): Seconds the window starts before `since`, in watermark units for numeric columns.
+			children (list): (table name, foreign key, watermark column) tuples of the child tables.
+		"""
+		super(IncrementalIdSource, self).__init__(model, limit, where, window_size)
+
+		if column is not None:
+			self.column = column
+		if self.column not in self.table.c:
+			raise BadConfigError('No watermark column {:s} found in {:s}.'.format(self.column, self.table.fullname))
+
+		self.children = []
+		for table_name, foreign_key, child_column in children:
+			child = sqlalchemy.Table(table_name, self.table.metadata, autoload=True)
+			if child_column not in child.c:
+				vprint('No watermark column {:s} found in {:s}, its changes are ignored.'.format(child_column, table_name))
+				continue
+			self.children.append((child, child.c[foreign_key], child.c[child_column]))
+
+		if overlap is not None:
+			if overlap < 0:
+				raise BadConfigError('The watermark overlap can not be negative.')
+			self.overlap = overlap
+
+		self.since = since
+		self.until = until if until is not None else self.high_water_mark()
+
+	def lower_bound(self):
+		"""Exclusive lower bound of the watermark window: `since`, moved back by the overlap.
+
+		Returns:
+			Watermark value, None to select every row.
+		"""
+		if self.since is None or not self.overlap:
+			return self.since
+		if isinstance(self.since, datetime.date):
+			return self.since - datetime.timedelta(seconds=self.overlap)
+		return self.since - self.overlap
+
+	def high_water_mark(self):
+		"""Highest watermark value of the source and child tables.
+
+		Returns:
+			Watermark value, None if every table is empty.
+		"""
+		bind = self.table.bind
+		marks = [bind.execute(sqlalchemy.select([sqlalchemy.func.max(self.table.c[self.column])])).scalar()]
+		for child, foreign_key, child_column in self.children:
+			marks.append(bind.execute(sqlalchemy.select([sqlalchemy.func.max(child_column)])).scalar())
+
+		marks = [mark for mark in marks if mark is not None]
+		return max(marks) if marks else None
+
+	def changed(self, column):
+		"""Clause selecting the rows changed inside the watermark window.
+
+		Args:
+			column (sqlalchemy.Column): Watermark column.
+
+		Returns:
+			SQLAlchemy clause.
+		"""
+		clauses = []
+		lower = self.lower_bound()
+		if lower is not None:
+			clauses.append(column > lower)
+		if self.until is not None:
+			clauses.append(column <= self.until)
+		return sqlalchemy.and_(*clauses) if clauses else sqlalchemy.true()
+
+	def changed_ids(self, last=None, upper=None, limit=None):
+		"""Subquery of the changed ids: changed source rows, and parents of changed child rows.
+
+		The id bounds and the limit are applied to every branch of the union, so a window only reads its own
+		ids instead of every changed row. Each bounded branch is wrapped in a subquery, as not every database
+		takes an ORDER BY and LIMIT inside a UNION.
+
+		Args:
+			last (int): Exclusive lower bound of the ids, None for no bound.
+			upper (int): Inclusive upper bound of the ids, None for no bound.
+			limit (int): Number of ids of each branch, None for no limit.
+
+		Returns:
+			Aliased SQLAlchemy Core selectable with an `id` column.
+		"""
+		table = self.table
+		bounds = []
+		if last is not None:
+			bounds.append(table.c.id > last)
+		if upper is not None:
+			bounds.append(table.c.id <= upper)
+
+		queries = [sqlalchemy.select([table.c.id.label('id')]).where(
+			sqlalchemy.and_(self.where, self.changed(table.c[self.column]), *bounds))]
+
+		# Joining the parents applies the source filter and leaves out orphans.
+		for child, foreign_key, child_column in self.children:
+			queries.append(sqlalchemy.select([table.c.id.label('id')])
+				.select_from(child.join(table, table.c.id == foreign_key))
+				.where(sqlalchemy.and_(self.where, self.changed(child_column), *bounds)))
+
+		if limit is not None:
+			queries = [query.distinct().order_by(table.c.id).limit(limit).alias() for query in queries]
+			queries = [sqlalchemy.select([query.c.id]) for query in queries]
+
+		return sqlalchemy.union(*queries).alias('changed')
+
+	def total(self):
+		if self.until is None:
+			return 0
+
+		changed = self.changed_ids()
+		total = self.table.bind.execute(sqlalchemy.select([sqlalchemy.func.count()]).select_from(changed)).scalar()
+		return min(total, self.limit) if self.limit is not None else total
+
+	def window(self, last, window_size, upper=None):
+		changed = self.changed_ids(last, upper, window_size)
+		return sqlalchemy.select([changed.c.id]).order_by(changed.c.id).limit(window_size)
+
+	def fetch(self, last, window_size, upper=None):
+		if self.until is None:
+			return []
+
+		return super(IncrementalIdSource, self).fetch(last, window_size, upper)
+
+	def __iter__(self):
+		if self.until is None:
+			return iter([])
+
+		return super(IncrementalIdSource, self).__iter__()
+
+
+id_sources = {
+	'buffer': BufferIdSource,
+	'incremental': IncrementalIdSource,
+	'keyset': KeysetIdSource,
+}
+
+
+def id_ranges(model, parts, where=True):
+	"""Splits the primary key span of a model into contiguous ranges.
+
+	Args:
+		model: Model, either a mapped class or a bound `sqlalchemy.Table`.
+		parts (int): Number of ranges.
+		where: Filter clause applied to the model.
+
+	Returns:
+		List of (lower, upper) inclusive bounds, empty if the model has no rows.
+	"""
+	table = getattr(model, '_table', model)
+	lower, upper = table.bind.execute(sqlalchemy.select([
+		sqlalchemy.func.min(table.c.id),
+		sqlalchemy.func.max(table.c.id)]).where(where)).first()
+
+	if lower is None:
+		return []
+
+	size = max((upper - lower + 1) // parts, 1)
+	ranges = []
+	while lower <= upper and len(ranges) < parts - 1:
+		ranges.append((lower, min(lower + size - 1, upper)))
+		lower += size
+	if lower <= upper:
+		ranges.append((lower, upper))
+
+	return ranges
+
+def id_quantiles(model, parts, where=True):
+	"""Splits the ids of a model into contiguous ranges holding about the same number of rows.
+
+	Unlike `id_ranges`, skewed or sparse ids are split evenly. Each boundary is looked up with an offset over
+	the primary key index, so it costs a count and an index scan per range.
+
+	Args:
+		model: Model, either a mapped class or a bound `sqlalchemy.Table`.
+		parts (int): Number of ranges.
+		where: Filter clause applied to the model.
+
+	Returns:
+		List of (lower, upper) inclusive bounds, empty if the model has no rows.
+	"""
+	table = getattr(model, '_table', model)
+	bind = table.bind
+	total = bind.execute(sqlalchemy.select([sqlalchemy.func.count(table.c.id)]).where(where)).scalar()
+	if not total:
+		return []
+
+	parts = min(parts, total)
+	query = sqlalchemy.select([table.c.id]).where(where).order_by(table.c.id).limit(1)
+	lowers = [bind.execute(query.offset(total * i // parts)).scalar() for i in range(parts)]
+	upper = bind.execute(sqlalchemy.select([sqlalchemy.func.max(table.c.id)]).where(where)).scalar()
+
+	ranges = []
+	for lower, next_lower in zip(lowers, lowers[1:] + [upper + 1]):
+		if lower < next_lower:
+			ranges.append((lower, next_lower - 1))
+
+	return ranges
@@ -8,6 +8,8 @@ __copyright__   = "Copyright 2014, Planet Earth"
 
 from BaseIndexer import BaseIndexer
 
+import collections
+import gc
 import itertools # iterate faster
 import time
 
@@ -26,6 +28,24 @@ from utils.errors import (
 # Utility functions
 from utils.utils import vprint, tprint
 
+# Metrics
+from utils.Metrics import metrics
+
+# Id sources
+from IdSource import id_sources, id_ranges, id_quantiles
+
+# Scheduler
+from Scheduler import RangeScheduler, subtract
+
+# Pipeline
+from Pipeline import Pipeline
+
+# Checkpoints
+from Checkpoint import Chunk, skip_segments
+
+# Change log
+from ChangeLog import Batch, Cursor, collapse, DELETE, UPSERT
+
 
 class Indexer(BaseIndexer):
 	"""Indexer class"""
@@ -36,6 +56,11 @@ class Indexer(BaseIndexer):
 	def fill_buffer(self, model, limit=None):
 		"""Populates the buffer.
 
+		The buffer is a generator of ids produced by the configured id source. The keyset source walks the
+		primary key in windows, the buffer source keeps the former single query behaviour. When an id range
+		is set, only the ids inside it are produced. When resuming, the ids inside the checkpointed ranges are
+		skipped.
+
 		http://stackoverflow.com/questions/7389759/memory-efficient-built-in-sqlalchemy-iterator-generator
 		http://www.sqlalchemy.org/trac/wiki/UsageRecipes/WindowedRangeQuery
 
@@ -45,21 +70,79 @@ class Indexer(BaseIndexer):
 		"""
 		where = True
 
-		total = model.session.query(sqlalchemy.func.count(model.id)).filter(where).scalar()
-		self.index_total = min(total, limit) if limit not in [None, 0] else total
+		table = getattr(model, '_table', model)
+
+		# Id before the first one to index
+		start = None
+
+		if self._id_range is not None:
+			lower, upper = self._id_range
+			where = sqlalchemy.and_(table.c.id >= lower, table.c.id <= upper)
+			start = lower - 1
+
+		# Skip the ranges completed by the interrupted run
+		segments = []
+		if self._checkpoint is not None and self._resume:
+			segments = self._checkpoint.segments()
+			for after, upper in segments:
+				if (after is None or (start is not None and after <= start)) and (start is None or upper > start):
+					vprint('Resuming after id {:d}.'.format(upper))
+					where = sqlalchemy.and_(where, table.c.id > upper)
+					start = upper
+					break
+
+		self._last_id = start
+
+		if self._id_source not in id_sources:
+			raise BadConfigError('Unknown id source: {:s}.'.format(self._id_source))
+
+		id_source = id_sources[self._id_source](model, limit, where,
+			window_size=self._id_window_size,
+			**self._id_source_options)
+
+		self._ids = id_source
+		self._where = where
+		self._segments = segments
+		self._scheduler = None
+
+		self.index_total = id_source.total()
 		vprint('Number of elements to index: ' + str(self.index_total))
 
 		vprint('Populating the buffer...')
 
-		query = model.filter(where)
-		if limit not in [None, 0]:
-			query = query.limit(limit)
-		self.index_buffer = query.values(model.id)
+		self.index_buffer = skip_segments(iter(id_source), segments) if segments else iter(id_source)
 
 		vprint('Buffer populated.')
 
+	def scheduler(self):
+		"""Range scheduler shared by the indexing threads, built by the first one.
+
+		Returns:
+			Scheduler.RangeScheduler, None if the id source has no windows, then the ids are taken from the
+			buffer.
+		"""
+		if not hasattr(self._ids, 'fetch'):
+			return None
+
+		with self._lock:
+			if self._scheduler is None:
+				split = id_quantiles if self._id_split == 'quantiles' else id_ranges
+				ranges = [(lower - 1, upper) for lower, upper in split(self._ids.model, self._id_split_parts, self._where)]
+				if self._segments:
+					ranges = subtract(ranges, self._segments)
+				vprint('Scheduling {:d} id ranges.'.format(len(ranges)))
+				self._scheduler = RangeScheduler(self._ids, ranges, self._ids.limit)
+
+		return self._scheduler
+
 	def index(self, start_time=time.time(), read_chunk_size=None):
-		"""Indexes the buffered items."""
+		"""Indexes the buffered items.
+
+		With windowed id sources, every thread takes its ids from its own range (see Scheduler.RangeScheduler),
+		so threads do not share a lock. Otherwise the ids are taken from the shared buffer.
+
+		An error stops the thread, and is recorded (see BaseIndexer.fail), the other threads go on.
+		"""
 
 		process_name = threading.current_thread().getName()
 
@@ -71,65 +154,416 @@ class Indexer(BaseIndexer):
 		# Sync threads
 		time.sleep(0.5)
 
-		# Items to be indexed
-		buffer = self.index_buffer
+		try:
+			while True:
+				taken = self.take(read_chunk_size)
+				if taken is None:
+					break
 
-		# Number of elements to index
-		total = self.index_total
+				self.process(taken, start_time)
 
-		es_connector = self._es_connector
-		es_index = self._es_index
-		es_type = self._es_type
-		read_queue = self._read_queue
+		except Exception, e:
+			self.fail(e)
+		except (KeyboardInterrupt, SystemExit):
+			exit(0)
+
+		tprint(process_name, 'I\'m dead!')
+
+	def take(self, read_chunk_size=None):
+		"""Takes the next chunk of ids, from the range scheduler, or from the shared buffer.
+
+		Args:
+			read_chunk_size (integer): Number of ids to take.
 
+		Returns:
+			Tuple with the id before the chunk (None at the first one), the last id covered by the chunk and the
+			ids, None once there are no ids left.
+		"""
+		process_name = threading.current_thread().getName()
+
+		if read_chunk_size is None:
+			read_chunk_size = self.read_chunk_size
+
+		scheduler = self._scheduler if self._scheduler is not None else self.scheduler()
+
+		if scheduler is not None:
+			with metrics.time('id_fetch'):
+				taken = scheduler.next(read_chunk_size)
+			if taken is None:
+				tprint(process_name, 'No ranges left...')
+				return None
+			(after, upper), model_ids = taken
+			return after, upper, model_ids
+
+		if self.buffer_empty:
+			return None
+
+		model_ids = []
+
+		fetch_start = time.time()
 		try:
-			while not self.buffer_empty:
-				model_ids = []
+			self._lock.acquire()
+			after = self._last_id
+			for _ in itertools.repeat(None, read_chunk_size):
+				model_ids.append(next(self.index_buffer))
+		except StopIteration:
+			self.buffer_empty = True
+			tprint(process_name, 'Empty buffer...')
+			if len(model_ids) == 0:
+				return None
+			tprint(process_name, '... terminating')
+		finally:
+			if model_ids:
+				self._last_id = model_ids[-1]
+			self._lock.release()
+			metrics.observe('id_fetch', time.time() - fetch_start)
+
+		return after, model_ids[-1], model_ids
+
+	def process(self, taken, start_time):
+		"""Reads, builds and writes a chunk of ids.
 
-				try:
-					self._lock.acquire()
-					for _ in itertools.repeat(None, read_chunk_size):
-						model_ids.append(next(buffer)[0])
-				except StopIteration:
-					self.buffer_empty = True
-					tprint(process_name, 'Empty buffer...')
-					if len(model_ids) == 0:
-						break
-					tprint(process_name, '... terminating')
-				finally:
-					self._lock.release()
+		Args:
+			taken (tuple): Chunk taken with Indexer.take.
+			start_time (float): Start time in seconds.
 
-				db_connector = read_queue.get(True)
+		Returns:
+			int, number of indexed items so far.
+		"""
+		after, upper, model_ids = taken
 
-				model = db_connector._model
+		with self._memory.chunk():
+			documents = self.build_chunk(self.read_chunk(model_ids)) if model_ids else []
 
-				documents = []
-				for mapped_model in model.filter(model.id.in_(model_ids)):
-					documents.append((mapped_model.id, self.build_document(db_connector, mapped_model)))
-				#model.session.close()
-				read_queue.put(db_connector)
+			return self.write_chunk(documents, len(model_ids), start_time, self.chunk(after, upper))
 
-				for document in documents:
-					# import pprint
-					# pprint.pprint(document)
-					es_connector.index(document[1], es_index, es_type, document[0], bulk=True)
+	def pipeline(self, start_time=time.time(), read_chunk_size=None, readers=1, builders=1, writers=1, queue_size=8):
+		"""Indexes the buffered items through a staged pipeline.
 
-				count = self.index_count = self.index_count + len(model_ids)
+		Reading, building and writing run in their own stages, connected by bounded queues, so database reads
+		and Elasticsearch writes overlap, and the slowest stage holds back the others instead of letting
+		memory grow.
 
-				if count % 10 == 0:
-					tprint(process_name, '{:d}/{:d} ({:.2%}) {{{:f}}}'.format(count, total, float(count) / total, time.time() - start_time))
+		Args:
+			start_time (float): Start time in seconds.
+			read_chunk_size (integer): Number of ids read per query.
+			readers (int): Number of reader workers.
+			builders (int): Number of builder workers.
+			writers (int): Number of writer workers.
+			queue_size (int): Maximum number of chunks waiting in front of each stage.
 
-				if count % 1000 == 0:
-					es_connector.indices.refresh()
+		An error of any stage stops the pipeline, and is recorded (see BaseIndexer.fail).
 
+		Returns:
+			List of dicts with the statistics of each stage.
+		"""
+		if read_chunk_size is None:
+			read_chunk_size = self.read_chunk_size
+
+		# Items are (checkpoint chunk, number of ids, payload) tuples
+		def chunks():
+			buffer = self.index_buffer
+			while True:
+				with metrics.time('id_fetch'):
+					model_ids = list(itertools.islice(buffer, read_chunk_size))
+				if not model_ids:
+					break
+				after = self._last_id
+				self._last_id = model_ids[-1]
+				yield self.chunk(after, model_ids[-1]), len(model_ids), model_ids
+
+		def read_chunk((chunk, size, model_ids)):
+			return chunk, size, self.read_chunk(model_ids)
+
+		def build_chunk((chunk, size, read)):
+			return chunk, size, self.build_chunk(read)
+
+		# Progress counts the ids taken, like Indexer.process, whether their rows were found or not
+		def write_chunk((chunk, size, documents)):
+			self.write_chunk(documents, size, start_time, chunk)
+
+		pipeline = Pipeline(queue_size) \
+			.stage('Reader', read_chunk, readers) \
+			.stage('Builder', build_chunk, builders) \
+			.stage('Writer', write_chunk, writers)
 
+		try:
+			pipeline.run(chunks())
 		except Exception, e:
-			print(type(e))
-			raise
+			self.fail(e)
+		finally:
+			self.buffer_empty = True
+			for stats in pipeline.stats():
+				vprint('{name:s}: {concurrency:d} workers, {processed:d} chunks, busy {busy_time:.3f}s, '
+					'starved {starved_time:.3f}s, blocked {blocked_time:.3f}s, '
+					'queue depth {mean_depth:.1f} (max {max_depth:d})'.format(**stats))
+
+		return pipeline.stats()
+
+	def follow(self, change_log, offset=None, poll_interval=1.0, window=0.5, batch_size=1000, purge=False, stop=None, on_offset=None,
+		settle=5.0):
+		"""Follows the change log, indexing the changed documents until stopped.
+
+		Changes are polled every `poll_interval` seconds. Once a change shows up, the next ones are gathered
+		for `window` seconds (or until `batch_size` changes), and collapsed by root document, so a document
+		changing many times is indexed once. Deleted roots, and roots no longer found, are deleted from the
+		index. Each batch is sent right away as small bulks, so the lag stays around `poll_interval + window`
+		plus the bulk latency.
+
+		The offset only moves past a batch once every document of the batch, and of the previous ones, is
+		acknowledged by the sink, and never past a change id that may still show up (see ChangeLog.Cursor).
+
+		Args:
+			change_log (ChangeLog.ChangeLog): Change log.
+			offset (int): Last change already indexed, None to start from the first one.
+			poll_interval (float): Seconds between polls while there are no changes.
+			window (float): Seconds during which changes are collapsed.
+			batch_size (int): Maximum number of changes per batch.
+			purge (bool): Whether to delete the changes once indexed.
+			stop (threading.Event): Stops following once set, None to follow until interrupted.
+			on_offset: Called with the new offset once it moves, to store it.
+			settle (float): Seconds a missing change id is waited for, changes commit out of id order.
+
+		Returns:
+			int, last change indexed.
+		"""
+		if self._sink is None:
+			raise BadConfigError('Following the change log needs a sink.')
+
+		process_name = threading.current_thread().getName()
+		if stop is None:
+			stop = threading.Event()
+
+		# Batches in change order, waiting to be acknowledged
+		batches = collections.deque()
+		state = {'offset': offset, 'failed': 0}
+
+		# Moves the offset past the acknowledged batches
+		def advance():
+			last = None
+			while batches and batches[0].done():
+				batch = batches.popleft()
+				state['failed'] += batch.failed
+				last = batch.last
+			if last is not None and last != state['offset']:
+				state['offset'] = last
+				if purge:
+					change_log.purge(last)
+				if on_offset is not None:
+					on_offset(last)
+
+		tprint(process_name, 'Following changes after {!r}...'.format(offset))
+
+		cursor = Cursor(change_log, offset, settle)
+		settled = offset
+		try:
+			while not stop.is_set():
+				changes = cursor.poll(batch_size)
+
+				if changes:
+					deadline = time.time() + window
+					while len(changes) < batch_size and time.time() < deadline and not stop.is_set():
+						stop.wait(min(poll_interval, deadline - time.time()))
+						changes.extend(cursor.poll(batch_size - len(changes)))
+
+					settled = cursor.settled()
+					batches.append(self.write_changes(changes, settled))
+				elif cursor.settled() != settled:
+					# Only gaps given up, or changes without root
+					settled = cursor.offset
+					batches.append(Batch(settled))
+
+				advance()
+
+				if not changes:
+					# Lets the sink complete what it holds back, like the current shard of the file sink
+					self._sink.flush()
+					stop.wait(poll_interval)
+
+			# Wait for the batches in flight
+			self._sink.drain()
+			while batches:
+				advance()
+				if batches:
+					time.sleep(0.1)
+
 		except (KeyboardInterrupt, SystemExit):
-			exit(0)
+			tprint(process_name, 'Interrupted, the changes not acknowledged are indexed again on restart.')
 
-		tprint(process_name, 'I\'m dead!')
+		if state['failed']:
+			vprint('{:d} changed documents failed.'.format(state['failed']))
+
+		return state['offset']
+
+	def write_changes(self, changes, last):
+		"""Indexes or deletes the documents affected by a batch of changes.
+
+		Args:
+			changes (list): (id, root id, operation) tuples, in change order.
+			last (int): Offset once the batch is acknowledged.
+
+		Returns:
+			ChangeLog.Batch, acknowledged by the sink.
+		"""
+		process_name = threading.current_thread().getName()
+
+		# Late changes come after the later ones read before them
+		operations = collapse(sorted(changes))
+		upserts = [root_id for root_id, operation in operations.iteritems() if operation == UPSERT]
+		deletes = [root_id for root_id, operation in operations.iteritems() if operation == DELETE]
+
+		documents = self.build_chunk(self.read_chunk(upserts)) if upserts else []
+
+		# Roots deleted after the change was logged
+		found = set(id for id, document in documents)
+		deletes.extend(root_id for root_id in upserts if root_id not in found)
+
+		if self._fingerprints is not None:
+			self._fingerprints.forget(deletes)
+			documents = self._fingerprints.changed(documents)
+
+		batch = Batch(last)
+		batch.expect(len(documents) + len(deletes))
+		self.send(documents, batch)
+		for id in deletes:
+			self._sink.delete(id, ack=batch)
+		self._sink.flush()
+
+		self.count(len(documents) + len(deletes))
+
+		tprint(process_name, '{:d} changes, {:d} indexed, {:d} deleted.'.format(len(changes), len(documents), len(deletes)))
+
+		return batch
+
+	def read_chunk(self, model_ids):
+		"""Reads a chunk of models, and maps them to the document structure.
+
+		A db connector is borrowed from the read queue while reading, relationships are loaded then. Its
+		session is released before giving it back, the instances read stay usable to build the documents.
+		On a database error the chunk is read again with the next db connector, up to the read retries, so
+		a replica pool can route it away from a failing replica.
+
+		Args:
+			model_ids (list): Ids of the models.
+
+		Returns:
+			Tuple with the db connector and a list of (id, document map) tuples.
+		"""
+		for attempt in itertools.count():
+			db_connector = self._read_queue.get(True)
+			try:
+				with metrics.time('read'):
+					document_maps = []
+					for mapped_model in db_connector.query(model_ids):
+						document_maps.append((mapped_model.id, db_connector.map(mapped_model, self._document_map)))
+				break
+			except sqlalchemy.exc.DBAPIError, e:
+				if attempt >= self._read_retries:
+					raise
+				tprint(threading.current_thread().getName(), 'Read failed, retrying: {!s}'.format(e.orig))
+			finally:
+				db_connector.release()
+				self._read_queue.put(db_connector)
+
+		return db_connector, document_maps
+
+	def recycle(self):
+		"""Drains the sink, and recycles the sessions and connections of the db connectors.
+
+		Called by the memory guard while no chunk is in progress, so every connector is in the read queue.
+		"""
+		if self._sink is not None:
+			self._sink.drain()
+
+		with self._read_queue.mutex:
+			db_connectors = list(self._read_queue.queue)
+		for db_connector in db_connectors:
+			db_connector.recycle()
+
+		gc.collect()
+
+	def build_chunk(self, chunk):
+		"""Builds the documents of a read chunk.
+
+		Args:
+			chunk (tuple): Db connector and list of (id, document map) tuples.
+
+		Returns:
+			List of (id, document) tuples.
+		"""
+		db_connector, document_maps = chunk
+		with metrics.time('build'):
+			documents = [(id, self.translate_document_map(db_connector, document_map)) for id, document_map in document_maps]
+			if self._hierarchy is not None:
+				for id, document in documents:
+					document['hierarchy'] = self._hierarchy.document(id)
+		return documents
+
+	def chunk(self, after, upper):
+		"""Tracks the acknowledgement of a chunk of ids, when checkpointing.
+
+		Args:
+			after (int): Id before the chunk, None if the chunk starts at the first id.
+			upper (int): Last id covered by the chunk.
+
+		Returns:
+			Chunk, None if there is no checkpoint.
+		"""
+		if self._checkpoint is None:
+			return None
+
+		return Chunk(self._checkpoint, after, upper)
+
+	def write_chunk(self, documents, size, start_time, chunk=None):
+		"""Sends the documents to the bulk sink or Elasticsearch connector, and accounts the progress.
+
+		Args:
+			documents (list): List of (id, document) tuples.
+			size (int): Number of ids of the chunk.
+			start_time (float): Start time in seconds.
+			chunk (Chunk): Checkpoint chunk acknowledged by the sink, if any.
+
+		Returns:
+			int, number of indexed items so far.
+		"""
+		process_name = threading.current_thread().getName()
+
+		if self._sink is not None:
+			if self._fingerprints is not None:
+				documents = self._fingerprints.changed(documents)
+			if chunk is not None:
+				chunk.expect(len(documents))
+			self.send(documents, chunk)
+		else:
+			for id, document in documents:
+				self._es_connector.index(document, self._es_index, self._es_type, id, bulk=True)
+
+		count = self.count(size)
+
+		if self._progress_queue is not None:
+			self._progress_queue.put(('progress', process_name, size))
+
+		if count % 10 == 0:
+			total = self.index_total
+			tprint(process_name, '{:d}/{:d} ({:.2%}) {{{:f}}}'.format(count, total, float(count) / max(total, 1), time.time() - start_time))
+
+		return count
+
+	def send(self, documents, ack=None):
+		"""Hands documents to the sink.
+
+		Args:
+			documents (list): (id, document) tuples, or (id, document, source, digest) tuples of the documents
+				that changed according to their fingerprints.
+			ack: Acknowledgement callback of every document, if any.
+		"""
+		if self._fingerprints is None:
+			for id, document in documents:
+				self._sink.index(document, id, ack=ack)
+		else:
+			fingerprints = self._fingerprints
+			for id, document, source, digest in documents:
+				self._sink.index(document, id, ack=fingerprints.acknowledge(id, digest, ack), source=source)
 
 	def build_document(self, db_connector, mapped_model):
 		"""Builds a dict containing the mapping structure for the document.
@@ -142,23 +576,27 @@ class Indexer(BaseIndexer):
 			Dictionary containing the mapping structure.
 		"""
 		document_map = db_connector.map(mapped_model, self._document_map)
-		return self.translate_document_map(document_map)
+		return self.translate_document_map(db_connector, document_map)
 
-	def translate_document_map(self, document_map):
+	def translate_document_map(self, db_connector, document_map):
 		"""Converts to dict all members of dict of mapped objects.
 
 		Args:
+			db_connector: Database connector.
 			document_map: Dict with mapped object as its values.
 
 		Returns:
 			Dict with mapped values converted.
 		"""
-		return {k:self.mapped_to_document(v) for k,v in document_map.items()}
+		return {k:self.mapped_to_document(db_connector, v) for k,v in document_map.items()}
 
-	def mapped_to_document(self, mapped_model):
+	def mapped_to_document(self, db_connector, mapped_model):
 		"""Converts a Mapped model into a document.
 
+		The conversion is done by the serializer the connector compiled for the model table.
+
 		Args:
+			db_connector: Database connector.
 			mapped_model: Mapped model.
 
 		Returns:
@@ -172,11 +610,14 @@ class Indexer(BaseIndexer):
 		if mapped_model is None:
 			return None
 
+		# Connectors without ORM already provide plain dicts.
+		if isinstance(mapped_model, dict):
+			return mapped_model
+
 		if isinstance(mapped_model, list):
 			models = []
 			for v in mapped_model:
-				models.append(self.mapped_to_document(v))
+				models.append(self.mapped_to_document(db_connector, v))
 			return models
 		else:
-			empty_schema = {k:None for k in mapped_model._table.c.keys()}
-			return {k:mapped_model.__dict__[k] for k in empty_schema}
+			return db_connector.serialize(mapped_model)
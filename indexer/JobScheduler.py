@@ -0,0 +1,260 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""JobScheduler.py: Weighted scheduler of several index jobs over a shared pool of workers."""
+
+__author__      = "Ber Clausen"
+__copyright__   = "Copyright 2014, Planet Earth"
+
+import time
+import traceback
+
+# Threading
+import threading
+
+# Errors
+from utils.errors import BadConfigError
+
+# Thread
+from utils.Thread import Thread
+
+# Utility functions
+from utils.utils import vprint, tprint
+
+
+# Scheduling policies.
+POLICIES = ['fair', 'priority']
+
+# Seconds charged for a chunk before any chunk of the job is measured.
+DEFAULT_ESTIMATE = 1.0
+
+
+class Share(object):
+	"""Job run by the scheduler.
+
+	Attributes:
+		name (string): Job name.
+		indexer (Indexer): Indexer of the job.
+		weight (float): Share of the workers.
+		priority (int): Priority, only used by the priority policy.
+		read_chunk_size (int): Number of ids per chunk.
+		virtual_time (float): Worker seconds spent on the job, divided by its weight.
+		chunks (int): Number of chunks processed.
+		ids (int): Number of ids processed.
+		busy_time (float): Worker seconds spent on the job.
+		done (bool): Whether every chunk was taken, or the job failed.
+		error (string): Error that stopped the job, None if it did not fail.
+	"""
+
+	def __init__(self, name, indexer, weight, priority, read_chunk_size):
+		self.name = name
+		self.indexer = indexer
+		self.weight = float(weight)
+		self.priority = priority
+		self.read_chunk_size = read_chunk_size
+		self.virtual_time = 0.0
+		self.chunks = 0
+		self.ids = 0
+		self.busy_time = 0.0
+		self.done = False
+		self.error = None
+
+		# Workers that took chunks, and the ones that found none left
+		self.takers = set()
+		self.exhausted = set()
+
+	def estimate(self):
+		"""Expected worker seconds of the next chunk, None before the first one."""
+		return self.busy_time / self.chunks if self.chunks else None
+
+
+class JobScheduler(object):
+	"""JobScheduler class.
+
+	Runs several indexers in one process, with a single pool of workers. Each worker takes one chunk at a
+	time, from the job picked by the policy:
+
+	- 'fair': the job with the least worker time per unit of weight, so every job gets a share of the workers
+	  proportional to its weight (stride scheduling). The time of a chunk is charged when it is picked, from
+	  the mean time of the chunks of the job, and corrected once known.
+	- 'priority': only the jobs of the highest priority with chunks left, fairly among them. Lower priority
+	  jobs take the workers those leave idle.
+
+	When a job runs out of chunks, its share goes to the others. The db connections and the Elasticsearch
+	bulk capacity are shared by the caller, through the schema of the connectors and the limiter of the sinks.
+
+	A worker keeps the id range it took from a job until it drains it, so a job is only done once every
+	worker that took chunks from it found none left.
+
+	A job whose chunk raises an error is marked failed and no longer picked, the workers go on with the other
+	jobs. The error is reported with its traceback, and kept in the statistics.
+	"""
+
+	def __init__(self, policy='fair'):
+		"""Initialization.
+
+		Args:
+			policy (string): 'fair' or 'priority'.
+		"""
+		if policy not in POLICIES:
+			raise BadConfigError('Unknown job policy: {:s}.'.format(policy))
+
+		self.policy = policy
+		self.shares = []
+
+		self._lock = threading.Lock()
+
+	def add(self, name, indexer, weight=1, priority=0, read_chunk_size=None):
+		"""Adds a job.
+
+		Args:
+			name (string): Job name.
+			indexer (Indexer): Indexer of the job, with its buffer filled.
+			weight (float): Share of the workers.
+			priority (int): Priority, only used by the priority policy.
+			read_chunk_size (int): Number of ids per chunk, None for the indexer default.
+
+		Returns:
+			JobScheduler.
+		"""
+		if weight <= 0:
+			raise BadConfigError('The weight of the {:s} job must be positive.'.format(name))
+
+		self.shares.append(Share(name, indexer, weight, priority, read_chunk_size))
+		return self
+
+	def pick(self):
+		"""Picks the job the current worker takes its next chunk from, and charges the chunk to it.
+
+		Returns:
+			Tuple with the Share and the seconds charged, (None, 0.0) once the worker has nothing left to do.
+		"""
+		worker = threading.current_thread().ident
+
+		with self._lock:
+			candidates = [candidate for candidate in self.shares
+				if not candidate.done and worker not in candidate.exhausted]
+			if not candidates:
+				return None, 0.0
+
+			if self.policy == 'priority':
+				top = max(candidate.priority for candidate in candidates)
+				candidates = [candidate for candidate in candidates if candidate.priority == top]
+
+			share = min(candidates, key=lambda candidate: candidate.virtual_time)
+
+			estimate = share.estimate()
+			if estimate is None:
+				measured = [other.estimate() for other in self.shares if other.chunks]
+				estimate = sum(measured) / len(measured) if measured else DEFAULT_ESTIMATE
+
+			share.virtual_time += estimate / share.weight
+			share.takers.add(worker)
+
+		return share, estimate
+
+	def work(self, start_time):
+		"""Worker: processes chunks of the picked jobs until none is left.
+
+		Args:
+			start_time (float): Start time in seconds.
+		"""
+		process_name = threading.current_thread().getName()
+		worker = threading.current_thread().ident
+
+		tprint(process_name, 'Starting...')
+
+		try:
+			while True:
+				share, estimate = self.pick()
+				if share is None:
+					break
+
+				chunk_start = time.time()
+				try:
+					taken = share.indexer.take(share.read_chunk_size)
+					if taken is not None:
+						share.indexer.process(taken, start_time)
+				except Exception, e:
+					self.fail(share, e)
+					continue
+				elapsed = time.time() - chunk_start
+
+				if taken is None:
+					with self._lock:
+						share.virtual_time -= estimate / share.weight
+						share.exhausted.add(worker)
+						if share.takers <= share.exhausted and not share.done:
+							share.done = True
+							tprint(process_name, '{:s} job done.'.format(share.name))
+					continue
+
+				with self._lock:
+					share.virtual_time += (elapsed - estimate) / share.weight
+					share.chunks += 1
+					share.ids += len(taken[2])
+					share.busy_time += elapsed
+
+		except (KeyboardInterrupt, SystemExit):
+			exit(0)
+
+		tprint(process_name, 'I\'m dead!')
+
+	def fail(self, share, error):
+		"""Marks a job failed, so no worker picks it again, and reports the error of the current worker.
+
+		Args:
+			share (Share): Failed job.
+			error (Exception): Error.
+		"""
+		with self._lock:
+			share.done = True
+			if share.error is None:
+				share.error = repr(error)
+
+		vprint('{:s} job failed in {:s}: {!r}\n{:s}'.format(share.name, threading.current_thread().getName(), error,
+			traceback.format_exc()))
+
+	def run(self, threads, start_time=None):
+		"""Runs the jobs until every one is done.
+
+		Args:
+			threads (int): Number of workers.
+			start_time (float): Start time in seconds, now if None.
+
+		Returns:
+			List of dicts with the statistics of each job.
+		"""
+		if start_time is None:
+			start_time = time.time()
+
+		workers = []
+		for i in range(max(1, threads)):
+			worker = Thread(self.work, start_time, autostart=False)
+			worker.setName('Worker-{:d}'.format(i + 1))
+			worker.start()
+			workers.append(worker)
+
+		for worker in workers:
+			worker.join()
+
+		return self.stats()
+
+	def stats(self):
+		"""Statistics of every job.
+
+		Returns:
+			List of dicts.
+		"""
+		with self._lock:
+			busy_time = sum(share.busy_time for share in self.shares)
+			return [{
+				'name': share.name,
+				'weight': share.weight,
+				'priority': share.priority,
+				'chunks': share.chunks,
+				'ids': share.ids,
+				'busy_time': share.busy_time,
+				'busy_share': share.busy_time / busy_time if busy_time else 0.0,
+				'error': share.error,
+			} for share in self.shares]
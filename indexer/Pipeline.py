@@ -0,0 +1,235 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Pipeline.py: Staged pipeline connected by bounded queues."""
+
+__author__      = "Ber Clausen"
+__copyright__   = "Copyright 2014, Planet Earth"
+
+import time
+from Queue import Queue
+
+# Threading
+import threading
+
+# Thread
+from utils.Thread import Thread
+
+
+# Marks the end of the items in a queue.
+END = object()
+
+
+class Stage(object):
+	"""Pipeline stage.
+
+	Workers take items from the input queue, process them and put the results in the output queue. As the queues
+	are bounded, a slow stage blocks the stages before it (backpressure) instead of letting the queues grow.
+
+	Attributes:
+		name (string): Stage name.
+		function: Function applied to every item, returning None means nothing goes downstream.
+		concurrency (int): Number of workers.
+		processed (int): Number of processed items.
+		busy_time (float): Seconds spent processing items.
+		starved_time (float): Seconds spent waiting for items from the input queue.
+		blocked_time (float): Seconds spent waiting for room in the output queue.
+		max_depth (int): Maximum observed depth of the input queue.
+	"""
+
+	input_queue = None
+	output_queue = None
+	next_stage = None
+	error = None
+
+	def __init__(self, name, function, concurrency=1):
+		"""Initialization.
+
+		Args:
+			name (string): Stage name.
+			function: Function applied to every item.
+			concurrency (int): Number of workers.
+		"""
+		self.name = name
+		self.function = function
+		self.concurrency = concurrency
+
+		self.processed = 0
+		self.busy_time = 0.0
+		self.starved_time = 0.0
+		self.blocked_time = 0.0
+		self.max_depth = 0
+		self._depth_total = 0
+		self._running = concurrency
+		self._lock = threading.Lock()
+
+	def work(self):
+		"""Worker loop.
+
+		After a failure the worker keeps draining its input queue, so the stages before it never block. Whatever
+		happens, the last worker to stop tells the next stage, so the stages after it never block either.
+		"""
+		try:
+			while True:
+				depth = self.input_queue.qsize()
+
+				wait_start = time.time()
+				item = self.input_queue.get(True)
+				busy_start = time.time()
+
+				if item is END:
+					break
+
+				if self.error is not None:
+					continue
+
+				try:
+					result = self.function(item)
+				except Exception, e:
+					self.error = e
+					continue
+
+				put_start = time.time()
+				if result is not None and self.output_queue is not None:
+					self.output_queue.put(result, True)
+				put_end = time.time()
+
+				with self._lock:
+					self.processed += 1
+					self.starved_time += busy_start - wait_start
+					self.busy_time += put_start - busy_start
+					self.blocked_time += put_end - put_start
+					self.max_depth = max(self.max_depth, depth)
+					self._depth_total += depth
+		except Exception, e:
+			if self.error is None:
+				self.error = e
+		finally:
+			with self._lock:
+				self._running -= 1
+				last = self._running == 0
+
+			# The last worker tells every worker of the next stage there is nothing left.
+			if last and self.next_stage is not None:
+				for _ in range(self.next_stage.concurrency):
+					self.output_queue.put(END, True)
+
+	def stats(self):
+		"""Stage statistics.
+
+		Returns:
+			Dict.
+		"""
+		return {
+			'name': self.name,
+			'concurrency': self.concurrency,
+			'processed': self.processed,
+			'busy_time': self.busy_time,
+			'starved_time': self.starved_time,
+			'blocked_time': self.blocked_time,
+			'max_depth': self.max_depth,
+			'mean_depth': float(self._depth_total) / self.processed if self.processed else 0.0,
+		}
+
+
+class Pipeline(object):
+	"""Pipeline class.
+
+	Chains stages through bounded queues, each stage with its own workers.
+
+	Attributes:
+		queue_size (int): Maximum number of items waiting in front of each stage.
+		stages (list): Stages, in order.
+	"""
+
+	def __init__(self, queue_size=8):
+		"""Initialization.
+
+		Args:
+			queue_size (int): Maximum number of items waiting in front of each stage.
+		"""
+		self.queue_size = queue_size
+		self.stages = []
+
+	def stage(self, name, function, concurrency=1):
+		"""Appends a stage.
+
+		Args:
+			name (string): Stage name.
+			function: Function applied to every item.
+			concurrency (int): Number of workers.
+
+		Returns:
+			Pipeline.
+		"""
+		self.stages.append(Stage(name, function, concurrency))
+		return self
+
+	def run(self, items):
+		"""Feeds the items to the first stage, and waits until every stage is done.
+
+		Args:
+			items: Iterable of items for the first stage.
+
+		Raises:
+			The error raised producing the items, or else the first error raised by a stage.
+		"""
+		stages = self.stages
+
+		previous = None
+		for stage in stages:
+			stage.input_queue = Queue(self.queue_size)
+			if previous is not None:
+				previous.output_queue = stage.input_queue
+				previous.next_stage = stage
+			previous = stage
+
+		threads = []
+		for stage in stages:
+			for i in range(stage.concurrency):
+				thread = Thread(stage.work, autostart=False)
+				thread.setName('{:s}-{:d}'.format(stage.name, i + 1))
+				thread.daemon = True
+				thread.start()
+				threads.append(thread)
+
+		# An error producing the items stops the stages too, once they are done with the items already fed
+		first = stages[0]
+		feed_error = None
+		try:
+			for item in items:
+				if self.error() is not None:
+					break
+				first.input_queue.put(item, True)
+		except Exception, e:
+			feed_error = e
+		finally:
+			for _ in range(first.concurrency):
+				first.input_queue.put(END, True)
+
+		for thread in threads:
+			thread.join()
+
+		if feed_error is not None:
+			raise feed_error
+		if self.error() is not None:
+			raise self.error()
+
+	def error(self):
+		"""First error raised by a stage.
+
+		Returns:
+			Exception, None if there was none.
+		"""
+		for stage in self.stages:
+			if stage.error is not None:
+				return stage.error
+		return None
+
+	def stats(self):
+		"""Statistics of every stage.
+
+		Returns:
+			List of dicts.
+		"""
+		return [stage.stats() for stage in self.stages]
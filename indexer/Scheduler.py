@@ -0,0 +1,217 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Scheduler.py: Work-stealing scheduler of primary key ranges."""
+
+__author__      = "Ber Clausen"
+__copyright__   = "Copyright 2014, Planet Earth"
+
+import bisect
+from collections import deque
+
+# Threading
+import threading
+
+
+class Slot(object):
+	"""Range owned by a worker.
+
+	The range (after, upper] is only changed holding the slot lock: by its worker when taking ids from the
+	bottom, and by thieves when taking its upper half. The lock is not held while fetching, so `after` only
+	moves once the ids are fetched, and only the worker moves it.
+
+	Attributes:
+		after: Last id already taken.
+		upper: Last id of the range.
+	"""
+
+	def __init__(self):
+		self.after = 0
+		self.upper = 0
+		self.lock = threading.Lock()
+
+	def remaining(self):
+		"""Span of ids not taken yet, read without the lock, so only an estimate."""
+		return self.upper - self.after
+
+
+class RangeScheduler(object):
+	"""RangeScheduler class.
+
+	Hands primary key ranges to the workers, so they take their ids without sharing a lock. The ranges start
+	in a pool; a worker takes one, fetches its ids window by window, and takes another one once done. When
+	the pool is empty, idle workers steal the upper half of the largest range left, so skewed ranges still
+	balance.
+
+	A worker only waits on another one while stealing from it, and never for a query.
+
+	Attributes:
+		id_source (IdSource.KeysetIdSource): Windowed id source, its filter applies to the ranges.
+		limit (int): Number of ids to hand out, None for no limit.
+		steals (int): Number of ranges stolen.
+	"""
+
+	limit = None
+	steals = 0
+
+	def __init__(self, id_source, ranges, limit=None):
+		"""Initialization.
+
+		Args:
+			id_source (IdSource.KeysetIdSource): Windowed id source.
+			ranges (list): (after, upper) ranges, each one covering the ids greater than `after` up to `upper`.
+			limit (int): Number of ids to hand out, None or 0 means no limit.
+		"""
+		self.id_source = id_source
+		self.limit = limit if limit not in [None, 0] else None
+
+		self._pool = deque(ranges)
+		self._pool_lock = threading.Lock()
+		self._slots = []
+		self._local = threading.local()
+
+		# Only used with a limit
+		self._claimed = 0
+		self._limit_lock = threading.Lock()
+
+	def slot(self):
+		"""Slot of the current worker, registered the first time.
+
+		Returns:
+			Slot.
+		"""
+		slot = getattr(self._local, 'slot', None)
+		if slot is None:
+			slot = self._local.slot = Slot()
+			with self._pool_lock:
+				self._slots.append(slot)
+		return slot
+
+	def next(self, size):
+		"""Takes the next ids of the current worker.
+
+		Args:
+			size (int): Maximum number of ids.
+
+		Returns:
+			Tuple with the range taken (after, upper) and its ids, which may be none. None once there is no
+			range left.
+		"""
+		slot = self.slot()
+
+		while True:
+			size = self.claim(size)
+			if size == 0:
+				return None
+
+			with slot.lock:
+				after, bound = slot.after, slot.upper
+
+			if after < bound:
+				ids = self.id_source.fetch(after, size, bound)
+
+				with slot.lock:
+					# The upper half may have been stolen meanwhile, its ids are the thief's.
+					full = len(ids) == size
+					if ids and ids[-1] > slot.upper:
+						ids = ids[:bisect.bisect_right(ids, slot.upper)]
+						full = False
+					# A short window exhausts the range, the ids past the last one are gone too.
+					upper = ids[-1] if full else slot.upper
+					slot.after = upper
+
+				self.refund(size - len(ids))
+				return (after, upper), ids
+
+			self.refund(size)
+			if not self.assign(slot):
+				return None
+
+	def assign(self, slot):
+		"""Gives a new range to an idle worker, from the pool or stolen.
+
+		Args:
+			slot (Slot): Slot of the worker.
+
+		Returns:
+			bool, False if there is no range left.
+		"""
+		with self._pool_lock:
+			stolen = self._pool.popleft() if self._pool else None
+			victims = sorted(self._slots, key=Slot.remaining, reverse=True)
+
+		if stolen is None:
+			for victim in victims:
+				if victim is slot or victim.remaining() < 2:
+					continue
+				with victim.lock:
+					remaining = victim.upper - victim.after
+					if remaining < 2:
+						continue
+					middle = victim.after + remaining // 2
+					stolen = (middle, victim.upper)
+					victim.upper = middle
+				with self._pool_lock:
+					self.steals += 1
+				break
+
+		if stolen is None:
+			return False
+
+		with slot.lock:
+			slot.after, slot.upper = stolen
+		return True
+
+	def claim(self, size):
+		"""Reserves ids against the limit.
+
+		Args:
+			size (int): Number of ids wanted.
+
+		Returns:
+			int, number of ids reserved.
+		"""
+		if self.limit is None:
+			return size
+
+		with self._limit_lock:
+			size = max(min(size, self.limit - self._claimed), 0)
+			self._claimed += size
+		return size
+
+	def refund(self, size):
+		"""Gives back the reserved ids that were not found.
+
+		Args:
+			size (int): Number of ids.
+		"""
+		if self.limit is None or size == 0:
+			return
+
+		with self._limit_lock:
+			self._claimed -= size
+
+
+def subtract(ranges, segments):
+	"""Removes completed segments from ranges.
+
+	Args:
+		ranges (list): Sorted (after, upper) ranges.
+		segments (list): Sorted (after, upper) segments that do not overlap, `after` None means from the start.
+
+	Returns:
+		List of (after, upper) ranges.
+	"""
+	result = []
+	for after, upper in ranges:
+		for segment_after, segment_upper in segments:
+			if segment_upper <= after or (segment_after is not None and segment_after >= upper):
+				continue
+			if segment_after is not None and segment_after > after:
+				result.append((after, segment_after))
+			after = max(after, segment_upper)
+			if after >= upper:
+				break
+		if after < upper:
+			result.append((after, upper))
+	return result
@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Watermark.py: High-water marks of the incremental runs."""
+
+__author__      = "Ber Clausen"
+__copyright__   = "Copyright 2014, Planet Earth"
+
+import datetime
+import json
+import os
+
+# Errors
+from utils.errors import BadConfigError
+
+
+class Watermark(object):
+	"""Watermark class.
+
+	Keeps the high-water mark of the last successful incremental run of a table into an index, in a JSON file
+	shared by every index and table.
+
+	Attributes:
+		path (string): State file path.
+		key (string): Key of the index and table in the state file.
+	"""
+
+	datetime_format = '%Y-%m-%dT%H:%M:%S.%f'
+
+	def __init__(self, path, es_index, table_name):
+		"""Initialization.
+
+		Args:
+			path (string): State file path.
+			es_index (string): Elasticsearch index.
+			table_name (string): Source table name.
+		"""
+		self.path = path
+		self.key = '{:s}/{:s}'.format(es_index, table_name)
+
+	def read(self):
+		"""Reads the state file.
+
+		Returns:
+			Dict.
+		"""
+		if not os.path.exists(self.path):
+			return {}
+
+		try:
+			with open(self.path) as file:
+				return json.load(file)
+		except ValueError:
+			raise BadConfigError('Corrupted watermark file: {:s}.'.format(self.path))
+
+	def load(self):
+		"""Loads the high-water mark.
+
+		Returns:
+			Watermark value, None if there was no successful run.
+		"""
+		state = self.read().get(self.key)
+		if state is None:
+			return None
+
+		if 'datetime' in state:
+			return datetime.datetime.strptime(state['datetime'], self.datetime_format)
+		return state['value']
+
+	def save(self, value):
+		"""Stores the high-water mark. Only to be called once the documents are acknowledged.
+
+		The file is replaced atomically, so a crash never leaves it half written.
+
+		Args:
+			value: Watermark value, a date, datetime or number.
+		"""
+		if isinstance(value, datetime.date) and not isinstance(value, datetime.datetime):
+			value = datetime.datetime.combine(value, datetime.time())
+
+		if isinstance(value, datetime.datetime):
+			state = {'datetime': value.strftime(self.datetime_format)}
+		else:
+			state = {'value': value}
+
+		states = self.read()
+		states[self.key] = state
+
+		temporary_path = self.path + '.tmp'
+		with open(temporary_path, 'w') as file:
+			json.dump(states, file, indent=1, sort_keys=True)
+		os.rename(temporary_path, self.path)
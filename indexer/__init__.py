@@ -1 +1 @@
-__all__ = ['BaseIndexer', 'Indexer']
+__all__ = ['BaseIndexer', 'ChangeLog', 'Checkpoint', 'Fingerprints', 'Hierarchy', 'IdSource', 'Indexer', 'JobScheduler', 'Pipeline', 'Scheduler', 'Watermark']
@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""BaseSink.py: Abstract class of the outputs the documents are written to."""
+
+__author__      = "Ber Clausen"
+__copyright__   = "Copyright 2014, Planet Earth"
+
+from abc import ABCMeta, abstractmethod
+import datetime
+import decimal
+import json
+
+# Fast JSON encoder, optional
+try:
+	import simplejson
+except ImportError:
+	simplejson = None
+
+# Utility functions
+from utils.utils import format_timedelta
+
+# Metrics
+from utils.Metrics import metrics
+
+
+def encode_default(value):
+	"""Encodes the values the json module does not know about."""
+	if isinstance(value, (datetime.datetime, datetime.date, datetime.time)):
+		return value.isoformat()
+	# TIME columns read by MySQLdb
+	if isinstance(value, datetime.timedelta):
+		return format_timedelta(value)
+	if isinstance(value, decimal.Decimal):
+		return float(value)
+	raise TypeError(repr(value) + ' is not JSON serializable')
+
+def json_encoder():
+	"""Builds the fastest JSON encoder available: simplejson with its C speedups, or the json module.
+
+	The encoder is built once and reused, `json.dumps` builds a new one on every call given a `default`.
+	Separators are compact, Elasticsearch does not need the spaces.
+
+	Returns:
+		Encoder with the `encode(value)` method, safe to share between threads.
+	"""
+	if simplejson is not None and getattr(simplejson.encoder, 'c_make_encoder', None) is not None:
+		return simplejson.JSONEncoder(default=encode_default, separators=(',', ':'))
+	return json.JSONEncoder(default=encode_default, separators=(',', ':'))
+
+
+class BaseSink(object):
+	"""BaseSink class.
+
+	Documents are rendered as `_bulk` operations (an action line, and a source line for indexed documents),
+	and written by the implementations. Action lines are pre-rendered for every operation, index and type, so
+	only the id is encoded per document. Writes are acknowledged through the `ack` callbacks, with True once a
+	document is durably written, or False once it is given up, from any thread.
+
+	Sinks are shared by the indexing threads.
+	"""
+
+	__metaclass__ = ABCMeta
+
+	_es_index = None
+	_es_type = None
+
+	def __init__(self, es_index, es_type):
+		"""Initialization.
+
+		Args:
+			es_index (string): Elasticsearch index of the operations.
+			es_type (string): Elasticsearch type of the operations.
+		"""
+		self._es_index = es_index
+		self._es_type = es_type
+		self._encoder = json_encoder()
+		self._actions = {}
+
+	def action(self, id, es_index=None, es_type=None, operation='index'):
+		"""Renders the action line of a document, newline included.
+
+		Args:
+			id: Document id.
+			es_index (string): Elasticsearch index, the sink one if None.
+			es_type (string): Elasticsearch type, the sink one if None.
+			operation (string): Bulk operation, 'index' or 'delete'.
+
+		Returns:
+			string.
+		"""
+		key = (operation, es_index or self._es_index, es_type or self._es_type)
+		prefix = self._actions.get(key)
+		if prefix is None:
+			prefix = self._actions[key] = '{{{:s}:{{"_index":{:s},"_type":{:s},"_id":'.format(
+				*[self._encoder.encode(value) for value in key])
+
+		# Integer ids, the usual primary keys, need no encoder
+		return prefix + (str(id) if type(id) in (int, long) else self._encoder.encode(id)) + '}}\n'
+
+	def index(self, document, id, es_index=None, es_type=None, ack=None, source=None):
+		"""Adds a document.
+
+		Args:
+			document (dict): Document.
+			id: Document id.
+			es_index (string): Elasticsearch index, the sink one if None.
+			es_type (string): Elasticsearch type, the sink one if None.
+			ack: Called with True once the document is written, or False once given up.
+			source (string): Document already encoded, if any.
+		"""
+		with metrics.time('serialize'):
+			if source is None:
+				source = self._encoder.encode(document)
+			lines = ''.join((self.action(id, es_index, es_type), source, '\n'))
+		metrics.add('documents')
+		self.add(lines, ack)
+
+	def delete(self, id, es_index=None, es_type=None, ack=None):
+		"""Adds the deletion of a document. Missing documents count as deleted.
+
+		Args:
+			id: Document id.
+			es_index (string): Elasticsearch index, the sink one if None.
+			es_type (string): Elasticsearch type, the sink one if None.
+			ack: Called with True once the deletion is written, or False once given up.
+		"""
+		self.add(self.action(id, es_index, es_type, 'delete'), ack)
+
+	@abstractmethod
+	def add(self, lines, ack=None):
+		"""Adds the rendered lines of a bulk operation.
+
+		Args:
+			lines (string): Action line, and source line if any.
+			ack: Acknowledgement callback.
+		"""
+		raise NotImplementedError()
+
+	@abstractmethod
+	def flush(self):
+		"""Starts writing the pending operations, without waiting for them."""
+		raise NotImplementedError()
+
+	@abstractmethod
+	def drain(self):
+		"""Writes the pending operations and waits for them, the sink can still be used afterwards."""
+		raise NotImplementedError()
+
+	@abstractmethod
+	def close(self):
+		"""Writes the pending operations and waits for them.
+
+		Returns:
+			Dict with the sink statistics, at least 'documents' and 'failed_documents'.
+		"""
+		raise NotImplementedError()
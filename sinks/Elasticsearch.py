@@ -0,0 +1,543 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Elasticsearch.py: Elasticsearch bulk sink keeping several `_bulk` requests in flight."""
+
+__author__      = "Ber Clausen"
+__copyright__   = "Copyright 2014, Planet Earth"
+
+import httplib
+import json
+import random
+import socket
+import time
+import traceback
+from collections import deque
+from Queue import Queue
+
+# Threading
+import threading
+
+# Errors
+from utils.errors import BadConfigError
+
+# Thread
+from utils.Thread import Thread
+
+# Utility functions
+from utils.utils import vprint
+
+# Metrics
+from utils.Metrics import metrics
+
+# Base sink
+from BaseSink import BaseSink
+
+
+# Tells a sender there are no more bodies.
+END = object()
+
+# Statuses worth sending again: the cluster is busy, not the document wrong.
+RETRY_STATUSES = [429, 502, 503, 504]
+
+# Target size changes kept in the statistics, a long running sink changes it for ever.
+BULK_SIZES_KEPT = 100
+
+
+class BulkSink(BaseSink):
+	"""Elasticsearch bulk sink.
+
+	Producers hand documents to the sink, which renders them into `_bulk` bodies. Full bodies are queued to a
+	pool of sender threads, each one keeping a persistent HTTP connection to one of the servers, so up to
+	`concurrency` requests are in flight and producers never wait for the responses. Producers only block
+	when every sender is busy and the queue in front of them is full.
+
+	Bodies are flushed when they reach `bulk_bytes` or `bulk_size` documents, whatever comes first. The byte
+	target adapts to the observed responses: it shrinks when requests are rejected (413, 429) or slower than
+	`bulk_latency`, and grows while full requests are fast, always within `min_bulk_bytes` and
+	`max_bulk_bytes`. Target changes are counted, and the last ones kept, in the statistics.
+
+	The responses are checked item by item. Only the documents rejected because the cluster is busy (429,
+	`es_rejected_execution_exception`, unavailable nodes or network errors) are sent again, after an
+	exponential backoff with jitter, up to `max_retries` times. Bodies rejected for being too large are split
+	in halves. Documents with other errors, or out of retries, are given up and reported.
+
+	Sinks of jobs running in the same process can share a `limiter`, a semaphore bounding their requests in
+	flight altogether, so they share the bulk capacity of the cluster instead of adding up.
+
+	Python 2 has no asyncio, so the in-flight requests are handled by threads, which release the GIL while
+	waiting on the network.
+
+	Attributes:
+		bulk_size (int): Maximum number of documents per `_bulk` request.
+		bulk_bytes (int): Current target size of the `_bulk` bodies, in bytes.
+		min_bulk_bytes (int): Lower bound of the target size.
+		max_bulk_bytes (int): Upper bound of the target size.
+		bulk_latency (float): Target seconds per `_bulk` request.
+		concurrency (int): Number of concurrent `_bulk` requests.
+		timeout (float): Seconds to wait for a response.
+		max_retries (int): Number of times a rejected document is sent again.
+		backoff (float): Seconds to wait before the first retry, doubled on every retry.
+		max_backoff (float): Maximum seconds to wait before a retry.
+	"""
+
+	bulk_size = 1000
+	bulk_bytes = 5 * 1024 * 1024
+	min_bulk_bytes = 1024 * 1024
+	max_bulk_bytes = 20 * 1024 * 1024
+	bulk_latency = 1.0
+	concurrency = 4
+	timeout = 60
+	max_retries = 5
+	backoff = 0.5
+	max_backoff = 30.0
+
+	def __init__(self, servers, es_index, es_type,
+		bulk_size=None,
+		bulk_bytes=None,
+		min_bulk_bytes=None,
+		max_bulk_bytes=None,
+		bulk_latency=None,
+		concurrency=None,
+		timeout=None,
+		max_retries=None,
+		backoff=None,
+		limiter=None):
+		"""Initialization.
+
+		Args:
+			servers (list): (protocol, hostname, port) tuples, like config.es_connections.
+			es_index (string): Elasticsearch index.
+			es_type (string): Elasticsearch type.
+			bulk_size (int): Maximum number of documents per `_bulk` request.
+			bulk_bytes (int): Initial target size of the `_bulk` bodies, in bytes.
+			min_bulk_bytes (int): Lower bound of the target size.
+			max_bulk_bytes (int): Upper bound of the target size.
+			bulk_latency (float): Target seconds per `_bulk` request.
+			concurrency (int): Number of concurrent `_bulk` requests.
+			timeout (float): Seconds to wait for a response.
+			max_retries (int): Number of times a rejected document is sent again.
+			backoff (float): Seconds to wait before the first retry.
+			limiter (threading.Semaphore): Bounds the requests in flight of every sink sharing it, None to
+				only bound the ones of this sink.
+		"""
+		if not servers:
+			raise BadConfigError('No Elasticsearch servers configured.')
+
+		super(BulkSink, self).__init__(es_index, es_type)
+		self._servers = [self.server(server) for server in servers]
+
+		if bulk_size is not None:
+			self.bulk_size = bulk_size
+		if min_bulk_bytes is not None:
+			self.min_bulk_bytes = min_bulk_bytes
+		if max_bulk_bytes is not None:
+			self.max_bulk_bytes = max_bulk_bytes
+		if bulk_bytes is not None:
+			self.bulk_bytes = bulk_bytes
+		if bulk_latency is not None:
+			self.bulk_latency = bulk_latency
+		if concurrency is not None:
+			self.concurrency = concurrency
+		if timeout is not None:
+			self.timeout = timeout
+		if max_retries is not None:
+			self.max_retries = max_retries
+		if backoff is not None:
+			self.backoff = backoff
+
+		if not self.min_bulk_bytes <= self.bulk_bytes <= self.max_bulk_bytes:
+			raise BadConfigError('The bulk bytes target must be within its bounds.')
+
+		self._start_time = time.time()
+		self._lock = threading.Lock()
+		self._stats_lock = threading.Lock()
+		self._lines = []
+		self._bytes = 0
+
+		# Held by the senders while their request is in flight
+		self._limiter = limiter if limiter is not None else threading.Semaphore(self.concurrency)
+
+		# Bodies queued and not completely answered yet
+		self._in_flight = 0
+		self._idle = threading.Condition()
+
+		self.stats = {
+			'documents': 0,
+			'requests': 0,
+			'bytes': 0,
+			'failed_requests': 0,
+			'failed_documents': 0,
+			'rejected_documents': 0,
+			'retries': 0,
+			'retried_documents': 0,
+			'gave_up_documents': 0,
+			'ack_errors': 0,
+			'sender_errors': 0,
+			'request_time': 0.0,
+			'min_request_bytes': None,
+			'max_request_bytes': 0,
+			'bulk_bytes': self.bulk_bytes,
+			'bulk_size_changes': 0,
+			'bulk_sizes': deque([(0.0, self.bulk_bytes)], BULK_SIZES_KEPT),
+		}
+
+		self._bodies = Queue(self.concurrency)
+		self._senders = []
+		for i in range(self.concurrency):
+			sender = Thread(self.send_loop, self._servers[i % len(self._servers)], autostart=False)
+			sender.setName('Sender-{:d}'.format(i + 1))
+			sender.daemon = True
+			sender.start()
+			self._senders.append(sender)
+
+	@staticmethod
+	def server(server):
+		"""Parses a server definition.
+
+		Args:
+			server: (protocol, hostname, port) tuple, or 'protocol://hostname:port' string.
+
+		Returns:
+			(protocol, hostname, port) tuple.
+		"""
+		if isinstance(server, basestring):
+			protocol, _, address = server.rpartition('://')
+			hostname, _, port = address.partition(':')
+			server = (protocol or 'http', hostname, port or '9200')
+
+		try:
+			protocol, hostname, port = server
+		except ValueError:
+			raise BadConfigError('Bad Elasticsearch server: {!r}.'.format(server))
+
+		if protocol not in ['http', 'https']:
+			raise BadConfigError('Unsupported Elasticsearch protocol: {:s}.'.format(protocol))
+
+		return protocol, hostname, int(port)
+
+	def add(self, lines, ack=None):
+		"""Adds the lines of a bulk operation to the current body, queuing it once full.
+
+		Args:
+			lines (string): Action line, and source line if any.
+			ack: Acknowledgement callback.
+		"""
+		body = None
+		with self._lock:
+			self._lines.append((lines, ack))
+			self._bytes += len(lines)
+			if len(self._lines) >= self.bulk_size or self._bytes >= self.bulk_bytes:
+				body = self.take()
+
+		if body is not None:
+			self.enqueue(body)
+
+	def take(self):
+		"""Takes the pending lines as a body. Must be called holding the lock.
+
+		Returns:
+			List with the (lines, ack) pair of each document.
+		"""
+		body = self._lines
+		self._lines = []
+		self._bytes = 0
+		return body
+
+	def enqueue(self, body):
+		"""Queues a body for the senders, blocking while all of them are busy and the queue is full.
+
+		Args:
+			body (list): (lines, ack) pair of each document.
+		"""
+		with self._idle:
+			self._in_flight += 1
+		self._bodies.put(body, True)
+
+	def flush(self):
+		"""Queues the pending documents, without waiting for the response."""
+		with self._lock:
+			body = self.take() if self._lines else None
+
+		if body is not None:
+			self.enqueue(body)
+
+	def drain(self):
+		"""Sends the pending documents and waits until every body is answered, retries included."""
+		self.flush()
+		with self._idle:
+			while self._in_flight:
+				self._idle.wait()
+
+	def close(self):
+		"""Sends the pending documents and waits for all the requests in flight.
+
+		Returns:
+			Dict with the sink statistics.
+		"""
+		self.flush()
+		for _ in self._senders:
+			self._bodies.put(END, True)
+		for sender in self._senders:
+			sender.join()
+
+		vprint('Bulk sink: {documents:d} documents, {requests:d} requests, {bytes:d} bytes, '
+			'{failed_requests:d} failed requests, {failed_documents:d} failed documents, '
+			'{rejected_documents:d} rejections, {retries:d} retries ({retried_documents:d} documents), '
+			'{gave_up_documents:d} documents given up, {ack_errors:d} failed acknowledgements, '
+			'{sender_errors:d} dropped bodies, final bulk size {bulk_bytes:d} bytes '
+			'({bulk_size_changes:d} changes).'.format(**self.stats))
+
+		return self.stats
+
+	def connect(self, server):
+		"""Opens a connection to a server.
+
+		Args:
+			server (tuple): (protocol, hostname, port) tuple.
+
+		Returns:
+			httplib.HTTPConnection.
+		"""
+		protocol, hostname, port = server
+		Connection = httplib.HTTPSConnection if protocol == 'https' else httplib.HTTPConnection
+		return Connection(hostname, port, timeout=self.timeout)
+
+	def send_loop(self, server):
+		"""Sender thread: sends the queued bodies to a server through a persistent connection.
+
+		Rejected documents are sent again by the same sender, which holds back the producers while the
+		cluster is busy.
+
+		Args:
+			server (tuple): (protocol, hostname, port) tuple.
+		"""
+		connection = None
+		while True:
+			body = self._bodies.get(True)
+			if body is END:
+				break
+
+			# (entries, attempt) pairs still to send, and the entries being sent, not acknowledged yet
+			pending = [(body, 0)]
+			entries = []
+
+			# Whatever happens, the body is answered, or drain() and close() would wait for ever
+			try:
+				while pending:
+					entries, attempt = pending.pop()
+					data = ''.join(lines for lines, ack in entries)
+
+					status = None
+					response = None
+					# Waiting for the limiter is not part of the latency
+					with self._limiter:
+						start = time.time()
+						try:
+							if connection is None:
+								connection = self.connect(server)
+							status, response = self.send(connection, data)
+						except (httplib.HTTPException, socket.error, ValueError), e:
+							if connection is not None:
+								connection.close()
+								connection = None
+							vprint('Bulk request to {:s} failed: {:s}'.format(server[1], str(e)))
+						latency = time.time() - start
+
+					if status is not None and status >= 300:
+						vprint('Bulk request to {:s} failed: HTTP {:d}'.format(server[1], status))
+
+					split = status == 413 and len(entries) > 1
+					if split:
+						succeeded, retry, failed, rejected = [], [], [], len(entries)
+					else:
+						succeeded, retry, failed, rejected = self.results(entries, status, response)
+
+					give_up = retry if attempt >= self.max_retries else []
+					if give_up:
+						retry = []
+
+					with self._stats_lock:
+						stats = self.stats
+						stats['documents'] += len(succeeded)
+						stats['requests'] += 1
+						stats['bytes'] += len(data)
+						stats['failed_requests'] += 1 if status is None or status >= 300 else 0
+						stats['failed_documents'] += len(failed) + len(give_up)
+						stats['rejected_documents'] += rejected
+						stats['gave_up_documents'] += len(give_up)
+						stats['request_time'] += latency
+						stats['min_request_bytes'] = min(stats['min_request_bytes'] or len(data), len(data))
+						stats['max_request_bytes'] = max(stats['max_request_bytes'], len(data))
+						if retry:
+							stats['retries'] += 1
+							stats['retried_documents'] += len(retry)
+						self.adapt(len(data), latency, rejected, status == 413)
+
+					self.acknowledge(succeeded, True)
+					self.acknowledge(failed + give_up, False)
+					entries = []
+
+					if split:
+						half = len(entries) // 2
+						pending.append((entries[half:], attempt))
+						pending.append((entries[:half], attempt))
+					elif retry:
+						time.sleep(self.delay(attempt))
+						pending.append((retry, attempt + 1))
+			except Exception, e:
+				if connection is not None:
+					connection.close()
+					connection = None
+
+				# The documents not acknowledged yet failed, so their chunks and batches complete
+				dropped = entries + [entry for waiting, _ in pending for entry in waiting]
+				with self._stats_lock:
+					self.stats['sender_errors'] += 1
+					self.stats['failed_documents'] += len(dropped)
+				vprint('Bulk sender {:s} dropped {:d} documents: {!r}\n{:s}'.format(threading.current_thread().getName(),
+					len(dropped), e, traceback.format_exc()))
+				self.acknowledge(dropped, False)
+			finally:
+				with self._idle:
+					self._in_flight -= 1
+					self._idle.notify_all()
+
+		if connection is not None:
+			connection.close()
+
+	def acknowledge(self, entries, written):
+		"""Calls the acknowledgement callbacks of some documents.
+
+		A failing callback is counted and reported, and does not stop the sender nor the other callbacks.
+
+		Args:
+			entries (list): (lines, ack) pair of each document.
+			written (bool): Whether the documents were written.
+		"""
+		errors = 0
+		for lines, ack in entries:
+			if ack is None:
+				continue
+			try:
+				ack(written)
+			except Exception, e:
+				errors += 1
+				error = e
+
+		if errors:
+			with self._stats_lock:
+				self.stats['ack_errors'] += errors
+			vprint('Bulk sink: {:d} acknowledgements failed, last one: {!r}'.format(errors, error))
+
+	def results(self, entries, status, response):
+		"""Sorts out the documents of a request by their result.
+
+		Args:
+			entries (list): (lines, ack) pair of each document sent.
+			status (int): Response status, None if the request did not complete.
+			response (dict): Decoded response, None if not successful.
+
+		Returns:
+			Tuple with the entries of the written documents, of the documents to send again, of the failed
+			documents, and the number of rejected documents.
+		"""
+		if status is None or status in RETRY_STATUSES:
+			return [], entries, [], len(entries) if status == 429 else 0
+
+		if status >= 300:
+			return [], [], entries, len(entries) if status == 413 else 0
+
+		items = response.get('items', [])
+		if len(items) != len(entries):
+			return [], [], entries, 0
+
+		succeeded = []
+		retry = []
+		failed = []
+		rejected = 0
+		for entry, item in zip(entries, items):
+			result = item.values()[0]
+			if 'error' not in result:
+				succeeded.append(entry)
+				continue
+
+			error = str(result['error']).lower()
+			if result.get('status') in RETRY_STATUSES or 'rejected_execution' in error or 'rejectedexecution' in error:
+				retry.append(entry)
+				rejected += 1
+			else:
+				failed.append(entry)
+
+		return succeeded, retry, failed, rejected
+
+	def delay(self, attempt):
+		"""Seconds to wait before a retry: exponential backoff with full jitter.
+
+		http://www.awsarchitectureblog.com/2015/03/backoff.html
+
+		Args:
+			attempt (int): Number of retries already done.
+
+		Returns:
+			float.
+		"""
+		return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+	def adapt(self, size, latency, rejected, too_large):
+		"""Adjusts the target body size from the last response. Must be called holding the stats lock.
+
+		Args:
+			size (int): Size of the last body, in bytes.
+			latency (float): Seconds the last request took.
+			rejected (int): Number of rejected documents.
+			too_large (bool): Whether the body was rejected for being too large.
+		"""
+		target = self.bulk_bytes
+
+		if too_large:
+			target = min(target, size) // 2
+		elif rejected:
+			target = target // 2
+		elif latency > self.bulk_latency:
+			target = int(target * 0.8)
+		elif latency < self.bulk_latency / 2 and size >= target * 0.9:
+			# Only full bodies tell whether a bigger one would still be fast.
+			target = int(target * 1.25)
+
+		target = max(self.min_bulk_bytes, min(target, self.max_bulk_bytes))
+
+		if target != self.bulk_bytes:
+			self.bulk_bytes = target
+			self.stats['bulk_bytes'] = target
+			self.stats['bulk_size_changes'] += 1
+			self.stats['bulk_sizes'].append((round(time.time() - self._start_time, 3), target))
+
+	def send(self, connection, data):
+		"""Sends a `_bulk` request.
+
+		Args:
+			connection (httplib.HTTPConnection): Connection.
+			data (string): Body.
+
+		Returns:
+			Tuple with the response status and the decoded response, None if not successful.
+		"""
+		with metrics.time('bulk_send'):
+			# httplib.request would copy the body after the headers to send them at once
+			if connection.sock is None:
+				connection.connect()
+				connection.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+			connection.putrequest('POST', '/_bulk', skip_accept_encoding=True)
+			connection.putheader('Content-Type', 'application/x-ndjson')
+			connection.putheader('Content-Length', str(len(data)))
+			connection.endheaders()
+			connection.send(data)
+			response = connection.getresponse()
+			content = response.read()
+		metrics.add('bytes_sent', len(data))
+
+		if response.status >= 300:
+			return response.status, None
+
+		return response.status, json.loads(content)
@@ -0,0 +1,379 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""File.py: File sink writing `_bulk` NDJSON shards, and their loader."""
+
+__author__      = "Ber Clausen"
+__copyright__   = "Copyright 2014, Planet Earth"
+
+import os
+import time
+import zlib
+import multiprocessing
+from Queue import Queue, Empty
+
+# Threading
+import threading
+
+# Zstandard, optional
+try:
+	import zstandard
+except ImportError:
+	zstandard = None
+
+# Errors
+from utils.errors import BadConfigError
+
+# Thread
+from utils.Thread import Thread
+
+# Utility functions
+from utils.utils import vprint
+
+# Base sink
+from BaseSink import BaseSink
+
+
+# File extension of each compression.
+EXTENSIONS = {
+	None: '.ndjson',
+	'gzip': '.ndjson.gz',
+	'zstd': '.ndjson.zst',
+}
+
+# Shards being written, renamed once complete.
+PARTIAL_EXTENSION = '.tmp'
+
+# Bytes read from a shard at a time.
+READ_BYTES = 1024 * 1024
+
+
+def compressor(compression, level=None):
+	"""Builds a streaming compressor.
+
+	Args:
+		compression (string): 'gzip', 'zstd', or None.
+		level (int): Compression level, the default one if None.
+
+	Returns:
+		Object with the `compress(data)` and `flush()` methods, None if not compressed.
+	"""
+	if compression is None:
+		return None
+	if compression == 'gzip':
+		# 16 + MAX_WBITS writes the gzip header and trailer.
+		return zlib.compressobj(6 if level is None else level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+	if compression == 'zstd':
+		if zstandard is None:
+			raise BadConfigError('The zstd compression needs the zstandard module.')
+		return zstandard.ZstdCompressor(level=3 if level is None else level).compressobj()
+	raise BadConfigError('Unsupported compression: {!s}.'.format(compression))
+
+def decompressor(path):
+	"""Builds the streaming decompressor of a shard, from its extension.
+
+	Args:
+		path (string): Shard path.
+
+	Returns:
+		Object with the `decompress(data)` method, None if not compressed.
+	"""
+	if path.endswith(EXTENSIONS['gzip']):
+		return zlib.decompressobj(16 + zlib.MAX_WBITS)
+	if path.endswith(EXTENSIONS['zstd']):
+		if zstandard is None:
+			raise BadConfigError('Loading zstd shards needs the zstandard module.')
+		return zstandard.ZstdDecompressor().decompressobj()
+	return None
+
+
+class FileSink(BaseSink):
+	"""File sink.
+
+	Operations are written in the `_bulk` NDJSON format to shards of at most `shard_bytes` uncompressed bytes,
+	optionally compressed. A shard is written as a `.tmp` file, and renamed once complete and synced to disk;
+	only then are its documents acknowledged, so checkpoints never cover documents of a partial shard.
+
+	Producers only hold the sink lock to buffer their lines. A full buffer is taken by the producer that
+	filled it, and compressed and written under a lock of its own, so the other producers keep buffering
+	meanwhile. `flush` writes the buffer, but only completes the shard once it is `shard_seconds` old, so
+	following the change log does not leave a tiny shard per batch; `drain` and `close` complete it.
+
+	Shards are named after the index, the start time of the sink and the process, so several processes can
+	write to the same directory. They can be loaded later with `load`, on another machine if need be.
+
+	Attributes:
+		shard_bytes (int): Maximum uncompressed bytes per shard.
+		shard_seconds (float): Seconds after which a flush completes the current shard.
+		buffer_bytes (int): Bytes buffered before being compressed and written.
+		compression (string): 'gzip', 'zstd', or None.
+		level (int): Compression level, the default one if None.
+	"""
+
+	shard_bytes = 256 * 1024 * 1024
+	shard_seconds = 60.0
+	buffer_bytes = 1024 * 1024
+	compression = 'gzip'
+	level = None
+
+	def __init__(self, directory, es_index, es_type,
+		compression='gzip',
+		shard_bytes=None,
+		level=None,
+		shard_seconds=None):
+		"""Initialization.
+
+		Args:
+			directory (string): Directory of the shards, created if missing.
+			es_index (string): Elasticsearch index.
+			es_type (string): Elasticsearch type.
+			compression (string): 'gzip', 'zstd', or None.
+			shard_bytes (int): Maximum uncompressed bytes per shard.
+			level (int): Compression level, the default one if None.
+			shard_seconds (float): Seconds after which a flush completes the current shard.
+		"""
+		super(FileSink, self).__init__(es_index, es_type)
+
+		if compression not in EXTENSIONS:
+			raise BadConfigError('Unsupported compression: {!s}.'.format(compression))
+		self.compression = compression
+		self.level = level
+		if shard_bytes is not None:
+			if shard_bytes <= 0:
+				raise BadConfigError('The shard size must be positive.')
+			self.shard_bytes = shard_bytes
+		if shard_seconds is not None:
+			if shard_seconds < 0:
+				raise BadConfigError('The shard age can not be negative.')
+			self.shard_seconds = shard_seconds
+
+		# Fails early if the compression is not available
+		compressor(self.compression, self.level)
+
+		if not os.path.isdir(directory):
+			os.makedirs(directory)
+		self._directory = directory
+		self._prefix = '{:s}-{:s}-{:s}'.format(es_index, time.strftime('%Y%m%d%H%M%S'),
+			multiprocessing.current_process().name)
+
+		# Buffered lines
+		self._lock = threading.Lock()
+		# Current shard, and the statistics
+		self._write_lock = threading.Lock()
+		self._shard = None
+		self._sequence = 0
+		self._lines = []
+		self._bytes = 0
+		self._acks = []
+
+		self.stats = {
+			'documents': 0,
+			'failed_documents': 0,
+			'shards': 0,
+			'bytes': 0,
+			'compressed_bytes': 0,
+		}
+
+	def add(self, lines, ack=None):
+		"""Adds the lines of a bulk operation to the buffer, writing it once full.
+
+		Args:
+			lines (string): Action line, and source line if any.
+			ack: Acknowledgement callback, called once the shard is complete.
+		"""
+		with self._lock:
+			self._lines.append(lines)
+			self._bytes += len(lines)
+			self._acks.append(ack)
+			buffer = self.take() if self._bytes >= self.buffer_bytes else None
+
+		if buffer is not None:
+			self.acknowledge(self.write(buffer))
+
+	def take(self):
+		"""Takes the buffered lines. Must be called holding the lock.
+
+		Returns:
+			Tuple with the lines, their size in bytes and their acknowledgement callbacks.
+		"""
+		buffer = (self._lines, self._bytes, self._acks)
+		self._lines = []
+		self._bytes = 0
+		self._acks = []
+		return buffer
+
+	def write(self, buffer, max_age=None):
+		"""Compresses and writes taken lines to the current shard, opened if needed, and completes the shard once
+		full. Must be called without holding the lock.
+
+		Args:
+			buffer (tuple): Lines, their size in bytes and their acknowledgement callbacks.
+			max_age (float): Seconds after which the shard is completed anyway, None to only complete it once full.
+
+		Returns:
+			List with the acknowledgement callbacks of the shard documents, empty if not completed.
+		"""
+		lines, size, acks = buffer
+		with self._write_lock:
+			if lines:
+				if self._shard is None:
+					self._sequence += 1
+					path = os.path.join(self._directory, '{:s}-{:06d}{:s}'.format(
+						self._prefix, self._sequence, EXTENSIONS[self.compression]))
+					self._shard = {
+						'path': path,
+						'file': open(path + PARTIAL_EXTENSION, 'wb'),
+						'compressor': compressor(self.compression, self.level),
+						'bytes': 0,
+						'acks': [],
+						'opened': time.time(),
+					}
+
+				shard = self._shard
+				data = ''.join(lines)
+				if shard['compressor'] is not None:
+					data = shard['compressor'].compress(data)
+				shard['file'].write(data)
+				shard['bytes'] += size
+				shard['acks'].extend(acks)
+
+				self.stats['bytes'] += size
+				self.stats['compressed_bytes'] += len(data)
+
+			shard = self._shard
+			if shard is not None and (shard['bytes'] >= self.shard_bytes or
+				(max_age is not None and time.time() - shard['opened'] >= max_age)):
+				return self.rotate()
+		return []
+
+	def rotate(self):
+		"""Completes the current shard: syncs it and renames it. Must be called holding the write lock.
+
+		Returns:
+			List with the acknowledgement callbacks of the shard documents.
+		"""
+		shard = self._shard
+		self._shard = None
+
+		if shard['compressor'] is not None:
+			data = shard['compressor'].flush()
+			shard['file'].write(data)
+			self.stats['compressed_bytes'] += len(data)
+		shard['file'].flush()
+		os.fsync(shard['file'].fileno())
+		shard['file'].close()
+		os.rename(shard['path'] + PARTIAL_EXTENSION, shard['path'])
+
+		self.stats['shards'] += 1
+		self.stats['documents'] += len(shard['acks'])
+
+		return shard['acks']
+
+	def acknowledge(self, acks):
+		for ack in acks:
+			if ack is not None:
+				ack(True)
+
+	def flush(self):
+		"""Writes the buffered lines, and completes the current shard if it is `shard_seconds` old, so its
+		documents are acknowledged."""
+		with self._lock:
+			buffer = self.take()
+		self.acknowledge(self.write(buffer, self.shard_seconds))
+
+	def drain(self):
+		"""Writes the buffered lines and completes the current shard, so its documents are acknowledged."""
+		with self._lock:
+			buffer = self.take()
+		self.acknowledge(self.write(buffer, 0))
+
+	def close(self):
+		"""Completes the current shard.
+
+		Returns:
+			Dict with the sink statistics.
+		"""
+		self.drain()
+
+		vprint('File sink: {documents:d} documents, {shards:d} shards, {bytes:d} bytes, '
+			'{compressed_bytes:d} bytes written.'.format(**self.stats))
+
+		return self.stats
+
+
+def shards(directory):
+	"""Complete shards of a directory, partial ones are ignored.
+
+	Args:
+		directory (string): Directory of the shards.
+
+	Returns:
+		Sorted list of paths.
+	"""
+	extensions = tuple(EXTENSIONS.values())
+	return sorted(os.path.join(directory, name) for name in os.listdir(directory) if name.endswith(extensions))
+
+def operations(path):
+	"""Reads the bulk operations of a shard.
+
+	Args:
+		path (string): Shard path.
+
+	Yields:
+		string, action line and source line if any.
+	"""
+	decompress = decompressor(path)
+	with open(path, 'rb') as file:
+		rest = ''
+		action = None
+		while True:
+			data = file.read(READ_BYTES)
+			if not data:
+				break
+			if decompress is not None:
+				data = decompress.decompress(data)
+
+			lines = (rest + data).split('\n')
+			rest = lines.pop()
+			for line in lines:
+				if action is not None:
+					yield action + line + '\n'
+					action = None
+				elif line.startswith('{"delete"'):
+					yield line + '\n'
+				else:
+					action = line + '\n'
+
+	if rest or action is not None:
+		raise ValueError('Truncated shard: {:s}.'.format(path))
+
+def load(sink, paths, threads=4):
+	"""Loads shards into a sink, reading several of them at once.
+
+	Args:
+		sink (BaseSink): Sink the operations are added to, usually a bulk sink.
+		paths (list): Shard paths.
+		threads (int): Number of shards read at once.
+
+	Returns:
+		Dict with the sink statistics.
+	"""
+	queue = Queue()
+	for path in paths:
+		queue.put(path)
+
+	def read_loop():
+		while True:
+			try:
+				path = queue.get(False)
+			except Empty:
+				break
+			vprint('Loading {:s}...'.format(path))
+			for lines in operations(path):
+				sink.add(lines)
+
+	readers = [Thread(read_loop, autostart=True) for _ in range(max(1, min(threads, len(paths))))]
+	for reader in readers:
+		reader.join()
+
+	return sink.close()
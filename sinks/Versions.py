@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Versions.py: Versioned Elasticsearch indexes served through an alias."""
+
+__author__      = "Ber Clausen"
+__copyright__   = "Copyright 2014, Planet Earth"
+
+import re
+import time
+
+# Elasticsearch connector
+from pyes.exceptions import IndexMissingException
+
+# Errors
+from utils.errors import BadConfigError
+
+# Utility functions
+from utils.utils import vprint
+
+
+class VersionedIndex(object):
+	"""VersionedIndex class.
+
+	Full rebuilds write into a new index named after the alias and a UTC timestamp (`dmoz_20140312093000`),
+	nobody searches it while it loads. Once loaded, the alias is moved to it in a single atomic request, and
+	the older versions beyond the retention are deleted.
+
+	Attributes:
+		alias (string): Alias searched by the clients.
+		retention (int): Number of versions kept, including the one behind the alias.
+	"""
+
+	timestamp_format = '%Y%m%d%H%M%S'
+	retention = 2
+
+	def __init__(self, es_connector, alias, retention=None):
+		"""Initialization.
+
+		Args:
+			es_connector: Elasticsearch connector.
+			alias (string): Alias searched by the clients.
+			retention (int): Number of versions kept, including the one behind the alias.
+		"""
+		self._es_connector = es_connector
+		self.alias = alias
+		self._pattern = re.compile('^' + re.escape(alias) + r'_\d{14}$')
+
+		if retention is not None:
+			if retention < 1:
+				raise BadConfigError('At least the version behind the alias must be kept.')
+			self.retention = retention
+
+	def versions(self):
+		"""Existing versions.
+
+		Returns:
+			List of index names, oldest first.
+		"""
+		indices = self._es_connector.indices.get_indices()
+		if self.alias in indices:
+			raise BadConfigError('{:s} is an index, not an alias: delete it, or index into another name, before rebuilding.'.format(self.alias))
+
+		return sorted(name for name in indices if self._pattern.match(name))
+
+	def current(self):
+		"""Versions behind the alias.
+
+		Returns:
+			List of index names.
+		"""
+		try:
+			return list(self._es_connector.indices.get_alias(self.alias))
+		except IndexMissingException:
+			return []
+
+	def unfinished(self):
+		"""Newest version not behind the alias yet, left by an interrupted rebuild.
+
+		Returns:
+			string, None if the newest version is the one behind the alias.
+		"""
+		versions = self.versions()
+		current = self.current()
+		if versions and versions[-1] not in current and (not current or versions[-1] > max(current)):
+			return versions[-1]
+		return None
+
+	def create(self, settings):
+		"""Creates a new version.
+
+		Args:
+			settings (dict): Index settings.
+
+		Returns:
+			string, index name.
+		"""
+		name = '{:s}_{:s}'.format(self.alias, time.strftime(self.timestamp_format, time.gmtime()))
+		self._es_connector.indices.create_index(name, settings)
+		vprint('Created {:s}.'.format(name))
+		return name
+
+	def swap(self, name):
+		"""Moves the alias to a version, in one atomic request.
+
+		Args:
+			name (string): Index name.
+		"""
+		commands = [('remove', index, self.alias) for index in self.current() if index != name]
+		commands.append(('add', name, self.alias))
+		self._es_connector.indices.change_aliases(commands)
+		vprint('Alias {:s} moved to {:s}.'.format(self.alias, name))
+
+	def prune(self):
+		"""Deletes the oldest versions beyond the retention, never the ones behind the alias.
+
+		Returns:
+			List of the deleted index names.
+		"""
+		current = self.current()
+		versions = self.versions()
+		deleted = []
+		for name in versions[:max(len(versions) - self.retention, 0)]:
+			if name in current:
+				continue
+			self._es_connector.indices.delete_index(name)
+			deleted.append(name)
+			vprint('Deleted {:s}.'.format(name))
+		return deleted
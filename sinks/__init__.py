@@ -0,0 +1 @@
+__all__ = ['BaseSink', 'Elasticsearch', 'File', 'Versions']
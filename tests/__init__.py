@@ -0,0 +1 @@
+__all__ = ['test_ChangeLog', 'test_Replicas', 'test_Scheduler']
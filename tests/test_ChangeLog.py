@@ -0,0 +1,204 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""test_ChangeLog.py: Change log cursor, collapsing and triggers, against an in memory SQLite database.
+
+Run from the project root:
+	python -m unittest discover -s tests -t .
+"""
+
+__author__      = "Ber Clausen"
+__copyright__   = "Copyright 2014, Planet Earth"
+
+import unittest
+
+# SQLAlchemy
+import sqlalchemy
+
+# Change log
+from indexer.ChangeLog import ChangeLog, Cursor, collapse, triggers, DELETE, UPSERT
+
+
+class ChangeLogTestCase(unittest.TestCase):
+	"""Change log table in a fresh in memory database."""
+
+	def setUp(self):
+		self.engine = sqlalchemy.create_engine('sqlite://')
+		self.metadata = sqlalchemy.MetaData(bind=self.engine)
+		self.table = ChangeLog.define('changes', self.metadata)
+		self.metadata.create_all()
+		self.change_log = ChangeLog(self.table)
+
+	def log(self, id, root_id, operation=UPSERT):
+		self.engine.execute(self.table.insert(), id=id, root_id=root_id, operation=operation)
+
+	def ids(self, changes):
+		return [change[0] for change in changes]
+
+
+class CursorTest(ChangeLogTestCase):
+
+	def test_reads_in_order(self):
+		for id in [1, 2, 3]:
+			self.log(id, id)
+		cursor = Cursor(self.change_log, settle=60)
+
+		self.assertEqual(self.ids(cursor.poll(100)), [1, 2, 3])
+		self.assertEqual(cursor.settled(), 3)
+		self.assertEqual(cursor.poll(100), [])
+
+	def test_starts_after_offset(self):
+		for id in [1, 2, 3]:
+			self.log(id, id)
+		cursor = Cursor(self.change_log, 2, settle=60)
+
+		self.assertEqual(self.ids(cursor.poll(100)), [3])
+		self.assertEqual(cursor.settled(), 3)
+
+	def test_waits_for_late_change(self):
+		for id in [1, 2, 4]:
+			self.log(id, id)
+		cursor = Cursor(self.change_log, settle=60)
+
+		self.assertEqual(self.ids(cursor.poll(100)), [1, 2, 4])
+		self.assertEqual(cursor.settled(), 2)
+
+		# Committed after 4 was read
+		self.log(3, 3)
+		self.assertEqual(self.ids(cursor.poll(100)), [3])
+		self.assertEqual(cursor.gaps, [])
+		self.assertEqual(cursor.settled(), 4)
+
+	def test_gives_up_gap_once_settled(self):
+		for id in [1, 4]:
+			self.log(id, id)
+		cursor = Cursor(self.change_log, settle=0)
+
+		self.assertEqual(self.ids(cursor.poll(100)), [1, 4])
+		self.assertEqual(cursor.settled(), 4)
+		self.assertEqual(cursor.gaps, [])
+
+	def test_jump_is_one_gap(self):
+		for id in [1, 10 ** 9]:
+			self.log(id, id)
+		cursor = Cursor(self.change_log, settle=60)
+
+		cursor.poll(100)
+		self.assertEqual([gap[:2] for gap in cursor.gaps], [(2, 10 ** 9 - 1)])
+		self.assertEqual(cursor.settled(), 1)
+
+	def test_late_changes_split_gaps(self):
+		for id in [1, 10, 20]:
+			self.log(id, id)
+		cursor = Cursor(self.change_log, settle=60)
+		cursor.poll(100)
+
+		for id in [2, 5, 19]:
+			self.log(id, id)
+		self.assertEqual(self.ids(cursor.poll(100)), [2, 5, 19])
+		self.assertEqual([gap[:2] for gap in cursor.gaps], [(3, 4), (6, 9), (11, 18)])
+		self.assertEqual(cursor.settled(), 2)
+
+	def test_late_and_new_changes_sorted(self):
+		for id in [1, 3]:
+			self.log(id, id)
+		cursor = Cursor(self.change_log, settle=60)
+		cursor.poll(100)
+
+		for id in [4, 2]:
+			self.log(id, id)
+		self.assertEqual(self.ids(cursor.poll(100)), [2, 4])
+		self.assertEqual(cursor.settled(), 4)
+
+	def test_skips_changes_without_root(self):
+		self.log(1, 1)
+		self.log(2, None)
+		self.log(3, 3)
+		cursor = Cursor(self.change_log, settle=60)
+
+		self.assertEqual(self.ids(cursor.poll(100)), [1, 3])
+		self.assertEqual(cursor.gaps, [])
+		self.assertEqual(cursor.settled(), 3)
+
+
+class CollapseTest(unittest.TestCase):
+
+	def test_last_operation_wins(self):
+		operations = collapse([(1, 10, UPSERT), (2, 20, UPSERT), (3, 10, DELETE), (4, 30, DELETE), (5, 30, UPSERT)])
+
+		self.assertEqual(operations.items(), [(10, DELETE), (20, UPSERT), (30, UPSERT)])
+
+	def test_empty(self):
+		self.assertEqual(collapse([]).items(), [])
+
+
+class TriggersTest(ChangeLogTestCase):
+	"""Triggers of a self referential source table with one to many items and a many to one owner."""
+
+	relationships = {
+		'one_to_many': {'items': {'foreign_key': 'category_id'}},
+		'many_to_one': {'owners': {'foreign_key': 'owner_id'}},
+		'self_referential': {'parent': {'foreign_key': 'parent_id'}},
+	}
+
+	def setUp(self):
+		super(TriggersTest, self).setUp()
+		for statement in [
+			'CREATE TABLE categories (id INTEGER PRIMARY KEY, parent_id INTEGER, owner_id INTEGER, name TEXT)',
+			'CREATE TABLE items (id INTEGER PRIMARY KEY, category_id INTEGER, name TEXT)',
+			'CREATE TABLE owners (id INTEGER PRIMARY KEY, name TEXT)',
+		]:
+			self.engine.execute(statement)
+		for statement in triggers('changes', 'categories', self.relationships):
+			self.engine.execute(statement)
+
+		self.execute(
+			"INSERT INTO owners (id, name) VALUES (1, 'owner')",
+			"INSERT INTO categories (id, parent_id, owner_id, name) VALUES (1, NULL, 1, 'root')",
+			"INSERT INTO categories (id, parent_id, owner_id, name) VALUES (2, 1, 1, 'child')",
+			"INSERT INTO categories (id, parent_id, owner_id, name) VALUES (3, 1, NULL, 'other')")
+		self.engine.execute(self.table.delete())
+
+	def execute(self, *statements):
+		for statement in statements:
+			self.engine.execute(statement)
+
+	def changes(self):
+		query = sqlalchemy.select([self.table.c.root_id, self.table.c.operation]).order_by(self.table.c.id)
+		return [tuple(row) for row in self.engine.execute(query)]
+
+	def test_source_insert(self):
+		self.execute("INSERT INTO categories (id, parent_id, name) VALUES (4, NULL, 'new')")
+
+		self.assertEqual(self.changes(), [(4, UPSERT)])
+
+	def test_source_delete(self):
+		self.execute('DELETE FROM categories WHERE id = 3')
+
+		self.assertEqual(self.changes(), [(3, DELETE)])
+
+	def test_source_update_marks_children(self):
+		self.execute("UPDATE categories SET name = 'renamed' WHERE id = 1")
+
+		self.assertEqual(sorted(self.changes()), [(1, UPSERT), (2, UPSERT), (3, UPSERT)])
+
+	def test_item_moved_marks_both_parents(self):
+		self.execute("INSERT INTO items (id, category_id, name) VALUES (1, 2, 'item')")
+		self.execute('UPDATE items SET category_id = 3 WHERE id = 1')
+		self.execute('DELETE FROM items WHERE id = 1')
+
+		self.assertEqual(self.changes(), [(2, UPSERT), (2, UPSERT), (3, UPSERT), (3, UPSERT)])
+
+	def test_owner_change_marks_its_categories(self):
+		self.execute("UPDATE owners SET name = 'renamed' WHERE id = 1")
+
+		self.assertEqual(sorted(self.changes()), [(1, UPSERT), (2, UPSERT)])
+
+	def test_item_without_parent_is_logged_without_root(self):
+		self.execute("INSERT INTO items (id, category_id, name) VALUES (1, NULL, 'orphan')")
+
+		self.assertEqual(self.changes(), [(None, UPSERT)])
+
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""test_Replicas.py: Replica pool balancing, ejection and probing, with in memory SQLite engines.
+
+Run from the project root:
+	python -m unittest discover -s tests -t .
+"""
+
+__author__      = "Ber Clausen"
+__copyright__   = "Copyright 2014, Planet Earth"
+
+import time
+import unittest
+
+# SQLAlchemy
+import sqlalchemy
+
+# Replicas
+from connectors.Replicas import ReplicaPool
+
+
+class Connector(object):
+	"""Db connector stand-in, the pool only needs its engine."""
+
+	def __init__(self, engine):
+		self._engine = engine
+
+	def query(self, statement='SELECT 1'):
+		return self._engine.execute(statement).fetchall()
+
+
+class ReplicaPoolTest(unittest.TestCase):
+
+	def setUp(self):
+		self.pool = ReplicaPool(max_errors=2, eject_seconds=0.05)
+		self.connectors = {}
+		for name in ['fast', 'slow']:
+			engine = sqlalchemy.create_engine('sqlite://')
+			self.connectors[name] = [Connector(engine) for _ in range(2)]
+			for connector in self.connectors[name]:
+				self.pool.add(connector, name)
+
+	def replica(self, name):
+		return self.pool.replicas[name]
+
+	def name(self, connector):
+		for name, connectors in self.connectors.iteritems():
+			if connector in connectors:
+				return name
+
+	def take(self):
+		"""Checks out a db connector and gives it back.
+
+		Returns:
+			string, name of its replica.
+		"""
+		connector = self.pool.get(False)
+		self.pool.put(connector)
+		return self.name(connector)
+
+	def fail(self, name, times):
+		for _ in range(times):
+			self.pool.failed(self.replica(name), Exception('down'))
+
+	def test_lowest_latency_first(self):
+		self.pool.succeeded(self.replica('fast'), 0.001)
+		self.pool.succeeded(self.replica('slow'), 0.1)
+
+		self.assertEqual([self.take() for _ in range(5)], ['fast'] * 5)
+
+	def test_busy_replica_shares_load(self):
+		self.pool.succeeded(self.replica('fast'), 0.01)
+		self.pool.succeeded(self.replica('slow'), 0.015)
+
+		first = self.pool.get(False)
+		second = self.pool.get(False)
+		self.assertEqual((self.name(first), self.name(second)), ('fast', 'slow'))
+
+	def test_queries_measured_during_checkout_only(self):
+		connector = self.pool.get(False)
+		connector.query()
+		self.pool.put(connector)
+		connector.query()
+
+		replica = self.replica(self.name(connector))
+		self.assertEqual(replica.queries, 1)
+		self.assertEqual(replica.checkouts, 1)
+
+	def test_engine_shared_by_pools_measured_once(self):
+		other = ReplicaPool()
+		for connector in self.connectors['fast']:
+			other.add(Connector(connector._engine), 'fast')
+
+		connector = other.get(False)
+		connector.query()
+		other.put(connector)
+
+		self.assertEqual(other.replicas['fast'].queries, 1)
+		self.assertEqual(self.replica('fast').queries, 0)
+
+	def test_failed_query_counted(self):
+		while True:
+			connector = self.pool.get(False)
+			if self.name(connector) == 'slow':
+				break
+			self.pool.put(connector)
+		self.assertRaises(sqlalchemy.exc.DBAPIError, connector.query, 'SELECT * FROM missing')
+		self.pool.put(connector)
+
+		self.assertEqual(self.replica('slow').errors, 1)
+		self.assertEqual(self.replica('slow').failures, 1)
+
+	def test_recent_failure_goes_last(self):
+		self.fail('fast', 1)
+
+		self.assertEqual(self.take(), 'slow')
+
+	def test_ejected_after_max_errors(self):
+		self.fail('fast', 2)
+
+		self.assertTrue(self.replica('fast').ejected_until is not None)
+		self.assertEqual(self.pool.qsize(), 2)
+		self.assertEqual(set(self.take() for _ in range(5)), set(['slow']))
+
+	def test_probe_brings_replica_back(self):
+		self.fail('fast', 2)
+		time.sleep(0.06)
+
+		# The first chunk probes the ejected replica, only one at a time
+		probe = self.pool.get(False)
+		self.assertEqual(self.name(probe), 'fast')
+		self.assertTrue(self.replica('fast').probing)
+		self.assertFalse(self.replica('fast').available(time.time()))
+
+		probe.query()
+		self.pool.put(probe)
+		self.assertTrue(self.replica('fast').ejected_until is None)
+		self.assertEqual(self.pool.qsize(), 4)
+
+	def test_failed_probe_ejects_longer(self):
+		self.fail('fast', 2)
+		time.sleep(0.06)
+
+		probe = self.pool.get(False)
+		self.fail('fast', 1)
+		self.pool.put(probe)
+
+		replica = self.replica('fast')
+		self.assertEqual(replica.ejections, 2)
+		self.assertAlmostEqual(replica.eject_seconds, 0.1)
+		self.assertFalse(replica.available(time.time()))
+
+	def test_every_replica_ejected_still_usable(self):
+		self.fail('fast', 2)
+		self.fail('slow', 2)
+
+		self.assertEqual(self.pool.qsize(), 4)
+		self.assertTrue(self.take() in ['fast', 'slow'])
+
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""test_Scheduler.py: Range scheduler invariants, and the subtraction of checkpointed segments.
+
+Run from the project root:
+	python -m unittest discover -s tests -t .
+"""
+
+__author__      = "Ber Clausen"
+__copyright__   = "Copyright 2014, Planet Earth"
+
+import bisect
+import unittest
+
+# Threading
+import threading
+
+# Scheduler
+from indexer.Scheduler import RangeScheduler, subtract
+
+
+class ListIdSource(object):
+	"""Windowed id source over a sorted list of ids, like IdSource.KeysetIdSource.fetch."""
+
+	def __init__(self, ids):
+		self.ids = sorted(ids)
+
+	def fetch(self, last, window_size, upper=None):
+		start = bisect.bisect_right(self.ids, last) if last is not None else 0
+		end = bisect.bisect_right(self.ids, upper) if upper is not None else len(self.ids)
+		return self.ids[start:min(start + window_size, end)]
+
+
+def drain(scheduler, size, threads):
+	"""Takes every chunk with several workers.
+
+	Returns:
+		List of ((after, upper), ids) chunks taken.
+	"""
+	taken = []
+	lock = threading.Lock()
+
+	def work():
+		while True:
+			chunk = scheduler.next(size)
+			if chunk is None:
+				return
+			with lock:
+				taken.append(chunk)
+
+	workers = [threading.Thread(target=work) for _ in range(threads)]
+	for worker in workers:
+		worker.start()
+	for worker in workers:
+		worker.join()
+	return taken
+
+
+class RangeSchedulerTest(unittest.TestCase):
+
+	ids = range(1, 500) + range(1000, 1010) + range(5000, 8000, 3)
+
+	def assertCovers(self, taken, ids):
+		handed = sorted(id for chunk, chunk_ids in taken for id in chunk_ids)
+		self.assertEqual(handed, sorted(ids))
+
+		# Every id of a chunk is inside its range, and the ranges do not overlap
+		ranges = sorted(chunk for chunk, chunk_ids in taken)
+		for (after, upper), chunk_ids in taken:
+			self.assertTrue(all(after < id <= upper for id in chunk_ids))
+		for (after, upper), (next_after, next_upper) in zip(ranges, ranges[1:]):
+			self.assertTrue(upper <= next_after)
+
+	def test_single_worker(self):
+		scheduler = RangeScheduler(ListIdSource(self.ids), [(0, 600), (600, 9000)])
+
+		self.assertCovers(drain(scheduler, 50, 1), self.ids)
+		self.assertEqual(scheduler.steals, 0)
+
+	def test_workers_steal_the_largest_range(self):
+		scheduler = RangeScheduler(ListIdSource(self.ids), [(0, 9000)])
+
+		self.assertCovers(drain(scheduler, 7, 8), self.ids)
+
+	def test_limit(self):
+		scheduler = RangeScheduler(ListIdSource(self.ids), [(0, 600), (600, 9000)], limit=123)
+
+		taken = drain(scheduler, 10, 4)
+		handed = [id for chunk, chunk_ids in taken for id in chunk_ids]
+		self.assertEqual(len(handed), 123)
+		self.assertEqual(len(set(handed)), 123)
+
+	def test_no_ranges(self):
+		scheduler = RangeScheduler(ListIdSource(self.ids), [])
+
+		self.assertEqual(scheduler.next(10), None)
+
+	def test_steal_while_fetching(self):
+		"""A thief takes the upper half of a range while its worker fetches, without waiting for the fetch."""
+		fetching = threading.Event()
+		release = threading.Event()
+
+		class SlowIdSource(ListIdSource):
+			def fetch(self, last, window_size, upper=None):
+				if threading.current_thread().getName() == 'Owner' and not fetching.is_set():
+					fetching.set()
+					release.wait(5)
+				return ListIdSource.fetch(self, last, window_size, upper)
+
+		ids = range(1, 1001)
+		scheduler = RangeScheduler(SlowIdSource(ids), [(0, 1000)])
+		taken = {}
+
+		def take(name):
+			taken[name] = scheduler.next(1000)
+
+		owner = threading.Thread(target=take, args=('Owner',), name='Owner')
+		owner.start()
+		self.assertTrue(fetching.wait(5))
+
+		thief = threading.Thread(target=take, args=('Thief',))
+		thief.start()
+		thief.join(5)
+		stalled = thief.is_alive()
+		release.set()
+		owner.join()
+		thief.join()
+
+		self.assertFalse(stalled)
+		self.assertEqual(scheduler.steals, 1)
+		self.assertEqual(taken['Thief'], ((500, 1000), range(501, 1001)))
+		self.assertEqual(taken['Owner'], ((0, 500), range(1, 501)))
+
+
+class SubtractTest(unittest.TestCase):
+
+	def test_no_segments(self):
+		self.assertEqual(subtract([(0, 100), (100, 200)], []), [(0, 100), (100, 200)])
+
+	def test_segments_inside_and_across(self):
+		self.assertEqual(subtract([(0, 100), (100, 200), (200, 300)], [(None, 10), (50, 60), (150, 250)]),
+			[(10, 50), (60, 100), (100, 150), (250, 300)])
+
+	def test_range_covered(self):
+		self.assertEqual(subtract([(0, 100), (100, 200)], [(90, 210)]), [(0, 90)])
+
+	def test_segments_outside(self):
+		self.assertEqual(subtract([(100, 200)], [(0, 100), (200, 300)]), [(100, 200)])
+
+
+if __name__ == '__main__':
+	unittest.main()
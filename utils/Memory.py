@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Memory.py: Resident memory ceiling, recycling the process state between chunks."""
+
+# Inside the utils package, `utils` is the package, not the utils.py module
+from __future__ import absolute_import
+
+__author__      = "Ber Clausen"
+__copyright__   = "Copyright 2014, Planet Earth"
+
+import os
+import time
+from contextlib import contextmanager
+
+# Threading
+import threading
+
+# Utility functions
+from utils.utils import vprint
+
+
+try:
+	PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+except (AttributeError, ValueError, OSError):
+	PAGE_SIZE = 4096
+
+
+def rss():
+	"""Current resident set size of the process.
+
+	Returns:
+		int, bytes, None where /proc is not available.
+	"""
+	try:
+		with open('/proc/self/statm') as file:
+			return int(file.read().split()[1]) * PAGE_SIZE
+	except (IOError, IndexError, ValueError):
+		return None
+
+
+class MemoryGuard(object):
+	"""MemoryGuard class.
+
+	Workers process their chunks inside `chunk()`. Between chunks, once the resident memory goes over
+	`max_rss`, new chunks wait while the ones in progress finish, then `recycle` runs alone (draining the
+	sink and releasing the sessions and connections), and the workers go on.
+
+	The memory is read at most every `check_interval` seconds, and recycling happens at most every
+	`min_interval` seconds, so a working set above the ceiling does not stall the run.
+
+	Attributes:
+		max_rss (int): Ceiling in bytes, None to disable the guard.
+		recycles (int): Number of times the state was recycled.
+	"""
+
+	check_interval = 1.0
+	min_interval = 30.0
+
+	def __init__(self, max_rss, recycle, check_interval=None, min_interval=None):
+		"""Initialization.
+
+		Args:
+			max_rss (int): Ceiling in bytes, None to disable the guard.
+			recycle: Called without arguments, while no chunk is in progress.
+			check_interval (float): Seconds between memory reads.
+			min_interval (float): Minimum seconds between recycles.
+		"""
+		if max_rss is not None and rss() is None:
+			vprint('The resident memory can not be read here, the memory ceiling is ignored.')
+			max_rss = None
+
+		self.max_rss = max_rss
+		self.recycles = 0
+		if check_interval is not None:
+			self.check_interval = check_interval
+		if min_interval is not None:
+			self.min_interval = min_interval
+
+		self._recycle = recycle
+		self._condition = threading.Condition()
+		self._active = 0
+		self._recycling = False
+		self._checked_at = 0.0
+		self._recycled_at = 0.0
+
+	@contextmanager
+	def chunk(self):
+		"""Runs a chunk, recycling before it if the ceiling is reached."""
+		if self.max_rss is None:
+			yield
+			return
+
+		self.check()
+		with self._condition:
+			while self._recycling:
+				self._condition.wait()
+			self._active += 1
+		try:
+			yield
+		finally:
+			with self._condition:
+				self._active -= 1
+				self._condition.notify_all()
+
+	def check(self):
+		"""Recycles if the memory is over the ceiling, waiting for the chunks in progress."""
+		now = time.time()
+		if now - self._checked_at < self.check_interval or now - self._recycled_at < self.min_interval:
+			return
+		self._checked_at = now
+
+		before = rss()
+		if before is None or before <= self.max_rss:
+			return
+
+		with self._condition:
+			# Another worker is already on it
+			if self._recycling:
+				return
+			self._recycling = True
+			while self._active:
+				self._condition.wait()
+
+		try:
+			self._recycle()
+		finally:
+			with self._condition:
+				self._recycling = False
+				self._recycled_at = time.time()
+				self.recycles += 1
+				self._condition.notify_all()
+
+		vprint('Memory ceiling reached: {:.1f}MB before recycling, {:.1f}MB after.'.format(
+			before / 1048576.0, (rss() or 0) / 1048576.0))
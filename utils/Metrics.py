@@ -0,0 +1,335 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Metrics.py: Per worker timers, counters and latency histograms of the indexing stages."""
+
+# Inside the utils package, `utils` is the package, not the utils.py module
+from __future__ import absolute_import
+
+__author__      = "Ber Clausen"
+__copyright__   = "Copyright 2014, Planet Earth"
+
+import json
+import os
+import time
+from contextlib import contextmanager
+
+# Threading
+import threading
+
+# SQLAlchemy
+import sqlalchemy
+import sqlalchemy.event
+
+# Utility functions
+from utils.utils import vprint
+
+
+# Upper bounds of the latency histogram buckets, in seconds.
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, float('inf'))
+
+# Stages, in pipeline order, with their description.
+TIMERS = [
+	('id_fetch', 'Fetching the ids to index'),
+	('read', 'Reading the rows of a chunk, queries included'),
+	('sql_query', 'Executing a SQL statement'),
+	('build', 'Building the documents of a chunk'),
+	('serialize', 'Serializing a document to a bulk body'),
+	('bulk_send', 'Sending a _bulk request and reading its response'),
+]
+
+COUNTERS = [
+	('documents', 'Documents handed to the sink'),
+	('skipped_documents', 'Unchanged documents skipped by their fingerprint'),
+	('related_cache_hits', 'Related parents found in the cache'),
+	('related_cache_misses', 'Related parents queried'),
+	('related_cache_evictions', 'Related parents evicted from the cache'),
+	('bytes_sent', 'Bytes of the _bulk bodies sent'),
+]
+
+
+class Timer(object):
+	"""Latency histogram.
+
+	Attributes:
+		count (int): Number of observations.
+		total (float): Sum of the observed seconds.
+		max (float): Largest observation.
+		buckets (list): Number of observations of each bucket, not cumulative.
+	"""
+
+	def __init__(self):
+		self.count = 0
+		self.total = 0.0
+		self.max = 0.0
+		self.buckets = [0] * len(BUCKETS)
+
+	def observe(self, seconds):
+		self.count += 1
+		self.total += seconds
+		if seconds > self.max:
+			self.max = seconds
+		for i, bound in enumerate(BUCKETS):
+			if seconds <= bound:
+				self.buckets[i] += 1
+				break
+
+	def merge(self, other):
+		self.count += other.count
+		self.total += other.total
+		self.max = max(self.max, other.max)
+		self.buckets = [a + b for a, b in zip(self.buckets, other.buckets)]
+
+	def quantile(self, q):
+		"""Upper bound of the bucket holding a quantile.
+
+		Args:
+			q (float): Quantile, between 0 and 1.
+
+		Returns:
+			float.
+		"""
+		rank = q * self.count
+		seen = 0
+		for bound, count in zip(BUCKETS, self.buckets):
+			seen += count
+			if count and seen >= rank:
+				return min(bound, self.max)
+		return self.max
+
+	def to_dict(self):
+		return {
+			'count': self.count,
+			'seconds': round(self.total, 6),
+			'max': round(self.max, 6),
+			'p50': round(self.quantile(0.5), 6),
+			'p99': round(self.quantile(0.99), 6),
+			'buckets': dict(('{:g}'.format(bound), count) for bound, count in zip(BUCKETS, self.buckets)),
+		}
+
+
+class Metrics(object):
+	"""Metrics class.
+
+	Timers and counters are kept by worker thread. A thread only updates its own ones, so recording needs no
+	lock; totals are merged when reported.
+
+	Attributes:
+		start_time (float): Start time in seconds.
+	"""
+
+	def __init__(self):
+		self.start_time = time.time()
+		self._workers = {}
+		self._lock = threading.Lock()
+		self._local = threading.local()
+
+	def reset(self):
+		"""Forgets every metric, in processes forked after recording some."""
+		self.__init__()
+
+	def worker(self):
+		"""Timers and counters of the current thread, registered the first time.
+
+		Returns:
+			Tuple with the dicts of timers and counters by name.
+		"""
+		worker = getattr(self._local, 'worker', None)
+		if worker is None:
+			worker = self._local.worker = ({}, {})
+			with self._lock:
+				self._workers.setdefault(threading.current_thread().getName(), []).append(worker)
+		return worker
+
+	def observe(self, name, seconds):
+		"""Records a latency.
+
+		Args:
+			name (string): Timer name.
+			seconds (float): Latency.
+		"""
+		timers = self.worker()[0]
+		timer = timers.get(name)
+		if timer is None:
+			timer = timers[name] = Timer()
+		timer.observe(seconds)
+
+	def add(self, name, value=1):
+		"""Increments a counter.
+
+		Args:
+			name (string): Counter name.
+			value (int): Increment.
+		"""
+		counters = self.worker()[1]
+		counters[name] = counters.get(name, 0) + value
+
+	@contextmanager
+	def time(self, name):
+		"""Times a block.
+
+		Args:
+			name (string): Timer name.
+		"""
+		start = time.time()
+		try:
+			yield
+		finally:
+			self.observe(name, time.time() - start)
+
+	def snapshot(self):
+		"""Merged timers and counters, by worker and in total.
+
+		Returns:
+			Dict.
+		"""
+		with self._lock:
+			workers = [(name, list(registered)) for name, registered in self._workers.items()]
+
+		total_timers = {}
+		total_counters = {}
+		by_worker = {}
+		for name, registered in sorted(workers):
+			timers = {}
+			counters = {}
+			for worker_timers, worker_counters in registered:
+				for timer_name, timer in worker_timers.items():
+					timers.setdefault(timer_name, Timer()).merge(timer)
+					total_timers.setdefault(timer_name, Timer()).merge(timer)
+				for counter_name, value in worker_counters.items():
+					counters[counter_name] = counters.get(counter_name, 0) + value
+					total_counters[counter_name] = total_counters.get(counter_name, 0) + value
+			by_worker[name] = {
+				'timers': dict((timer_name, timer.to_dict()) for timer_name, timer in timers.items()),
+				'counters': counters,
+			}
+
+		return {
+			'elapsed': round(time.time() - self.start_time, 3),
+			'total': {
+				'timers': dict((timer_name, timer.to_dict()) for timer_name, timer in total_timers.items()),
+				'counters': total_counters,
+			},
+			'workers': by_worker,
+		}
+
+	def prometheus(self, snapshot=None):
+		"""Renders the metrics in the Prometheus text exposition format.
+
+		Args:
+			snapshot (dict): Snapshot to render, None to take one.
+
+		Returns:
+			string.
+		"""
+		if snapshot is None:
+			snapshot = self.snapshot()
+
+		descriptions = dict(TIMERS + COUNTERS)
+		lines = ['# TYPE elastico_elapsed_seconds gauge', 'elastico_elapsed_seconds {:g}'.format(snapshot['elapsed'])]
+
+		timer_names = sorted(set(name for worker in snapshot['workers'].values() for name in worker['timers']))
+		for name in timer_names:
+			metric = 'elastico_{:s}_seconds'.format(name)
+			lines.append('# HELP {:s} {:s}.'.format(metric, descriptions.get(name, name)))
+			lines.append('# TYPE {:s} histogram'.format(metric))
+			for worker_name, worker in sorted(snapshot['workers'].items()):
+				timer = worker['timers'].get(name)
+				if timer is None:
+					continue
+				cumulative = 0
+				for bound in BUCKETS:
+					label = '{:g}'.format(bound)
+					cumulative += timer['buckets'][label]
+					lines.append('{:s}_bucket{{worker="{:s}",le="{:s}"}} {:d}'.format(
+						metric, worker_name, '+Inf' if bound == float('inf') else label, cumulative))
+				lines.append('{:s}_sum{{worker="{:s}"}} {:g}'.format(metric, worker_name, timer['seconds']))
+				lines.append('{:s}_count{{worker="{:s}"}} {:d}'.format(metric, worker_name, timer['count']))
+
+		counter_names = sorted(set(name for worker in snapshot['workers'].values() for name in worker['counters']))
+		for name in counter_names:
+			metric = 'elastico_{:s}_total'.format(name)
+			lines.append('# HELP {:s} {:s}.'.format(metric, descriptions.get(name, name)))
+			lines.append('# TYPE {:s} counter'.format(metric))
+			for worker_name, worker in sorted(snapshot['workers'].items()):
+				if name in worker['counters']:
+					lines.append('{:s}{{worker="{:s}"}} {:d}'.format(metric, worker_name, worker['counters'][name]))
+
+		return '\n'.join(lines) + '\n'
+
+	def write(self, path):
+		"""Writes the metrics to a file, replaced atomically: JSON if the path ends with `.json`, Prometheus text
+		otherwise (for the node exporter textfile collector).
+
+		Args:
+			path (string): File path.
+		"""
+		snapshot = self.snapshot()
+		temporary_path = path + '.tmp'
+		with open(temporary_path, 'w') as file:
+			if path.endswith('.json'):
+				json.dump(snapshot, file, indent=1, sort_keys=True)
+			else:
+				file.write(self.prometheus(snapshot))
+		os.rename(temporary_path, path)
+
+	def summary(self):
+		"""Prints the totals of every stage, slowest first, to spot the bottleneck."""
+		snapshot = self.snapshot()
+		total = snapshot['total']
+
+		vprint('Stages ({:.3f}s elapsed):'.format(snapshot['elapsed']))
+		for name, timer in sorted(total['timers'].items(), key=lambda item: -item[1]['seconds']):
+			vprint('  {:s}: {:d} in {:.3f}s, mean {:.6f}s, p50 {:.6f}s, p99 {:.6f}s, max {:.6f}s'.format(
+				name, timer['count'], timer['seconds'], timer['seconds'] / max(timer['count'], 1),
+				timer['p50'], timer['p99'], timer['max']))
+		for name, value in sorted(total['counters'].items()):
+			vprint('  {:s}: {:d}'.format(name, value))
+
+
+class Reporter(threading.Thread):
+	"""Writes the metrics to a file periodically, until stopped."""
+
+	def __init__(self, metrics, path, interval=10.0):
+		"""Initialization.
+
+		Args:
+			metrics (Metrics): Metrics.
+			path (string): File path.
+			interval (float): Seconds between writes.
+		"""
+		super(Reporter, self).__init__(name='Metrics')
+		self.daemon = True
+		self.metrics = metrics
+		self.path = path
+		self.interval = interval
+		self._stop_event = threading.Event()
+
+	def run(self):
+		while not self._stop_event.wait(self.interval):
+			self.metrics.write(self.path)
+
+	def stop(self):
+		"""Stops the reporter, writing the final metrics."""
+		self._stop_event.set()
+		self.join()
+		self.metrics.write(self.path)
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+	context._metrics_start = time.time()
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+	start = getattr(context, '_metrics_start', None)
+	if start is not None:
+		metrics.observe('sql_query', time.time() - start)
+
+def instrument_sql():
+	"""Times every SQL statement of every engine, whatever the connector."""
+	if not sqlalchemy.event.contains(sqlalchemy.engine.Engine, 'before_cursor_execute', before_cursor_execute):
+		sqlalchemy.event.listen(sqlalchemy.engine.Engine, 'before_cursor_execute', before_cursor_execute)
+		sqlalchemy.event.listen(sqlalchemy.engine.Engine, 'after_cursor_execute', after_cursor_execute)
+
+
+# Metrics of the current process.
+metrics = Metrics()
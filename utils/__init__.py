@@ -1 +1 @@
-__all__ = ['Thread', 'ThreadWatcher', 'errors', 'utils']
+__all__ = ['Memory', 'Metrics', 'Thread', 'ThreadWatcher', 'errors', 'utils']
@@ -32,3 +32,8 @@ class BadConfigError(Error):
 class ConnectorError(Error):
     """Exception raised for configuration errors."""
     msg = 'Connector errors were found.'
+
+
+class SinkError(Error):
+    """Exception raised for output sink errors."""
+    msg = 'Sink errors were found.'
@@ -37,4 +37,25 @@ def uniqify(collection):
 
 	seen = set()
 	seen_add = seen.add
-	return [x for x in collection if x not in seen and not seen_add(x)]
\ No newline at end of file
+	return [x for x in collection if x not in seen and not seen_add(x)]
+
+def format_timedelta(value):
+	"""Formats a duration as a time of day, the way MySQL shows TIME values: [-]HH:MM:SS[.ffffff].
+
+	MySQLdb returns TIME columns as datetime.timedelta, which may be negative or over 24 hours.
+
+	Args:
+		value (datetime.timedelta): Duration.
+
+	Returns:
+		string.
+	"""
+	microseconds = (value.days * 86400 + value.seconds) * 1000000 + value.microseconds
+	sign = '-' if microseconds < 0 else ''
+	seconds, microseconds = divmod(abs(microseconds), 1000000)
+	minutes, seconds = divmod(seconds, 60)
+	hours, minutes = divmod(minutes, 60)
+	text = '{:s}{:02d}:{:02d}:{:02d}'.format(sign, hours, minutes, seconds)
+	if microseconds:
+		text += '.{:06d}'.format(microseconds)
+	return text
\ No newline at end of file